@@ -0,0 +1,115 @@
+# async_database.py
+# Асинхронная обёртка над database.py: запросы выполняются в отдельных потоках,
+# чтобы обработчики не блокировали event loop.
+# Все записи идут через один поток (сериализованный писатель), чтения — через пул.
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+import database
+import metrics
+
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+_readers = ThreadPoolExecutor(max_workers=config.DB_READ_WORKERS, thread_name_prefix='db-reader')
+
+async def _run(executor, fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    call = functools.partial(fn, *args, **kwargs)
+    if metrics.ENABLED:
+        call = metrics.timed_call(metrics.DB_SECONDS, fn.__name__, call)
+    return await loop.run_in_executor(executor, call)
+
+def _read(fn):
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        return await _run(_readers, fn, *args, **kwargs)
+    return wrapper
+
+def _read_user(fn):
+    # cached user lookups are answered on the event loop without a thread hop;
+    # a single cache lookup, so an entry expiring meanwhile can't make fn hit the DB here
+    @functools.wraps(fn)
+    async def wrapper(user_id):
+        row = database.get_cached_user(user_id)
+        if row is database.USER_MISS:
+            return await _run(_readers, fn, user_id)
+        return fn.from_row(row)
+    return wrapper
+
+def _write(fn):
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        return await _run(_writer, fn, *args, **kwargs)
+    return wrapper
+
+# users
+add_user = _write(database.add_user)
+get_user_role = _read_user(database.get_user_role)
+get_user_name = _read_user(database.get_user_name)
+set_user_name = _write(database.set_user_name)
+get_manager_fi_for_employee = _read_user(database.get_manager_fi_for_employee)
+set_manager_fi_for_employee = _write(database.set_manager_fi_for_employee)
+get_manager_id_by_fi = _read(database.get_manager_id_by_fi)
+get_employees = _read(database.get_employees)
+get_user_by_name = _read(database.get_user_by_name)
+get_user_unit = _read_user(database.get_user_unit)
+user_cache_stats = database.user_cache_stats
+
+# reports
+save_report = _write(database.save_report)
+get_report = _read(database.get_report)
+get_all_reports_on_date = _read(database.get_all_reports_on_date)
+get_reports_page = _read(database.get_reports_page)
+get_missing_reports = _read(database.get_missing_reports)
+get_report_with_manager = _read(database.get_report_with_manager)
+
+# combined RTP reports
+save_rtp_combined = _write(database.save_rtp_combined)
+get_rtp_combined = _read(database.get_rtp_combined)
+get_all_rtp_combined_on_date = _read(database.get_all_rtp_combined_on_date)
+get_rtp_combined_status_for_all = _read(database.get_rtp_combined_status_for_all)
+
+# materialized aggregates
+get_rtp_aggregate = _read(database.get_rtp_aggregate)
+get_rtp_period = _read(database.get_rtp_period)
+
+# organisational structure
+get_unit = _read(database.get_unit)
+get_units = _read(database.get_units)
+get_child_units = _read(database.get_child_units)
+get_unit_path = _read(database.get_unit_path)
+is_unit_within = _read(database.is_unit_within)
+get_unit_overview = _read(database.get_unit_overview)
+get_unit_rollup = _read(database.get_unit_rollup)
+get_unit_period = _read(database.get_unit_period)
+get_submitted_rollup = _read(database.get_submitted_rollup)
+get_submitted_period = _read(database.get_submitted_period)
+add_unit = _write(database.add_unit)
+move_unit = _write(database.move_unit)
+delete_unit = _write(database.delete_unit)
+set_unit_head = _write(database.set_unit_head)
+
+# authorization
+set_user_verified = _write(database.set_user_verified)
+is_user_verified = _read_user(database.is_user_verified)
+
+# dialog sessions
+save_sessions = _write(database.save_sessions)
+load_session = _read(database.load_session)
+touch_sessions = _write(database.touch_sessions)
+delete_sessions = _write(database.delete_sessions)
+delete_expired_sessions = _write(database.delete_expired_sessions)
+
+# outbox
+enqueue_outbox = _write(database.enqueue_outbox)
+get_due_outbox = _read(database.get_due_outbox)
+next_outbox_attempt = _read(database.next_outbox_attempt)
+delete_outbox = _write(database.delete_outbox)
+reschedule_outbox = _write(database.reschedule_outbox)
+
+def shutdown(wait=True):
+    # дождаться незавершённых записей и остановить потоки
+    _writer.shutdown(wait=wait)
+    _readers.shutdown(wait=wait)
+    database.close_all()
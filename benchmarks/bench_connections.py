@@ -0,0 +1,60 @@
+# benchmarks/bench_connections.py
+# Per-call latency: new sqlite3 connection per call (old get_conn) vs pooled connection.
+# Usage: python benchmarks/bench_connections.py [calls]
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import json
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+
+N_USERS = 1000
+
+def _old_get_user_role(user_id):
+    conn = sqlite3.connect(database.DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute('SELECT role FROM users WHERE user_id = ?', (user_id,))
+    result = cursor.fetchone()
+    conn.close()
+    return result[0] if result else None
+
+def _old_save_report(user_id, report_data):
+    conn = sqlite3.connect(database.DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute('INSERT OR REPLACE INTO reports (user_id, report_date, report_data) VALUES (?, ?, ?)',
+                   (user_id, '2000-01-01', json.dumps(report_data, ensure_ascii=False)))
+    conn.commit()
+    conn.close()
+
+def _time_per_call(fn, calls):
+    start = time.perf_counter()
+    for i in range(calls):
+        fn(i % N_USERS)
+    return (time.perf_counter() - start) / calls * 1e6
+
+def main():
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    tmp = tempfile.mkdtemp()
+    database.DB_FILE = os.path.join(tmp, 'bench.db')
+    database.init_db()
+    for uid in range(N_USERS):
+        database.add_user(uid, 'mkk', f'User {uid}', 'Чепик Ольга')
+    report = {'meetings': '3.0', 'knk_opened': '1.0'}
+
+    before_read = _time_per_call(_old_get_user_role, calls)
+    after_read = _time_per_call(database.get_user_role, calls)
+    before_write = _time_per_call(lambda uid: _old_save_report(uid, report), calls // 4)
+    after_write = _time_per_call(lambda uid: database.save_report(uid, report), calls // 4)
+
+    print(f"{'call':<16}{'before, us':>12}{'after, us':>12}{'speedup':>10}")
+    for name, before, after in (('get_user_role', before_read, after_read),
+                                ('save_report', before_write, after_write)):
+        print(f"{name:<16}{before:>12.1f}{after:>12.1f}{before / after:>9.1f}x")
+    database.close_all()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+# benchmarks/bench_router.py
+# Dispatch cost per callback: CallbackRouter.resolve vs the former linear
+# if/startswith chain of button_handler (same order of checks).
+# Before timing, check_routes() verifies that sample callbacks resolve to the
+# expected handler (or to the route's error text) and exits 1 otherwise.
+# Usage: python benchmarks/bench_router.py [iterations]
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(tempfile.mkdtemp())  # main.py opens reports.db in the working directory
+
+import main
+
+# order of checks in the old button_handler
+LINEAR_CHAIN = [
+    ('exact', 'return_to_menu'), ('prefix', 'role_'), ('exact', 'change_info'),
+    ('prefix', 'choose_rtp_'), ('prefix', 'choose_rm_'), ('exact', 'role_rm'),
+    ('exact', 'rm_show_rtps'), ('prefix', 'rm_choose_rtp_'), ('exact', 'rm_combine_all'),
+    ('prefix', 'download_rtp_'), ('exact', 'download_global'), ('exact', 'role_rtp'),
+    ('exact', 'rtp_menu'), ('exact', 'rtp_show_reports'), ('exact', 'rtp_detailed_reports'),
+    ('exact', 'rtp_combine_reports'), ('exact', 'rtp_send_to_rm'),
+    ('exact', 'rtp_period_menu'), ('exact', 'rm_period_menu'),
+    ('prefix', 'rtp_period_'), ('prefix', 'rm_period_'), ('prefix', 'fckp_prod_'),
+    ('prefix', 'download_user_'), ('exact', 'send_report'),
+]
+
+SAMPLES = [
+    'return_to_menu', 'role_mkk', 'role_rtp', 'change_info', 'choose_rtp_3', 'choose_rm_1',
+    'rm_show_rtps', 'rm_choose_rtp_4', 'rm_combine_all', 'download_rtp_2', 'download_global',
+    'rtp_menu', 'rtp_show_reports', 'rtp_detailed_reports', 'rtp_combine_reports', 'rtp_send_to_rm',
+    'rtp_period_menu', 'rm_period_month', 'fckp_prod_ВЭД', 'download_user_123456789', 'send_report',
+    'edit_report',
+]
+
+# callback_data -> handler name, or ('error', text) when the argument must be rejected
+ROUTES = {
+    'rtp_pick_7': 'on_rtp_pick',
+    'rtp_page_:n12': 'on_rtp_page',
+    'rtp_page_7:p3': 'on_rtp_page',
+    'rtp_page_7:x3': ('error', "Ошибка выбора. Попробуйте снова."),
+    'rm_rtps_page_:n5': 'on_rm_rtps_page',
+    'rm_rtps_page_:5': ('error', "Ошибка навигации."),
+    'rm_units_page_:p9': 'on_rm_units_page',
+    'org_node_4': 'on_org_node',
+    'org_page_4:n10': 'on_org_page',
+    'org_page_4': ('error', "Ошибка оргструктуры."),
+    'org_move_4': 'on_org_move',
+    'org_mvpage_4:p2': 'on_org_move_page',
+    'org_mvpage_x:p2': ('error', "Ошибка оргструктуры."),
+    'org_add_rm_4': 'on_org_add',
+    'org_add_rtp_4': 'on_org_add',
+    'org_add_rtp_x': ('error', "Ошибка оргструктуры."),
+    'org_add_mkk_4': ('error', "Ошибка оргструктуры."),
+    'org_moveto_4:9': 'on_org_moveto',
+    'org_moveto_4': ('error', "Ошибка оргструктуры."),
+}
+
+def check_routes():
+    failed = 0
+    for data, expected in ROUTES.items():
+        handler, _, error = main.router.resolve(data)
+        got = handler.__name__ if handler is not None else ('error', error)
+        if got != expected:
+            print(f"route {data!r}: expected {expected}, got {got}")
+            failed += 1
+    print(f"routes: {len(ROUTES) - failed}/{len(ROUTES)} ok")
+    if failed:
+        sys.exit(1)
+
+def linear_resolve(data):
+    for kind, key in LINEAR_CHAIN:
+        if kind == 'exact' and data == key:
+            return key, ()
+        if kind == 'prefix' and data.startswith(key):
+            arg = data[len(key):]
+            return key, (int(arg) if arg.isdigit() else arg,)
+    return None, ()
+
+def _ns_per_call(fn, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for data in SAMPLES:
+            fn(data)
+    return (time.perf_counter() - start) / (iterations * len(SAMPLES)) * 1e9
+
+def main_bench():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    linear = _ns_per_call(linear_resolve, iterations)
+    routed = _ns_per_call(main.router.resolve, iterations)
+    print(f"callbacks per sample set: {len(SAMPLES)}")
+    print(f"linear chain : {linear:8.1f} ns/callback")
+    print(f"router       : {routed:8.1f} ns/callback")
+    worst = SAMPLES[-2]
+    print(f"worst case '{worst}': linear {_ns_per_call_one(linear_resolve, worst, iterations):.1f} ns, "
+          f"router {_ns_per_call_one(main.router.resolve, worst, iterations):.1f} ns")
+
+def _ns_per_call_one(fn, data, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn(data)
+    return (time.perf_counter() - start) / iterations * 1e9
+
+if __name__ == '__main__':
+    check_routes()
+    main_bench()
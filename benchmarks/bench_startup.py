@@ -0,0 +1,105 @@
+# benchmarks/bench_startup.py
+# Startup time of the bot: from launching `python main.py` to the first update
+# handled. The bot runs as a child process (polling, fake token) against
+# benchmarks/fake_bot_api.py; a /start message is queued before the launch and
+# the clock stops when the fake API receives the reply to it. Also reported:
+# time to the first Bot API request (getMe: imports and setup done) and to the
+# first getUpdates (polling started).
+# Scenarios: "fresh" — empty working directory, the schema is created;
+# "existing" — reports.db left by a previous run (schema up to date).
+# Each scenario runs --runs times, median and min are printed. --latency adds a
+# delay to every Bot API answer (the round trip to api.telegram.org).
+# Usage: python benchmarks/bench_startup.py [--runs 5] [--latency 50] [--json out.json]
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import signal
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT)
+
+from fake_bot_api import FakeBotAPI
+
+MAIN = os.path.join(os.path.dirname(ROOT), 'main.py')
+CHAT_ID = 4242
+
+def start_update():
+    user = {"id": CHAT_ID, "is_bot": False, "first_name": "startup"}
+    return {"message": {"message_id": 1, "date": int(time.time()), "text": "/start",
+                        "chat": {"id": CHAT_ID, "type": "private"}, "from": user,
+                        "entities": [{"type": "bot_command", "offset": 0, "length": 6}]}}
+
+async def launch(workdir, args):
+    # -> {'first_request_ms', 'polling_ms', 'first_update_ms'}
+    api = await FakeBotAPI(latency=args.latency / 1000).start()
+    api.push_update(start_update())
+    reply = api.wait_for(CHAT_ID, 'sendMessage')
+    # values from the real .env are not overridden by load_dotenv, so the token never leaves this machine
+    env = dict(os.environ, BOT_TOKEN='123456:STARTUP', BOT_API_BASE_URL=api.base_url,
+               BOT_MODE='polling', METRICS_ENABLED='0')
+    started = time.perf_counter()
+    proc = await asyncio.create_subprocess_exec(sys.executable, MAIN, cwd=workdir, env=env,
+                                                stdout=asyncio.subprocess.DEVNULL,
+                                                stderr=asyncio.subprocess.PIPE)
+    try:
+        await asyncio.wait_for(reply, args.timeout)
+        handled = time.perf_counter()
+    finally:
+        if proc.returncode is None:
+            proc.send_signal(signal.SIGINT)
+        try:
+            _, stderr = await asyncio.wait_for(proc.communicate(), args.timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            _, stderr = await proc.communicate()
+        await api.stop()
+    if not reply.done():
+        raise RuntimeError(f"no reply to /start:\n{stderr.decode(errors='replace')[-2000:]}")
+    ms = lambda t: round((t - started) * 1000, 1)
+    return {'first_request_ms': ms(api.first_call.get('getMe', handled)),
+            'polling_ms': ms(api.first_call.get('getUpdates', handled)),
+            'first_update_ms': ms(handled)}
+
+def summary(samples):
+    return {key: {'median': round(statistics.median(s[key] for s in samples), 1),
+                  'min': min(s[key] for s in samples)} for key in samples[0]}
+
+async def run(args):
+    results = {}
+    tmp = tempfile.mkdtemp()
+    try:
+        fresh = []
+        for i in range(args.runs):
+            workdir = os.path.join(tmp, f'fresh{i}')
+            os.mkdir(workdir)
+            fresh.append(await launch(workdir, args))
+        results['fresh'] = summary(fresh)
+        # fresh0 now holds a DB written by a previous start
+        existing = [await launch(os.path.join(tmp, 'fresh0'), args) for _ in range(args.runs)]
+        results['existing'] = summary(existing)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=50, help='Bot API round trip, ms')
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+    results = asyncio.run(run(args))
+    row = "{:<10} {:>22} {:>22} {:>22}"
+    print(row.format('', 'first request ms', 'polling started ms', 'first update ms'))
+    for scenario, r in results.items():
+        print(row.format(scenario, *(f"{r[k]['median']} (min {r[k]['min']})"
+                                     for k in ('first_request_ms', 'polling_ms', 'first_update_ms'))))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,346 @@
+# benchmarks/bench_suite.py
+# Micro-benchmarks of the hot paths on a synthetic reports.db:
+# save_report (first save and re-save), report/employee reads, RTP status,
+# config.format_value / format_report and the aggregation paths (the
+# reference.combine_reports loops next to the materialized aggregates that replaced
+# them, daily and over a month).
+#
+# Seeding: --users MKK employees spread over config.RTP_LIST, --days of history
+# ending yesterday, each employee reporting on a day with probability --fill.
+# Defaults are 10000 users x 365 days (~3.3M reports: about ten minutes to seed
+# and ~2.5 GB on disk); --quick uses 1000 x 30. --db PATH keeps the seeded
+# database and reuses it on later runs.
+#
+# Results (per-call median/min in microseconds) can be saved as a JSON baseline
+# and compared later; --compare exits with 1 if any case is slower than
+# baseline * (1 + --threshold). The comparison uses the per-call minimum by
+# default (least sensitive to scheduler noise), --stat median switches it.
+# Every run also times a fixed calibration workload (json + in-memory sqlite);
+# ratios are divided by its drift so a uniformly slower/faster machine does not
+# flag every case (--no-normalize compares raw numbers). Record baselines on the
+# machine that will run the comparison; on shared/virtualised hosts sub-microsecond
+# cases (format_value) can still jitter past 20%, use --rounds 10 or a larger --threshold.
+# Usage:
+#   python benchmarks/bench_suite.py --quick --save baseline.json
+#   python benchmarks/bench_suite.py --quick --compare baseline.json [--threshold 0.2]
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from reference import combine_reports
+
+# --- synthetic data ------------------------------------------------------------
+def fake_report(rng, config):
+    data = {}
+    for q in config.QUESTIONS:
+        if q['key'] == 'fckp_realized':
+            continue
+        value = rng.randint(0, 12) if rng.random() < 0.8 else round(rng.uniform(0, 50), 1)
+        data[q['key']] = str(float(value))
+    products = [rng.choice(config.FCKP_OPTIONS) for _ in range(rng.choice((0, 0, 1, 1, 2, 3)))]
+    data['fckp_products'] = products
+    data['fckp_realized'] = len(products)
+    return data
+
+def seed(database, config, users, days, fill, rng):
+    conn = database.get_conn()
+    today = date.today()
+    dates = [(today - timedelta(days=d)).isoformat() for d in range(days, 0, -1)]
+    rtps = config.RTP_LIST
+    units = {name: unit_id for unit_id, name in database.get_units('rtp')}   # seeded from RTP_LIST
+    with conn:
+        cursor = conn.cursor()
+        cursor.executemany('INSERT INTO users (user_id, role, name, manager_fi, is_verified, unit_id) VALUES (?, ?, ?, ?, 0, ?)',
+                           [(uid, 'mkk', f"Сотрудник {uid}", rtps[uid % len(rtps)], units[rtps[uid % len(rtps)]])
+                            for uid in range(1, users + 1)])
+        cursor.executemany('INSERT INTO users (user_id, role, name, manager_fi, is_verified, unit_id) VALUES (?, ?, ?, NULL, 1, ?)',
+                           [(900000 + i, 'rtp', fi, units[fi]) for i, fi in enumerate(rtps)])
+    report_id = 0
+    for d in dates:
+        reports, metrics, products = [], [], []
+        for uid in range(1, users + 1):
+            if rng.random() > fill:
+                continue
+            report_id += 1
+            data = fake_report(rng, config)
+            rtp = rtps[uid % len(rtps)]
+            reports.append((report_id, uid, d, json.dumps(data, ensure_ascii=False), rtp, units[rtp]))
+            for k, v in database._report_metrics(data).items():
+                if k == database.AGG_COUNT_KEY:
+                    continue
+                if k.startswith(database.AGG_PRODUCT_PREFIX):
+                    products.append((report_id, k[len(database.AGG_PRODUCT_PREFIX):], int(v)))
+                else:
+                    metrics.append((report_id, k, v))
+        with conn:
+            cursor = conn.cursor()
+            cursor.executemany('INSERT INTO reports (id, user_id, report_date, report_data, manager_fi, unit_id) VALUES (?, ?, ?, ?, ?, ?)', reports)
+            cursor.executemany('INSERT INTO report_metrics (report_id, metric_key, value) VALUES (?, ?, ?)', metrics)
+            cursor.executemany('INSERT INTO report_products (report_id, product, count) VALUES (?, ?, ?)', products)
+    database.rebuild_aggregates()
+    # every RTP submits its combined report every day
+    with conn:
+        cursor = conn.cursor()
+        for d in dates:
+            for fi in rtps:
+                combined = database.get_rtp_aggregate(fi, d)
+                if combined:
+                    cursor.execute('INSERT INTO rtp_combined (rtp_name, report_date, combined_data) VALUES (?, ?, ?)',
+                                   (fi, d, json.dumps(combined, ensure_ascii=False)))
+    database.rebuild_aggregates()
+    conn.execute('ANALYZE')
+    return report_id
+
+# --- timing --------------------------------------------------------------------
+def measure(fn, rounds, min_round_time, number=None):
+    # -> per-call seconds of each round; number is calibrated unless given
+    if number is None:
+        number = 1
+        while True:
+            start = time.perf_counter()
+            for _ in range(number):
+                fn()
+            if time.perf_counter() - start >= min_round_time or number >= 1 << 20:
+                break
+            number *= 2
+    per_call = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        per_call.append((time.perf_counter() - start) / number)
+    return per_call, number
+
+_CAL_PAYLOAD = {'k%d' % i: str(float(i)) for i in range(20)}
+_cal_conn = sqlite3.connect(':memory:')
+_cal_conn.execute('CREATE TABLE t (a INTEGER PRIMARY KEY, b TEXT)')
+_cal_conn.executemany('INSERT INTO t VALUES (?, ?)', [(i, str(i)) for i in range(1000)])
+
+def calibration():
+    # fixed CPU + sqlite work, independent of the code under test
+    json.loads(json.dumps(_CAL_PAYLOAD))
+    _cal_conn.execute('SELECT b FROM t WHERE a BETWEEN 100 AND 150').fetchall()
+    sum(float(v) for v in _CAL_PAYLOAD.values())
+
+def build_cases(database, config, users, rng):
+    yesterday = (date.today() - timedelta(days=1)).isoformat()
+    month_start = (date.today() - timedelta(days=30)).isoformat()
+    rtp = config.RTP_LIST[0]
+    root = database.get_units('rm')[0][0]
+    sample = fake_report(rng, config)
+    user_ids = list(range(1, users + 1))
+    cursor = {'new': 0, 'again': 0, 'read': 0}
+
+    def save_new():
+        # first save of the day for a user who has not reported today
+        cursor['new'] += 1
+        database.save_report(user_ids[cursor['new'] % len(user_ids)], sample)
+
+    def save_again():
+        cursor['again'] += 1
+        database.save_report(user_ids[cursor['again'] % 50], sample)
+
+    def get_report():
+        cursor['read'] += 1
+        database.get_report(user_ids[cursor['read'] % len(user_ids)], yesterday)
+
+    def status_cold():
+        database._rtp_status_index.clear()
+        database.get_rtp_combined_status_for_all(config.RTP_LIST, yesterday)
+
+    def combine_rtp_loop():
+        reports = database.get_all_reports_on_date(yesterday, rtp)
+        combine_reports([r for _, r in reports])
+
+    def combine_global_loop():
+        combined = database.get_all_rtp_combined_on_date(yesterday)
+        combine_reports([c for _, c in combined])
+
+    def combine_rtp_month_loop():
+        # what a monthly RTP rollup costs without aggregates: one combine per day
+        start = date.today() - timedelta(days=30)
+        for i in range(30):
+            reports = database.get_all_reports_on_date((start + timedelta(days=i)).isoformat(), rtp)
+            combine_reports([r for _, r in reports])
+
+    aggregated = database.get_rtp_aggregate(rtp, yesterday) or sample
+    # (name, fn, fixed number of calls per round or None to calibrate)
+    return [
+        ('save_report_first', save_new, max(1, min(200, len(user_ids) // 8))),
+        ('save_report_update', save_again, None),
+        ('get_report', get_report, None),
+        ('get_all_reports_on_date_rtp', lambda: database.get_all_reports_on_date(yesterday, rtp), None),
+        ('get_all_reports_on_date_all', lambda: database.get_all_reports_on_date(yesterday), None),
+        ('get_employees_rtp', lambda: database.get_employees(rtp), None),
+        ('get_employees_all', lambda: database.get_employees(), None),
+        ('get_rtp_combined_status_for_all', lambda: database.get_rtp_combined_status_for_all(config.RTP_LIST, yesterday), None),
+        ('get_rtp_combined_status_for_all_cold', status_cold, None),
+        ('get_missing_reports', lambda: database.get_missing_reports(yesterday), None),
+        ('format_value', lambda: config.format_value(1234.5), None),
+        ('format_report', lambda: config.format_report(aggregated), None),
+        ('combine_reports_rtp_loop', combine_rtp_loop, None),
+        ('get_rtp_aggregate', lambda: database.get_rtp_aggregate(rtp, yesterday), None),
+        ('combine_reports_global_loop', combine_global_loop, None),
+        ('get_submitted_rollup_root', lambda: database.get_submitted_rollup(root, yesterday), None),
+        ('combine_reports_rtp_month_loop', combine_rtp_month_loop, None),
+        ('get_rtp_period_month', lambda: database.get_rtp_period(rtp, month_start, yesterday), None),
+        ('get_unit_rollup_root', lambda: database.get_unit_rollup(root, yesterday), None),
+        ('get_unit_overview_root', lambda: database.get_unit_overview(root, yesterday), None),
+        ('get_unit_period_month_root', lambda: database.get_unit_period(root, month_start, yesterday), None),
+        ('get_submitted_period_month_root', lambda: database.get_submitted_period(root, month_start, yesterday), None),
+    ]
+
+# --- baselines -----------------------------------------------------------------
+CALIBRATION = '_calibration'
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except Exception:
+        return None
+
+def compare(baseline, current, threshold, stat='min_us', normalize=True):
+    # -> (machine drift, [(name, base_us, cur_us, ratio, flag)]); ratio is drift-corrected
+    drift = 1.0
+    base_cal = baseline['results'].get(CALIBRATION)
+    cur_cal = current['results'].get(CALIBRATION)
+    if normalize and base_cal and cur_cal and base_cal[stat]:
+        drift = cur_cal[stat] / base_cal[stat]
+    rows = []
+    for name, cur in current['results'].items():
+        if name == CALIBRATION:
+            continue
+        base = baseline['results'].get(name)
+        if base is None:
+            rows.append((name, None, cur[stat], None, 'new'))
+            continue
+        ratio = cur[stat] / base[stat] / drift if base[stat] else float('inf')
+        flag = 'SLOWER' if ratio > 1 + threshold else ('faster' if ratio < 1 / (1 + threshold) else '')
+        rows.append((name, base[stat], cur[stat], ratio, flag))
+    return drift, rows
+
+AGGREGATE_TABLES = ('rtp_aggregates', 'unit_aggregates', 'submitted_aggregates')
+
+def aggregate_snapshot(database):
+    # non-zero rows only: deltas may leave 0-valued rows a rebuild does not create
+    cursor = database.get_conn().cursor()
+    snapshot = {}
+    for table in AGGREGATE_TABLES:
+        cursor.execute(f'SELECT * FROM {table}')
+        snapshot[table] = {row[:-1]: round(row[-1], 6) for row in cursor.fetchall() if abs(row[-1]) > 1e-9}
+    return snapshot
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--fill', type=float, default=0.9, help='share of employees reporting on a given day')
+    parser.add_argument('--quick', action='store_true', help='1000 users x 30 days, shorter rounds')
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--db', help='seeded database to reuse (created if missing)')
+    parser.add_argument('--only', help='comma-separated case names')
+    parser.add_argument('--save', help='write results as a JSON baseline')
+    parser.add_argument('--compare', help='baseline JSON to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown, 0.2 = 20%%')
+    parser.add_argument('--stat', choices=('min', 'median'), default='min', help='statistic to compare')
+    parser.add_argument('--no-normalize', action='store_true', help='do not correct for machine speed drift')
+    args = parser.parse_args()
+    if args.quick:
+        args.users, args.days = 1000, 30
+    min_round_time = 0.05 if args.quick else 0.2
+
+    db_path = os.path.abspath(args.db) if args.db else os.path.join(tempfile.mkdtemp(), 'reports.db')
+    fresh = not os.path.exists(db_path)
+    meta_path = db_path + '.meta.json'
+
+    import config
+    import database
+    database.close_all()
+    database.DB_FILE = db_path
+    database.init_db()
+    rng = random.Random(42)
+    if fresh:
+        start = time.perf_counter()
+        reports = seed(database, config, args.users, args.days, args.fill, rng)
+        meta = {'users': args.users, 'days': args.days, 'fill': args.fill, 'reports': reports}
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+        print(f"seeded {reports} reports for {args.users} users x {args.days} days in {time.perf_counter() - start:.1f} s")
+    else:
+        with open(meta_path) as f:
+            meta = json.load(f)
+        args.users, args.days = meta['users'], meta['days']
+        print(f"reusing {db_path}: {meta['reports']} reports, {args.users} users x {args.days} days")
+
+    # today's rows written by save_report cases must not leak into the next run on a reused db
+    today = date.today().isoformat()
+    cases = build_cases(database, config, args.users, rng)
+    if args.only:
+        wanted = set(args.only.split(','))
+        cases = [c for c in cases if c[0] in wanted]
+    results = {}
+    try:
+        for name, fn, number in [(CALIBRATION, calibration, None)] + cases:
+            per_call, number = measure(fn, args.rounds, min_round_time, number)
+            results[name] = {'median_us': round(statistics.median(per_call) * 1e6, 3),
+                             'min_us': round(min(per_call) * 1e6, 3),
+                             'number': number, 'rounds': args.rounds}
+            print(f"{name:<40} {results[name]['median_us']:>12.2f} us  (min {results[name]['min_us']:.2f}, "
+                  f"{number} x {args.rounds})")
+    finally:
+        conn = database.get_conn()
+        with conn:
+            conn.execute('DELETE FROM report_metrics WHERE report_id IN (SELECT id FROM reports WHERE report_date = ?)', (today,))
+            conn.execute('DELETE FROM report_products WHERE report_id IN (SELECT id FROM reports WHERE report_date = ?)', (today,))
+            conn.execute('DELETE FROM reports WHERE report_date = ?', (today,))
+            conn.execute('DELETE FROM rtp_aggregates WHERE report_date = ?', (today,))
+            conn.execute('DELETE FROM unit_aggregates WHERE report_date = ?', (today,))
+        before = aggregate_snapshot(database)
+        database.rebuild_aggregates()
+        assert aggregate_snapshot(database) == before, "aggregates left after the cleanup differ from a rebuild"
+        database.close_all()
+
+    current = {
+        'meta': dict(meta, rounds=args.rounds, python=platform.python_version(), sqlite=sqlite3.sqlite_version,
+                     machine=platform.machine(), revision=git_revision(),
+                     created=datetime.now().isoformat(timespec='seconds')),
+        'results': results,
+    }
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(current, f, indent=2, ensure_ascii=False)
+        print(f"saved {args.save}")
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        bm, cm = baseline.get('meta', {}), current['meta']
+        if (bm.get('users'), bm.get('days')) != (cm['users'], cm['days']):
+            print(f"warning: baseline data set {bm.get('users')}x{bm.get('days')} differs from {cm['users']}x{cm['days']}")
+        drift, rows = compare(baseline, current, args.threshold, f"{args.stat}_us", not args.no_normalize)
+        print(f"\nmachine drift (calibration now / baseline): {drift:.2f}, ratios below are divided by it")
+        print(f"{'case (' + args.stat + ')':<40} {'baseline us':>12} {'current us':>12} {'ratio':>7}")
+        for name, base, cur, ratio, flag in rows:
+            print(f"{name:<40} {base if base is not None else '-':>12} {cur:>12} "
+                  f"{f'{ratio:.2f}' if ratio is not None else '-':>7}  {flag}")
+        slower = [r[0] for r in rows if r[4] == 'SLOWER']
+        if slower:
+            print(f"\n{len(slower)} case(s) slower than baseline by more than {args.threshold:.0%}: {', '.join(slower)}")
+            sys.exit(1)
+        print(f"\nno case slower than baseline by more than {args.threshold:.0%}")
+
+if __name__ == '__main__':
+    main()
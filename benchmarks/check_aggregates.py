@@ -0,0 +1,97 @@
+# benchmarks/check_aggregates.py
+# Checks that the aggregate tables kept up to date by save_report / save_rtp_combined
+# (deltas per save) match a full rebuild_aggregates() after a sequence of saves in
+# which employees report, re-report, and get moved between RTPs / org units
+# (including from "no RTP yet" to an RTP and back).
+# Usage: python benchmarks/check_aggregates.py [saves] [seed]
+import os
+import random
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import database
+
+TABLES = {
+    'rtp_aggregates': 'manager_fi, report_date, metric_key',
+    'unit_aggregates': 'unit_id, report_date, metric_key',
+    'submitted_aggregates': 'unit_id, report_date, metric_key',
+}
+
+def snapshot():
+    # non-zero rows only: deltas may leave 0-valued rows a rebuild does not create
+    cursor = database.get_conn().cursor()
+    result = {}
+    for table, key in TABLES.items():
+        cursor.execute(f'SELECT {key}, value FROM {table}')
+        result[table] = {row[:-1]: round(row[-1], 9) for row in cursor.fetchall() if abs(row[-1]) > 1e-9}
+    return result
+
+def random_report(rng):
+    data = {q['key']: str(rng.randint(0, 9)) for q in config.QUESTIONS}
+    data['fckp_products'] = [rng.choice(config.FCKP_OPTIONS) for _ in range(rng.randint(0, 2))]
+    data['fckp_realized'] = len(data['fckp_products'])
+    return data
+
+def assign(uid, rtp):
+    # rtp=None: the employee has not picked an RTP yet (and belongs to no org unit)
+    unit_id = dict((name, i) for i, name in database.get_units('rtp')).get(rtp)
+    database.add_user(uid, 'mkk', f"Сотрудник {uid}", rtp, unit_id)
+
+def scripted():
+    # first report without an RTP, second after picking one; then a move to another RTP,
+    # back to "no RTP" and into an RTP again
+    assign(1, None)
+    database.save_report(1, {'meetings': '5'})
+    assign(1, config.RTP_LIST[0])
+    database.save_report(1, {'meetings': '7'})
+    assign(2, config.RTP_LIST[1])
+    database.save_report(2, {'meetings': '3'})
+    assign(2, config.RTP_LIST[0])
+    database.save_report(2, {'meetings': '4'})
+    assign(2, None)
+    database.save_report(2, {'meetings': '1'})
+    assign(2, config.RTP_LIST[1])
+    database.save_report(2, {'meetings': '6'})
+
+def randomized(saves, rng):
+    users = list(range(100, 120))
+    choices = [None] + config.RTP_LIST[:3]
+    for uid in users:
+        assign(uid, rng.choice(choices))
+    for _ in range(saves):
+        uid = rng.choice(users)
+        if rng.random() < 0.3:
+            assign(uid, rng.choice(choices))
+        database.save_report(uid, random_report(rng))
+        if rng.random() < 0.1:
+            rtp = rng.choice(config.RTP_LIST[:3])
+            combined = database.get_rtp_aggregate(rtp, database.datetime.now().strftime('%Y-%m-%d'))
+            if combined:
+                database.save_rtp_combined(rtp, combined, database.datetime.now().strftime('%Y-%m-%d'))
+
+def compare(label):
+    incremental = snapshot()
+    database.rebuild_aggregates()
+    rebuilt = snapshot()
+    ok = True
+    for table in TABLES:
+        a, b = incremental[table], rebuilt[table]
+        diff = sorted(k for k in set(a) | set(b) if a.get(k) != b.get(k))
+        print(f"{label:<12} {table:<20} {len(b)} rows: {'ok' if not diff else f'{len(diff)} differ, e.g. {diff[0]}: {a.get(diff[0])} != {b.get(diff[0])}'}")
+        ok = ok and not diff
+    return ok
+
+if __name__ == '__main__':
+    saves = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    rng = random.Random(int(sys.argv[2]) if len(sys.argv) > 2 else 1)
+    database.DB_FILE = os.path.join(tempfile.mkdtemp(), 'aggregates.db')
+    scripted()
+    ok = compare('scripted')
+    randomized(saves, rng)
+    ok = compare('randomized') and ok
+    database.close_all()
+    print("OK" if ok else "FAILED")
+    sys.exit(0 if ok else 1)
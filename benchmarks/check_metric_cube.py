@@ -0,0 +1,204 @@
+# benchmarks/check_metric_cube.py
+# Checks benchmarks/metric_cube.MetricCube against the loop semantics of reference.combine_reports
+# on random reports (numbers, numeric strings, empty values, junk strings, ФЦКП
+# product lists). The reports are stored in a scratch DB and the cube is loaded
+# from report_metrics / report_products (database.iter_report_metrics), as it
+# would be in the bot. Checked: grand total, per-date / per-RTP / per-employee
+# sums, means, report counts, period-over-period deltas, the dense array(), and
+# per-RTP totals against the SQL aggregates (get_rtp_period). Runs with numpy
+# and again with the loop fallback (metric_cube.np = False); both must match
+# the loops, and each other.
+# Also times a per-RTP monthly rollup: cube group-by vs one combine_reports per
+# RTP vs get_rtp_period per RTP.
+# Usage: python benchmarks/check_metric_cube.py [reports] [seed]
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import config
+import database
+import metric_cube
+from metric_cube import MetricCube
+from reference import combine_reports
+
+def random_report(rng):
+    data = {}
+    for q in config.QUESTIONS:
+        kind = rng.random()
+        if kind < 0.6:
+            data[q['key']] = str(rng.randint(0, 20))
+        elif kind < 0.75:
+            data[q['key']] = round(rng.uniform(0, 10), 2)
+        elif kind < 0.85:
+            data[q['key']] = rng.choice(("", None, 0))
+        elif kind < 0.95:
+            data[q['key']] = rng.choice(("нет", "n/a"))     # skipped by combine_reports
+        # else: field missing
+    # as the bot saves it: fckp_realized is the number of products picked
+    data['fckp_products'] = [rng.choice(config.FCKP_OPTIONS) for _ in range(rng.choice((0, 0, 1, 2)))]
+    data['fckp_realized'] = len(data['fckp_products'])
+    return data
+
+def make_reports(n, rng):
+    # -> [(date, rtp, user_id, data)]; each employee belongs to one RTP and reports at most once a day
+    start = date(2026, 1, 1)
+    users = max(1, n // 20)
+    seen = set()
+    rows = []
+    while len(rows) < min(n, users * 60):
+        uid = rng.randrange(users)
+        day = (start + timedelta(days=rng.randrange(60))).isoformat()
+        if (uid, day) in seen:
+            continue
+        seen.add((uid, day))
+        rows.append((day, config.RTP_LIST[uid % len(config.RTP_LIST)], uid, random_report(rng)))
+    return rows
+
+def store(rows):
+    # reports -> scratch DB (reports + typed metric rows + aggregates), as save_report leaves them
+    conn = database.get_conn()
+    with conn:
+        cursor = conn.cursor()
+        for report_id, (day, rtp, uid, data) in enumerate(rows, 1):
+            cursor.execute('INSERT INTO reports (id, user_id, report_date, report_data, manager_fi) VALUES (?, ?, ?, ?, ?)',
+                           (report_id, uid, day, json.dumps(data, ensure_ascii=False), rtp))
+            database._write_metrics(cursor, report_id, database._report_metrics(data))
+    database.rebuild_aggregates()
+
+def load_cube(start=None, end=None):
+    dates = sorted(r[0] for r in database.get_conn().execute('SELECT DISTINCT report_date FROM reports'))
+    return MetricCube((d, rtp, uid, metrics) for d, rtp, uid, _, metrics
+                      in database.iter_report_metrics(start or dates[0], end or dates[-1]))
+
+def loop_sums(reports):
+    # reference: combine_reports, products as counts, missing numbers as 0
+    combined = combine_reports(reports)
+    sums = {k: v for k, v in combined.items() if k != 'fckp_products'}
+    products = Counter(combined['fckp_products'])
+    return sums, products
+
+def cube_sums(metrics):
+    # report_metrics has no report counter; _combined_from_metrics only needs it to be non-zero
+    combined = database._combined_from_metrics(dict(metrics, **{database.AGG_COUNT_KEY: 1}))
+    sums = {k: v for k, v in combined.items() if k != 'fckp_products'}
+    return sums, Counter(combined['fckp_products'])
+
+def same(a, b):
+    (sa, pa), (sb, pb) = a, b
+    keys = set(sa) | set(sb)
+    return pa == pb and all(math.isclose(sa.get(k, 0), sb.get(k, 0), abs_tol=1e-9) for k in keys)
+
+def grouped(rows, key):
+    groups = {}
+    for row in rows:
+        groups.setdefault(key(row), []).append(row[3])
+    return groups
+
+def check(rows, label):
+    cube = load_cube()
+    failures = []
+
+    def expect(name, ok):
+        if not ok:
+            failures.append(name)
+
+    expect('total', same(cube_sums(cube.sums()), loop_sums([r[3] for r in rows])))
+    for by, key in (('date', lambda r: r[0]), ('group', lambda r: r[1]), ('employee', lambda r: r[2])):
+        want = grouped(rows, key)
+        got = cube.sums(by=by)
+        expect(f'sums by {by}: labels', set(got) == set(want))
+        expect(f'sums by {by}: values', all(same(cube_sums(got[g]), loop_sums(reports))
+                                            for g, reports in want.items() if g in got))
+        expect(f'counts by {by}', cube.counts(by=by) == {g: len(reports) for g, reports in want.items()})
+
+    means = cube.means(by='group')
+    for g, reports in grouped(rows, lambda r: r[1]).items():
+        sums, _ = loop_sums(reports)
+        expect(f'means {g}', all(math.isclose(means[g].get(k, 0), v / len(reports), abs_tol=1e-9)
+                                 for k, v in sums.items() if k in cube.columns))
+
+    # period-over-period: days 30..59 against days 0..29, per RTP and in total
+    dates = sorted({r[0] for r in rows})
+    previous, current = (dates[0], dates[len(dates) // 2 - 1]), (dates[len(dates) // 2], dates[-1])
+    in_range = lambda r, period: period[0] <= r[0] <= period[1]
+    for by, key in ((None, lambda r: None), ('group', lambda r: r[1])):
+        delta = cube.delta(current, previous, by=by)
+        delta = {None: delta} if by is None else delta
+        for g in {key(r) for r in rows}:
+            cur, _ = loop_sums([r[3] for r in rows if key(r) == g and in_range(r, current)])
+            prev, _ = loop_sums([r[3] for r in rows if key(r) == g and in_range(r, previous)])
+            expect(f'delta {by} {g}', all(math.isclose(delta[g].get(k, 0), cur.get(k, 0) - prev.get(k, 0), abs_tol=1e-9)
+                                          for k in set(cur) | set(prev) if k in cube.columns))
+
+    if cube._np is not None:
+        dense = cube.array()
+        by_date = cube.sums(by='date')
+        expect('array', all(math.isclose(dense[i, :, j].sum(), by_date[d][k], abs_tol=1e-9)
+                            for i, d in enumerate(cube.dates) for j, k in enumerate(cube.columns)))
+
+    # per-RTP totals against the SQL aggregates the bot reads
+    first, last = cube.dates[0], cube.dates[-1]
+    for rtp, sums in cube.sums(by='group').items():
+        totals = database.get_rtp_period(rtp, first, last)['totals']
+        expect(f'sql {rtp}', same(cube_sums(sums), ({k: v for k, v in totals.items() if k != 'fckp_products'},
+                                                   Counter(totals['fckp_products']))))
+
+    print(f"{label:<8} {len(rows)} reports, {len(cube.columns)} columns: "
+          f"{'ok' if not failures else 'FAILED: ' + ', '.join(failures[:5])}")
+    return not failures, cube.sums(by='group')
+
+def time_rollup(rows):
+    # monthly per-RTP rollup: one combine_reports per RTP vs cube group-by vs SQL aggregates
+    month = [r for r in rows if r[0] < '2026-02-01']
+    started = time.perf_counter()
+    for reports in grouped(month, lambda r: r[1]).values():
+        combine_reports(reports)
+    loops = time.perf_counter() - started
+    started = time.perf_counter()
+    cube = load_cube('2026-01-01', '2026-01-31')
+    load = time.perf_counter() - started
+    started = time.perf_counter()
+    cube.sums(by='group')
+    group_by = time.perf_counter() - started
+    started = time.perf_counter()
+    for rtp in {r[1] for r in month}:
+        database.get_rtp_period(rtp, '2026-01-01', '2026-01-31')
+    sql = time.perf_counter() - started
+    print(f"per-RTP month rollup over {len(month)} reports: combine_reports loops {loops * 1000:.2f} ms, "
+          f"cube load {load * 1000:.2f} ms + group-by {group_by * 1000:.2f} ms, get_rtp_period {sql * 1000:.2f} ms")
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    rng = random.Random(int(sys.argv[2]) if len(sys.argv) > 2 else 1)
+    rows = make_reports(n, rng)
+    database.DB_FILE = os.path.join(tempfile.mkdtemp(), 'metric_cube.db')
+    store(rows)
+    ok = True
+    results = []
+    if metric_cube._numpy() is not None:
+        passed, by_group = check(rows, 'numpy')
+        ok = ok and passed
+        results.append(by_group)
+        time_rollup(rows)
+    else:
+        print("numpy is not installed, checking the loop fallback only")
+    metric_cube.np = False
+    passed, by_group = check(rows, 'loops')
+    ok = ok and passed
+    results.append(by_group)
+    if len(results) == 2:
+        agree = all(math.isclose(results[0][g][k], v, abs_tol=1e-9) for g, row in results[1].items() for k, v in row.items())
+        print(f"numpy vs loops: {'ok' if agree else 'FAILED'}")
+        ok = ok and agree
+    database.close_all()
+    print("OK" if ok else "FAILED")
+    sys.exit(0 if ok else 1)
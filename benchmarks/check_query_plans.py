@@ -0,0 +1,159 @@
+# benchmarks/check_query_plans.py
+# Runs every public function of database.py against a scratch DB, captures the SQL
+# they execute and checks EXPLAIN QUERY PLAN for each statement.
+# Exits with code 1 if a query falls back to a full table SCAN.
+# Usage: python benchmarks/check_query_plans.py
+import inspect
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database
+
+# maintenance paths that read whole tables on purpose
+ALLOWED_SCANS = {'init_db', 'migrate', 'rebuild_aggregates', 'migrate_report_metrics'}
+SKIP_PREFIXES = ('PRAGMA', 'BEGIN', 'COMMIT', 'ROLLBACK', 'CREATE', 'ALTER')
+
+DATE = '2026-01-15'
+
+# one call per public function; names that are not listed here fail the check
+CALLS = {
+    'add_user': lambda: (database.add_user(1, 'mkk', 'Сотрудник 1', 'РТП 1'),
+                         database.add_user(2, 'rtp', 'РТП 1'),
+                         database.add_user(3, 'mkk', 'Сотрудник 3')),
+    'get_user_role': lambda: database.get_user_role(1),
+    'get_user_name': lambda: database.get_user_name(1),
+    'set_user_name': lambda: database.set_user_name(3, 'Сотрудник 3'),
+    'get_manager_fi_for_employee': lambda: database.get_manager_fi_for_employee(1),
+    'set_manager_fi_for_employee': lambda: database.set_manager_fi_for_employee(3, 'РТП 1'),
+    'get_manager_id_by_fi': lambda: database.get_manager_id_by_fi('РТП 1'),
+    'save_report': lambda: (database.save_report(1, {'meetings': '2', 'fckp_products': ['ТЭ']}),
+                            database.save_report(1, {'meetings': '3'})),
+    'get_report': lambda: database.get_report(1, DATE),
+    'get_all_reports_on_date': lambda: (database.get_all_reports_on_date(DATE),
+                                        database.get_all_reports_on_date(DATE, 'РТП 1')),
+    'get_reports_page': lambda: (database.get_reports_page(DATE, limit=5),
+                                 database.get_reports_page(DATE, 'РТП 1', after_user_id=1, limit=5),
+                                 database.get_reports_page(DATE, 'РТП 1', before_user_id=9, limit=5)),
+    'get_report_with_manager': lambda: database.get_report_with_manager(1, DATE),
+    'get_missing_reports': lambda: database.get_missing_reports(DATE),
+    'get_employees': lambda: (database.get_employees(), database.get_employees('РТП 1')),
+    'save_rtp_combined': lambda: (database.save_rtp_combined('РТП 1', {'meetings': 3.0}, DATE),
+                                  database.save_rtp_combined('РТП 1', {'meetings': 4.0}, DATE)),
+    'get_rtp_combined': lambda: database.get_rtp_combined('РТП 1', DATE),
+    'get_all_rtp_combined_on_date': lambda: database.get_all_rtp_combined_on_date(DATE),
+    'get_rtp_combined_status_for_all': lambda: database.get_rtp_combined_status_for_all(['РТП 1', 'РТП 2'], '2026-01-16'),
+    'get_rtp_aggregate': lambda: database.get_rtp_aggregate('РТП 1', DATE),
+    'get_rtp_period': lambda: database.get_rtp_period('РТП 1', '2026-01-01', '2026-01-31'),
+    'iter_report_metrics': lambda: (list(database.iter_report_metrics('2026-01-01', '2026-01-31')),
+                                    list(database.iter_report_metrics('2026-01-01', '2026-01-31', 'РТП 1')),
+                                    list(database.iter_report_metrics('2026-01-01', '2026-01-31', unit_id=1))),
+    'set_user_verified': lambda: database.set_user_verified(2, 1),
+    'is_user_verified': lambda: database.is_user_verified(2),
+    'get_user_by_name': lambda: database.get_user_by_name('РТП 1'),
+    'save_sessions': lambda: database.save_sessions([(1, '{}', 100.0), (2, '{}', 200.0)]),
+    'load_session': lambda: database.load_session(1, 50.0),
+    'touch_sessions': lambda: database.touch_sessions([1], 300.0),
+    'delete_sessions': lambda: database.delete_sessions([2]),
+    'delete_expired_sessions': lambda: database.delete_expired_sessions(150.0),
+    'enqueue_outbox': lambda: (database.enqueue_outbox(2, 'a', 100.0), database.enqueue_outbox(2, 'b', 100.0)),
+    'get_due_outbox': lambda: database.get_due_outbox(150.0, 10),
+    'next_outbox_attempt': lambda: database.next_outbox_attempt(),
+    'reschedule_outbox': lambda: database.reschedule_outbox([1], 200.0, 'err'),
+    'delete_outbox': lambda: database.delete_outbox([1]),
+    # the scratch DB is seeded with the root unit 1 and one РТП group per config.RTP_LIST entry (2, 3, ...)
+    'get_user_unit': lambda: (database.add_user(4, 'mkk', 'Сотрудник 4', None, 2), database.get_user_unit(4)),
+    'set_unit_head': lambda: database.set_unit_head(2, 2),
+    'get_unit': lambda: database.get_unit(2),
+    'get_units': lambda: (database.get_units('rtp'), database.get_units('rtp', 1),
+                          database.get_units('rtp', 1, after_id=2, limit=5), database.get_units('rm', before_id=1, limit=5)),
+    'get_child_units': lambda: (database.get_child_units(), database.get_child_units(1),
+                                database.get_child_units(1, after_id=2, limit=5), database.get_child_units(1, before_id=3, limit=5)),
+    'get_unit_path': lambda: database.get_unit_path(2),
+    'is_unit_within': lambda: database.is_unit_within(2, 1),
+    'get_unit_overview': lambda: (database.get_unit_overview(1, DATE), database.get_unit_overview(1, DATE, after_id=2, limit=5),
+                                  database.get_unit_overview(1, DATE, before_id=3, limit=5)),
+    'get_unit_rollup': lambda: database.get_unit_rollup(1, DATE),
+    'get_unit_period': lambda: database.get_unit_period(1, '2026-01-01', '2026-01-31'),
+    'get_submitted_rollup': lambda: (database.get_submitted_rollup(1, DATE),
+                                     database.get_all_rtp_combined_on_date(DATE, 1)),
+    'get_submitted_period': lambda: database.get_submitted_period(1, '2026-01-01', '2026-01-31'),
+    'add_unit': lambda: (database.add_unit('Отдел 1', 'rm', 1), database.add_unit('РТП 2', 'rtp', 1)),
+    'move_unit': lambda: database.move_unit(*_unit_ids('РТП 2', 'Отдел 1')),
+    'delete_unit': lambda: database.delete_unit(*_unit_ids('РТП 2')),
+}
+# public helpers that never touch the DB
+NOT_QUERIES = ('get_conn', 'close_all', 'get_cached_user', 'user_cache_stats', 'clear_user_cache')
+MAINTENANCE = ('init_db', 'migrate', 'rebuild_aggregates', 'migrate_report_metrics')
+
+def _unit_ids(*names):
+    ids = {name: unit_id for kind in database.ORG_KINDS for unit_id, name in database.get_units(kind)}
+    return [ids[name] for name in names]
+
+class _FixedDate:
+    @staticmethod
+    def now():
+        from datetime import datetime
+        return datetime.strptime(DATE, '%Y-%m-%d')
+
+def _caller():
+    # name of the database.py function that issued the statement
+    frame = sys._getframe(2)
+    while frame is not None:
+        if frame.f_code.co_filename == database.__file__ and not frame.f_code.co_name.startswith('_'):
+            return frame.f_code.co_name
+        frame = frame.f_back
+    return '?'
+
+def public_functions():
+    return sorted(name for name, fn in vars(database).items()
+                  if inspect.isfunction(fn) and fn.__module__ == database.__name__
+                  and not name.startswith('_') and name not in NOT_QUERIES)
+
+def main():
+    tmp = tempfile.mkdtemp()
+    database.DB_FILE = os.path.join(tmp, 'plans.db')
+    database.datetime = _FixedDate
+    database.init_db()
+    database.get_conn().set_trace_callback(lambda sql: captured.append((_caller(), sql)))
+
+    missing = [name for name in public_functions() if name not in CALLS and name not in MAINTENANCE]
+    for name, call in CALLS.items():
+        call()
+    for name in MAINTENANCE:
+        if name not in ('init_db', 'migrate'):
+            getattr(database, name)()
+    database.get_conn().set_trace_callback(None)
+
+    failures = []
+    seen = set()
+    explain = database.get_conn().cursor()
+    for func, sql in captured:
+        stmt = ' '.join(sql.split())
+        if not stmt or stmt.upper().startswith(SKIP_PREFIXES) or (func, stmt) in seen:
+            continue
+        seen.add((func, stmt))
+        plan = [row[3] for row in explain.execute('EXPLAIN QUERY PLAN ' + stmt).fetchall()]
+        scans = [p for p in plan if p.startswith('SCAN') and 'CONSTANT ROW' not in p]
+        status = 'ok'
+        if scans and func not in ALLOWED_SCANS:
+            status = 'SCAN'
+            failures.append((func, stmt, scans))
+        elif scans:
+            status = 'scan (allowed)'
+        print(f"{status:<15} {func:<32} {stmt[:90]}")
+
+    for name in missing:
+        print(f"NOT COVERED     {name}")
+    for func, stmt, scans in failures:
+        print(f"\n{func}: {stmt}\n  -> {'; '.join(scans)}")
+    database.close_all()
+    if failures or missing:
+        sys.exit(1)
+
+captured = []
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+# benchmarks/check_update_ordering.py
+# Checks for PerUserUpdateProcessor (update_processor.py):
+#  1. synthetic updates: no two updates of one user overlap, each user's updates
+#     finish in arrival order, different users do run in parallel, and the
+#     number of updates in flight never exceeds max_concurrent_updates;
+#  2. questionnaire: several MKK users fill QUESTIONS through main.message_handler
+#     with their updates interleaved and random Bot API latency; every saved
+#     report must contain exactly that user's answers.
+# The same questionnaire run without per-user ordering is printed for comparison.
+# Usage: python benchmarks/check_update_ordering.py [users] [max_concurrency]
+import asyncio
+import os
+import random
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(tempfile.mkdtemp())  # main.py opens reports.db in the working directory
+
+from telegram import Update
+from telegram.ext import SimpleUpdateProcessor
+
+import config
+import main
+import database
+from update_processor import PerUserUpdateProcessor
+
+class FakeBot:
+    # any Bot API method: random latency, returns None
+    defaults = None
+
+    def __getattr__(self, name):
+        async def call(*args, **kwargs):
+            await asyncio.sleep(random.uniform(0, 0.004))
+        return call
+
+class Ctx:
+    def __init__(self, bot):
+        self.bot = bot
+        self.application = None
+
+_update_id = 0
+
+def make_update(bot, uid, text=None, data=None):
+    global _update_id
+    _update_id += 1
+    user = {"id": uid, "is_bot": False, "first_name": f"u{uid}"}
+    chat = {"id": uid, "type": "private"}
+    msg = {"message_id": _update_id, "date": 1700000000, "chat": chat, "from": user, "text": text or ""}
+    if data is not None:
+        payload = {"update_id": _update_id,
+                   "callback_query": {"id": str(_update_id), "from": user, "chat_instance": "c",
+                                      "data": data, "message": msg}}
+    else:
+        payload = {"update_id": _update_id, "message": msg}
+    return Update.de_json(payload, bot)
+
+async def feed(processor, updates, handle):
+    # like Application with concurrent updates: one task per update, created in arrival order
+    await asyncio.gather(*(asyncio.create_task(processor.process_update(u, handle(u))) for u in updates))
+
+async def check_synthetic(users, per_user, limit):
+    bot = FakeBot()
+    processor = PerUserUpdateProcessor(limit)
+    running = {}
+    finished = {}
+    state = {'active': 0, 'peak': 0, 'overlap': 0}
+
+    async def handle(update):
+        uid = update.effective_user.id
+        state['active'] += 1
+        state['peak'] = max(state['peak'], state['active'])
+        if running.get(uid):
+            state['overlap'] += 1
+        running[uid] = True
+        await asyncio.sleep(random.uniform(0, 0.003))
+        running[uid] = False
+        finished.setdefault(uid, []).append(int(update.message.text))
+        state['active'] -= 1
+
+    updates = [make_update(bot, uid, text=str(seq)) for seq in range(per_user) for uid in range(1, users + 1)]
+    random.shuffle(updates)
+    expected = {}
+    for u in updates:
+        expected.setdefault(u.effective_user.id, []).append(int(u.message.text))
+    await feed(processor, updates, handle)
+    ordered = all(finished[uid] == expected[uid] for uid in expected)
+    ok = ordered and state['overlap'] == 0 and 1 < state['peak'] <= limit and processor.active_users == 0
+    print(f"synthetic: {len(updates)} updates, {users} users, peak concurrency {state['peak']}/{limit}, "
+          f"same-user overlaps {state['overlap']}, per-user order {'ok' if ordered else 'BROKEN'}")
+    return ok
+
+def questionnaire_updates(bot, users):
+    # per user: role, name, RTP choice, then one answer per question; users' streams are
+    # merged at random (each user's own order kept), so bursts from one user sit side by side
+    per_user = {}
+    rtp_unit = database.get_units('rtp')[0][0]
+    for uid in users:
+        seq = [make_update(bot, uid, data='role_mkk'), make_update(bot, uid, text=f"Сотрудник {uid}"),
+               make_update(bot, uid, data=f'choose_rtp_{rtp_unit}')]
+        for step, q in enumerate(config.QUESTIONS):
+            seq.append(make_update(bot, uid, text='0' if q['key'] == 'fckp_realized' else f"{uid}.{step + 1}"))
+        per_user[uid] = seq
+    updates = []
+    pending = [uid for uid in users for _ in per_user[uid]]
+    random.shuffle(pending)
+    positions = dict.fromkeys(users, 0)
+    for uid in pending:
+        updates.append(per_user[uid][positions[uid]])
+        positions[uid] += 1
+    return updates
+
+def expected_report(uid):
+    expected = {}
+    for step, q in enumerate(config.QUESTIONS):
+        expected[q['key']] = 0 if q['key'] == 'fckp_realized' else str(float(f"{uid}.{step + 1}"))
+    return expected
+
+async def run_questionnaire(processor, users):
+    bot = FakeBot()
+    ctx = Ctx(bot)
+
+    async def handle(update):
+        if update.callback_query is not None:
+            await main.button_handler(update, ctx)
+        else:
+            await main.message_handler(update, ctx)
+
+    await feed(processor, questionnaire_updates(bot, users), handle)
+    date = main.datetime.now().strftime('%Y-%m-%d')
+    broken = 0
+    for uid in users:
+        report = database.get_report(uid, date)
+        want = expected_report(uid)
+        if report is None or any(report.get(k) != v for k, v in want.items()):
+            broken += 1
+    return broken
+
+async def main_async(users, limit):
+    ok = await check_synthetic(users, 20, limit)
+    broken = await run_questionnaire(PerUserUpdateProcessor(limit), list(range(1000, 1000 + users)))
+    print(f"questionnaire, per-user ordering: {users - broken}/{users} reports correct")
+    ok = ok and broken == 0
+    unsafe = await run_questionnaire(SimpleUpdateProcessor(limit), list(range(2000, 2000 + users)))
+    print(f"questionnaire, plain concurrent_updates (reference): {users - unsafe}/{users} reports correct")
+    await main.sessions.stop()
+    return ok
+
+if __name__ == '__main__':
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    limit = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    ok = asyncio.run(main_async(users, limit))
+    main.adb.shutdown()
+    print("OK" if ok else "FAILED")
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,164 @@
+# benchmarks/fake_bot_api.py
+# Minimal local stand-in for the Telegram Bot API (HTTP/1.1 with keep-alive on
+# asyncio streams, no third-party server). Point the bot at it with
+# BOT_API_BASE_URL=http://127.0.0.1:<port>/bot.
+# Supported: getMe, getUpdates (long polling over updates queued with
+# push_update), sendMessage, editMessageText, sendDocument, answerCallbackQuery;
+# any other method answers {"ok": true, "result": true}.
+# Every call is counted and can be awaited per chat with wait_for().
+# latency (seconds) delays every answer except getUpdates, like a network round trip.
+import asyncio
+import json
+import time
+from collections import Counter, defaultdict, deque
+from urllib.parse import parse_qs, urlsplit
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "LoadBot", "username": "load_bot"}
+
+def _parse_multipart(body, boundary):
+    # text fields only; file parts are skipped
+    fields = {}
+    for part in body.split(b'--' + boundary):
+        head, _, value = part.partition(b'\r\n\r\n')
+        if b'name="' not in head or b'filename="' in head:
+            continue
+        name = head.split(b'name="', 1)[1].split(b'"', 1)[0].decode()
+        fields[name] = value.rsplit(b'\r\n', 1)[0].decode('utf-8', 'replace')
+    return fields
+
+def _parse_body(content_type, body):
+    if not body:
+        return {}
+    if content_type.startswith('application/json'):
+        return json.loads(body)
+    if content_type.startswith('multipart/form-data'):
+        boundary = content_type.split('boundary=', 1)[1].strip('"').encode()
+        return _parse_multipart(body, boundary)
+    return {k: v[0] for k, v in parse_qs(body.decode()).items()}
+
+class FakeBotAPI:
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.calls = Counter()
+        self.call_time = defaultdict(float)     # method -> total seconds spent answering
+        self.first_call = {}                    # method -> perf_counter() when it was first received
+        self._updates = []                      # pending update dicts, ascending update_id
+        self._next_update_id = 1
+        self._new_updates = asyncio.Event()
+        self._waiters = defaultdict(list)       # (chat_id, method) -> [Future]
+        self.sent_texts = defaultdict(lambda: deque(maxlen=8))  # chat_id -> last texts sent/edited
+        self._message_id = 0
+        self._file_id = 0
+        self._server = None
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}/bot"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self._new_updates.set()     # release pending long polls
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    # --- updates -----------------------------------------------------------
+    def push_update(self, payload):
+        # payload without update_id; returns the assigned update_id
+        update_id = self._next_update_id
+        self._next_update_id += 1
+        self._updates.append(dict(payload, update_id=update_id))
+        self._new_updates.set()
+        return update_id
+
+    async def _get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        timeout = float(params.get('timeout') or 0)
+        self._updates = [u for u in self._updates if u['update_id'] >= offset]
+        if not self._updates and timeout > 0:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:limit]
+
+    # --- waiting for bot output ---------------------------------------------
+    def wait_for(self, chat_id, method):
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters[(int(chat_id), method)].append(fut)
+        return fut
+
+    def _notify(self, chat_id, method, result):
+        if chat_id is None:
+            return
+        if isinstance(result, dict) and 'text' in result:
+            self.sent_texts[int(chat_id)].append(result['text'])
+        for fut in self._waiters.pop((int(chat_id), method), []):
+            if not fut.done():
+                fut.set_result(result)
+
+    def _message(self, chat_id, **extra):
+        self._message_id += 1
+        return dict({"message_id": self._message_id, "date": int(time.time()), "from": BOT_USER,
+                     "chat": {"id": int(chat_id or 0), "type": "private"}}, **extra)
+
+    async def _call(self, method, params):
+        chat_id = params.get('chat_id')
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'getUpdates':
+            return await self._get_updates(params)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method == 'sendMessage':
+            result = self._message(chat_id, text=params.get('text', ''))
+        elif method == 'editMessageText':
+            result = self._message(chat_id, text=params.get('text', '')) if chat_id else True
+        elif method == 'sendDocument':
+            self._file_id += 1
+            result = self._message(chat_id, document={"file_id": f"FILE{self._file_id}",
+                                                      "file_unique_id": f"U{self._file_id}"})
+        else:
+            result = True
+        self._notify(chat_id, method, result)
+        return result
+
+    # --- HTTP ----------------------------------------------------------------
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                _, target, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, _, value = line.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length') or 0))
+                method = urlsplit(target).path.rsplit('/', 1)[-1]
+                started = time.perf_counter()
+                self.first_call.setdefault(method, started)
+                params = _parse_body(headers.get('content-type', ''), body)
+                result = await self._call(method, params)
+                self.calls[method] += 1
+                self.call_time[method] += time.perf_counter() - started
+                payload = json.dumps({"ok": True, "result": result}).encode()
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+                             b'Content-Length: ' + str(len(payload)).encode() + b'\r\n\r\n' + payload)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
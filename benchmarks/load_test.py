@@ -0,0 +1,318 @@
+# benchmarks/load_test.py
+# End-to-end load test: the bot (main.build_application, long polling) runs in
+# this process against benchmarks/fake_bot_api.py. Simulated users:
+#  - N MKK employees: /start, role, name, RTP, the full QUESTIONS questionnaire
+#    (one FCKP product), send_report;
+#  - one RTP per РТП group of the org tree (seeded from config.RTP_LIST): logs in, then keeps opening status /
+#    combined / detailed views and submits the combined report to the RM;
+#  - RM users: log in, global combine, per-RTP and global .xlsx downloads,
+#    monthly period view.
+# Each simulated user waits for its previous update to be handled before sending
+# the next one (plus --think ms). Reported: handler latency p50/p95/p99 (overall
+# and per step), end-to-end latency (queued at the fake API -> handled),
+# updates/s, .xlsx delivery time, Bot API call counts and DB contention:
+# time jobs wait for the single writer thread / reader pool, and
+# "database is locked" errors.
+# The fake API and the simulated users share the bot's event loop, so numbers
+# include their CPU cost; compare runs against each other, not against production.
+# --metrics FILE runs the bot with metrics.py enabled and saves a /metrics scrape
+# taken at the end of the run.
+# Usage: python benchmarks/load_test.py [--users 200] [--rm 2] [--think 20] [--json out.json]
+#                                       [--metrics metrics.txt]
+import argparse
+import asyncio
+import functools
+import json
+import os
+import random
+import socket
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_bot_api import FakeBotAPI
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+def summary(values):
+    ms = [v * 1000 for v in values]
+    return {'count': len(ms), 'p50_ms': round(percentile(ms, 50), 2), 'p95_ms': round(percentile(ms, 95), 2),
+            'p99_ms': round(percentile(ms, 99), 2), 'max_ms': round(max(ms), 2) if ms else 0.0}
+
+class Stats:
+    def __init__(self):
+        self.handler = []                   # seconds inside the update processor
+        self.end_to_end = []                # queued at fake API -> handled
+        self.by_step = defaultdict(list)
+        self.exports = []                   # download tap -> sendDocument
+        self.db_wait = defaultdict(list)    # 'writer'/'reader' -> seconds queued before running
+        self.db_exec = defaultdict(list)
+        self.db_locked = 0
+        self.no_document = 0                # download taps answered without a file
+        self.errors = 0                     # acknowledged downloads that never arrived
+
+class Harness:
+    def __init__(self, api, stats, think):
+        self.api = api
+        self.stats = stats
+        self.think = think
+        self.pending = {}                   # update_id -> (future, step, queued_at)
+        self._msg_id = 0
+
+    # --- hooks -----------------------------------------------------------
+    def instrument(self, app, adb):
+        processor = app.update_processor
+        do_process = processor.do_process_update
+
+        async def timed(update, coroutine):
+            started = time.perf_counter()
+            try:
+                await do_process(update, coroutine)
+            finally:
+                done = time.perf_counter()
+                entry = self.pending.pop(update.update_id, None)
+                if entry is not None:
+                    fut, step, queued = entry
+                    self.stats.handler.append(done - started)
+                    self.stats.end_to_end.append(done - queued)
+                    self.stats.by_step[step].append(done - started)
+                    if not fut.done():
+                        fut.set_result(None)
+
+        processor.do_process_update = timed
+        run = adb._run
+        stats = self.stats
+
+        async def run_timed(executor, fn, *args, **kwargs):
+            kind = 'writer' if executor is adb._writer else 'reader'
+            queued = time.perf_counter()
+
+            @functools.wraps(fn)
+            def job():
+                started = time.perf_counter()
+                stats.db_wait[kind].append(started - queued)
+                try:
+                    return fn(*args, **kwargs)
+                except sqlite3.OperationalError as e:
+                    if 'locked' in str(e):
+                        stats.db_locked += 1
+                    raise
+                finally:
+                    stats.db_exec[kind].append(time.perf_counter() - started)
+
+            return await run(executor, job)
+
+        adb._run = run_timed
+
+    # --- sending -----------------------------------------------------------
+    async def send(self, uid, step, text=None, data=None):
+        user = {"id": uid, "is_bot": False, "first_name": f"user{uid}"}
+        chat = {"id": uid, "type": "private"}
+        if data is not None:
+            self._msg_id += 1
+            message = {"message_id": self._msg_id, "date": int(time.time()), "chat": chat,
+                       "from": {"id": 1, "is_bot": True, "first_name": "LoadBot"}, "text": "menu"}
+            payload = {"callback_query": {"id": f"{uid}-{self._msg_id}", "from": user, "chat_instance": str(uid),
+                                          "data": data, "message": message}}
+        else:
+            self._msg_id += 1
+            payload = {"message": {"message_id": self._msg_id, "date": int(time.time()), "chat": chat,
+                                   "from": user, "text": text}}
+            if text.startswith('/'):
+                payload["message"]["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+        fut = asyncio.get_running_loop().create_future()
+        update_id = self.api.push_update(payload)
+        self.pending[update_id] = (fut, step, time.perf_counter())
+        await fut
+        if self.think:
+            await asyncio.sleep(random.uniform(0, self.think * 2) / 1000)
+
+    async def download(self, uid, step, data, timeout=60):
+        # waits for the document only if the bot sent it or acknowledged the job
+        started = time.perf_counter()
+        document = self.api.wait_for(uid, 'sendDocument')
+        self.api.sent_texts[uid].clear()
+        await self.send(uid, step, data=data)
+        if not document.done() and not any(t.startswith('⏳') for t in self.api.sent_texts[uid]):
+            document.cancel()
+            self.stats.no_document += 1     # e.g. "Отчёт не найден." for an RTP without a combined report
+            return
+        try:
+            await asyncio.wait_for(document, timeout)
+            self.stats.exports.append(time.perf_counter() - started)
+        except asyncio.TimeoutError:
+            self.stats.errors += 1
+
+    # --- scenarios -----------------------------------------------------------
+    async def mkk(self, config, uid, rtp_unit):
+        await self.send(uid, 'mkk:/start', text='/start')
+        await self.send(uid, 'mkk:role', data='role_mkk')
+        await self.send(uid, 'mkk:name', text=f"Сотрудник {uid}")
+        await self.send(uid, 'mkk:choose_rtp', data=f'choose_rtp_{rtp_unit}')
+        for q in config.QUESTIONS:
+            if q['key'] == 'fckp_realized':
+                await self.send(uid, 'mkk:answer', text='1')
+                await self.send(uid, 'mkk:fckp_product', data=f"fckp_prod_{config.FCKP_OPTIONS[uid % len(config.FCKP_OPTIONS)]}")
+            else:
+                await self.send(uid, 'mkk:answer', text=str(random.randint(0, 20)))
+        await self.send(uid, 'mkk:send_report', data='send_report')
+
+    async def rtp(self, config, uid, rtp_unit, done):
+        await self.send(uid, 'rtp:/start', text='/start')
+        await self.send(uid, 'rtp:role', data='role_rtp')
+        await self.send(uid, 'rtp:password', text=config.ADMIN_PASSWORD)
+        await self.send(uid, 'rtp:choose_rtp', data=f'choose_rtp_{rtp_unit}')
+        while True:
+            finished = done.is_set()
+            for data in ('rtp_show_reports', 'rtp_combine_reports', 'rtp_detailed_reports', 'rtp_send_to_rm'):
+                await self.send(uid, f'rtp:{data}', data=data)
+            if finished:
+                break
+            await asyncio.sleep(0.2)
+
+    async def rm(self, config, uid, rm_unit, rtp_units, done):
+        await self.send(uid, 'rm:/start', text='/start')
+        await self.send(uid, 'rm:role', data='role_rm')
+        await self.send(uid, 'rm:password', text=config.ADMIN_PASSWORD)
+        await self.send(uid, 'rm:choose_rm', data=f'choose_rm_{rm_unit}')
+        while True:
+            finished = done.is_set()
+            await self.send(uid, 'rm:rm_show_rtps', data='rm_show_rtps')
+            await self.send(uid, 'rm:rm_combine_all', data='rm_combine_all')
+            await self.send(uid, 'rm:rm_period_month', data='rm_period_month')
+            await self.download(uid, 'rm:download_rtp', f'download_rtp_{random.choice(rtp_units)}')
+            await self.download(uid, 'rm:download_global', 'download_global')
+            if finished:
+                break
+            await asyncio.sleep(0.5)
+
+async def run(args):
+    api = await FakeBotAPI().start()
+    os.environ['BOT_TOKEN'] = '123456:LOADTEST'
+    os.environ['BOT_MODE'] = 'polling'
+    os.environ['BOT_API_BASE_URL'] = api.base_url
+    if args.metrics:
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            metrics_port = s.getsockname()[1]
+        os.environ['METRICS_ENABLED'] = '1'
+        os.environ['METRICS_PORT'] = str(metrics_port)
+
+    import config
+    import main
+    import async_database as adb
+    import database
+
+    stats = Stats()
+    harness = Harness(api, stats, args.think)
+    app = main.build_application()
+    harness.instrument(app, adb)
+
+    await app.initialize()
+    await app.post_init(app)
+    await app.updater.start_polling(poll_interval=0, timeout=10)
+    await app.start()
+
+    started = time.perf_counter()
+    done = asyncio.Event()
+    rtp_units = [unit_id for unit_id, _ in database.get_units('rtp')]
+    rm_units = [unit_id for unit_id, _ in database.get_units('rm')]
+    managers = [asyncio.create_task(harness.rtp(config, 900000 + i, unit_id, done)) for i, unit_id in enumerate(rtp_units)]
+    managers += [asyncio.create_task(harness.rm(config, 910000 + i, rm_units[i % len(rm_units)], rtp_units, done))
+                 for i in range(args.rm)]
+    employees = [harness.mkk(config, 100000 + i, rtp_units[i % len(rtp_units)]) for i in range(args.users)]
+    await asyncio.gather(*employees)
+    done.set()
+    await asyncio.gather(*managers)
+    elapsed = time.perf_counter() - started
+    if args.metrics:
+        with open(args.metrics, 'wb') as f:
+            f.write(await scrape(metrics_port))
+
+    await app.updater.stop()
+    await app.stop()
+    await app.shutdown()
+    await app.post_shutdown(app)
+    await api.stop()
+
+    result = {
+        'users': args.users, 'rtp': len(rtp_units), 'rm': args.rm, 'think_ms': args.think,
+        'max_concurrent_updates': config.MAX_CONCURRENT_UPDATES,
+        'elapsed_s': round(elapsed, 2),
+        'updates': len(stats.handler),
+        'updates_per_s': round(len(stats.handler) / elapsed, 1),
+        'handler': summary(stats.handler),
+        'end_to_end': summary(stats.end_to_end),
+        'xlsx_delivery': summary(stats.exports),
+        'steps': {step: summary(v) for step, v in sorted(stats.by_step.items())},
+        'db': {kind: {'queue_wait': summary(stats.db_wait[kind]), 'exec': summary(stats.db_exec[kind])}
+               for kind in ('writer', 'reader')},
+        'db_locked_errors': stats.db_locked,
+        'downloads_without_file': stats.no_document,
+        'missing_documents': stats.errors,
+        'bot_api_calls': dict(api.calls),
+    }
+    return result
+
+async def scrape(port):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(b'GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n')
+    response = await reader.read()
+    writer.close()
+    head, _, body = response.partition(b'\r\n\r\n')
+    if not head.startswith(b'HTTP/1.1 200'):
+        raise RuntimeError(f"/metrics answered {head.splitlines()[0]!r}")
+    return body
+
+def print_report(r):
+    print(f"{r['users']} MKK, {r['rtp']} RTP, {r['rm']} RM, think {r['think_ms']} ms, "
+          f"max concurrent updates {r['max_concurrent_updates']}")
+    print(f"{r['updates']} updates in {r['elapsed_s']} s -> {r['updates_per_s']} updates/s")
+    row = "{:<26} {:>7} {:>9} {:>9} {:>9} {:>9}"
+    print(row.format('', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+    def line(name, s):
+        print(row.format(name, s['count'], s['p50_ms'], s['p95_ms'], s['p99_ms'], s['max_ms']))
+    line('handler', r['handler'])
+    line('end-to-end', r['end_to_end'])
+    line('xlsx delivery', r['xlsx_delivery'])
+    for kind, d in r['db'].items():
+        line(f'db {kind} queue wait', d['queue_wait'])
+        line(f'db {kind} exec', d['exec'])
+    print("per step (handler):")
+    for step, s in r['steps'].items():
+        line('  ' + step, s)
+    print(f"database is locked errors: {r['db_locked_errors']}, downloads answered without a file: "
+          f"{r['downloads_without_file']}, acknowledged but never delivered: {r['missing_documents']}")
+    print("Bot API calls:", ", ".join(f"{k}={v}" for k, v in sorted(r['bot_api_calls'].items())))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--rm', type=int, default=2)
+    parser.add_argument('--think', type=float, default=20, help='mean think time between steps, ms')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--metrics', help='enable metrics.py and save a /metrics scrape to this file')
+    args = parser.parse_args()
+    if args.json:
+        args.json = os.path.abspath(args.json)
+    if args.metrics:
+        args.metrics = os.path.abspath(args.metrics)
+    os.chdir(tempfile.mkdtemp())  # main.py opens reports.db in the working directory
+    result = asyncio.run(run(args))
+    print_report(result)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
@@ -0,0 +1,187 @@
+# benchmarks/metric_cube.py
+# Агрегация показателей отчётов в памяти: куб дата × сотрудник × показатель
+# (продукты ФЦКП — отдельные столбцы). Суммы, средние, группировки по дате /
+# РТП / сотруднику и разница период-к-периоду считаются пакетно, одной
+# операцией над массивом на запрос.
+# Загружается из report_metrics (database.iter_report_metrics). Бот его не
+# использует: сводки читаются из SQL-агрегатов (rtp_aggregates, unit_aggregates,
+# submitted_aggregates). Это эталонный движок для check_metric_cube.py, с
+# которым сверяются агрегаты и замеряются групповые срезы.
+# Хранение — по строке на отчёт (координаты даты, группы и сотрудника + строка
+# значений), т.е. память растёт с числом отчётов, а не с датами × сотрудниками;
+# плотный куб можно получить через array().
+# numpy необязателен: без него те же операции выполняются циклами (медленнее,
+# результат тот же). Импортируется при первом построении куба, чтобы не
+# замедлять запуск бота и процессов выгрузки.
+from bisect import bisect_left, bisect_right
+
+np = None       # numpy once loaded; False — not installed (or switched off, see check_metric_cube.py)
+
+def _numpy():
+    global np
+    if np is None:
+        try:
+            import numpy
+            np = numpy
+        except ImportError:
+            np = False
+    return np or None
+
+class MetricCube:
+    # records: iterable of (date, group, employee, metrics); metrics is {metric_key: number},
+    # e.g. the rows of database.iter_report_metrics. Dates are ISO strings (their order is date order).
+    # columns: metric keys to keep, in this order; by default every key seen, first-seen order.
+    def __init__(self, records, columns=None):
+        self._np = np = _numpy()   # backend is fixed per cube
+        self.columns = list(columns or ())
+        col_index = {k: j for j, k in enumerate(self.columns)}
+        fixed = columns is not None
+        dates, groups, employees = {}, {}, {}
+        date_codes, group_codes, employee_codes = [], [], []
+        cells = []      # (row, column, value)
+        for row, (date, group, employee, metrics) in enumerate(records):
+            date_codes.append(dates.setdefault(date, len(dates)))
+            group_codes.append(groups.setdefault(group, len(groups)))
+            employee_codes.append(employees.setdefault(employee, len(employees)))
+            for k, v in metrics.items():
+                j = col_index.get(k)
+                if j is None:
+                    if fixed:
+                        continue
+                    j = col_index[k] = len(self.columns)
+                    self.columns.append(k)
+                cells.append((row, j, v))
+        # date axis in calendar order, so a date range is a contiguous code range
+        self.dates = sorted(dates)
+        order = {d: i for i, d in enumerate(self.dates)}
+        remap = [order[d] for d in dates]
+        date_codes = [remap[c] for c in date_codes]
+        self.groups = list(groups)
+        self.employees = list(employees)
+        self.size = len(date_codes)
+        width = len(self.columns)
+        if np is not None:
+            self._date = np.array(date_codes, dtype=np.intp)
+            self._group = np.array(group_codes, dtype=np.intp)
+            self._employee = np.array(employee_codes, dtype=np.intp)
+            self._values = np.zeros((self.size, width))
+            if cells:
+                rows, cols, values = zip(*cells)
+                self._values[list(rows), list(cols)] = values
+        else:
+            self._date, self._group, self._employee = date_codes, group_codes, employee_codes
+            self._values = [[0.0] * width for _ in range(self.size)]
+            for row, j, v in cells:
+                self._values[row][j] = float(v)
+
+    # --- internals -----------------------------------------------------------
+    def _axis(self, by):
+        # -> (code per row, labels)
+        if by is None:
+            return None, [None]
+        if by == 'date':
+            return self._date, self.dates
+        if by == 'group':
+            return self._group, self.groups
+        if by == 'employee':
+            return self._employee, self.employees
+        raise ValueError(f"unknown axis: {by}")
+
+    def _date_range(self, start, end):
+        lo = 0 if start is None else bisect_left(self.dates, start)
+        hi = len(self.dates) if end is None else bisect_right(self.dates, end)
+        return lo, hi
+
+    def _slot(self, lo, hi):
+        # row -> 0 if its date is in [lo, hi), else -1
+        np = self._np
+        if np is not None:
+            return np.where((self._date >= lo) & (self._date < hi), 0, -1)
+        return [0 if lo <= d < hi else -1 for d in self._date]
+
+    def _reduce(self, slot, slots, by):
+        # one pass over all rows: rows with slot s >= 0 go to bucket (group, s);
+        # -> (sums[group][s] = values per column, counts[group][s]), labels
+        np = self._np
+        codes, labels = self._axis(by)
+        n = len(labels) * slots
+        width = len(self.columns)
+        if np is not None:
+            keep = slot >= 0
+            bucket = slot[keep] if codes is None else codes[keep] * slots + slot[keep]
+            counts = np.bincount(bucket, minlength=n)
+            # every (bucket, column) pair becomes one bin: a single bincount for the whole matrix
+            flat = (bucket[:, None] * width + np.arange(width)).ravel()
+            sums = np.bincount(flat, weights=self._values[keep].ravel(), minlength=n * width)
+            return sums.reshape(len(labels), slots, width), counts.reshape(len(labels), slots), labels
+        sums = [[[0.0] * width for _ in range(slots)] for _ in labels]
+        counts = [[0] * slots for _ in labels]
+        for row, s in enumerate(slot):
+            if s < 0:
+                continue
+            g = 0 if codes is None else codes[row]
+            acc = sums[g][s]
+            for j, v in enumerate(self._values[row]):
+                acc[j] += v
+            counts[g][s] += 1
+        return sums, counts, labels
+
+    def _result(self, by, labels, values, counts):
+        # values[g] per column -> {key: value} (by=None) or {label: {key: value}} for non-empty labels
+        out = {}
+        for g, label in enumerate(labels):
+            if counts[g]:
+                out[label] = {k: float(v) for k, v in zip(self.columns, values[g])}
+        return out.get(None, {}) if by is None else out
+
+    # --- queries ---------------------------------------------------------------
+    def sums(self, by=None, start=None, end=None):
+        # by: None (grand total), 'date', 'group' or 'employee'; start/end limit the dates (inclusive)
+        sums, counts, labels = self._reduce(self._slot(*self._date_range(start, end)), 1, by)
+        return self._result(by, labels, [s[0] for s in sums], [c[0] for c in counts])
+
+    def means(self, by=None, start=None, end=None):
+        # per report: sums divided by the number of reports in the bucket
+        np = self._np
+        sums, counts, labels = self._reduce(self._slot(*self._date_range(start, end)), 1, by)
+        if np is not None:
+            means = sums[:, 0] / np.maximum(counts[:, 0], 1)[:, None]
+        else:
+            means = [[v / max(c[0], 1) for v in s[0]] for s, c in zip(sums, counts)]
+        return self._result(by, labels, means, [c[0] for c in counts])
+
+    def counts(self, by=None, start=None, end=None):
+        # number of reports: int (by=None) or {label: count}
+        _, counts, labels = self._reduce(self._slot(*self._date_range(start, end)), 1, by)
+        out = {label: int(c[0]) for label, c in zip(labels, counts) if c[0]}
+        return out.get(None, 0) if by is None else out
+
+    def delta(self, current, previous, by=None):
+        # current / previous: (start, end) date ranges; -> sums(current) - sums(previous),
+        # both periods reduced in the same pass. Buckets empty in both periods are left out.
+        np = self._np
+        cur = self._date_range(*current)
+        prev = self._date_range(*previous)
+        if np is not None:
+            slot = np.full(self.size, -1)
+            slot[(self._date >= prev[0]) & (self._date < prev[1])] = 0
+            slot[(self._date >= cur[0]) & (self._date < cur[1])] = 1
+        else:
+            slot = [1 if cur[0] <= d < cur[1] else 0 if prev[0] <= d < prev[1] else -1 for d in self._date]
+        sums, counts, labels = self._reduce(slot, 2, by)
+        if np is not None:
+            deltas = sums[:, 1] - sums[:, 0]
+            present = counts.sum(axis=1)
+        else:
+            deltas = [[c - p for c, p in zip(s[1], s[0])] for s in sums]
+            present = [c[0] + c[1] for c in counts]
+        return self._result(by, labels, deltas, present)
+
+    def array(self):
+        # dense dates × employees × columns array (numpy only); cells without a report are 0
+        np = self._np
+        if np is None:
+            raise RuntimeError("numpy is required for MetricCube.array()")
+        dense = np.zeros((len(self.dates), len(self.employees), len(self.columns)))
+        np.add.at(dense, (self._date, self._employee), self._values)
+        return dense
@@ -0,0 +1,22 @@
+# benchmarks/reference.py
+# Loop-based reference for combining reports. The bot reads combined numbers
+# from the SQL aggregates (database.rebuild_aggregates / save_report deltas);
+# this is the plain-Python rule they follow, kept for check_metric_cube.py and
+# the aggregation cases of bench_suite.py.
+
+def combine_reports(reports):
+    # reports: iterable of report dicts; numeric fields are summed, ФЦКП products concatenated
+    combined = {}
+    fckp_products = []
+    for r in reports:
+        for k, v in r.items():
+            if k == 'fckp_products' and isinstance(v, list):
+                fckp_products.extend(v)
+            else:
+                try:
+                    combined[k] = combined.get(k, 0) + float(v or 0)
+                except Exception:
+                    pass
+    combined['fckp_products'] = fckp_products
+    combined['fckp_realized'] = len(fckp_products)
+    return combined
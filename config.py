@@ -1,6 +1,8 @@
 # config.py
 
-# Список ФИ для РТП (без ID)
+# Список ФИ для РТП (без ID) — начальное наполнение оргструктуры: при первом
+# запуске из него создаются группы РТП в ORG_ROOT_NAME, дальше состав групп и
+# подразделений хранится в БД и правится через бота
 RTP_LIST = [
     "Чепик Ольга",
     "Матвеева Анастасия",
@@ -10,12 +12,6 @@ RTP_LIST = [
     "Самойлова Татьяна"
 ]
 
-# Список ФИ для РМ/МН (без ID)
-RM_MN_LIST = [
-    "Региональный менеджер",
-    "Менеджер направления"
-]
-
 # Пароль для доступа к разделам руководителей (РТП и РМ/МН)
 # Задай здесь удобный пароль (строка). Меняй при необходимости.
 ADMIN_PASSWORD = "СРБ"
@@ -90,3 +86,92 @@ def format_report(data):
     for opt in FCKP_OPTIONS:
         lines.append(f"{opt} - {format_value(prod_counts.get(opt, 0))} шт")
     return "\n".join(lines)
+
+# Пул потоков для чтения из БД (записи идут через один отдельный поток)
+DB_READ_WORKERS = 4
+
+# Параметры соединений SQLite (соединения держатся открытыми, по одному на поток)
+DB_BUSY_TIMEOUT_MS = 5000
+DB_CACHE_SIZE = -16000          # отрицательное значение — размер в КиБ (≈16 МБ)
+DB_MMAP_SIZE = 64 * 1024 * 1024
+DB_CACHED_STATEMENTS = 256
+
+# Сколько последних дат держать в памяти в индексе статусов объединённых отчётов РТП
+RTP_STATUS_INDEX_DATES = 7
+
+# Показатели в разбивке по дням для отчётов за период: (ключ, подпись)
+PERIOD_DAY_FIELDS = [
+    ("meetings", "встречи"),
+    ("fckp_realized", "ФЦКП"),
+    ("credits_issued_mln", "кредиты, млн"),
+]
+
+# Хранилище сессий пользователей (состояние анкеты)
+SESSION_MAX_SIZE = 10000             # сколько сессий держать в памяти (LRU)
+SESSION_TTL_SECONDS = 24 * 3600      # неактивные дольше этого сессии удаляются
+SESSION_FLUSH_INTERVAL = 5           # период фоновой записи изменённых сессий в БД, сек
+
+# Кэш данных пользователя (роль, ФИ, РТП, флаг проверки пароля)
+USER_CACHE_TTL_SECONDS = 300
+USER_CACHE_MAX_SIZE = 50000
+
+# Кэш сформированных .xlsx: байты файла и file_id, который вернул Telegram
+EXPORT_CACHE_MAX_BYTES = 32 * 1024 * 1024   # суммарный объём хранимых файлов
+EXPORT_CACHE_MAX_ENTRIES = 2000             # записей (в т.ч. только с file_id)
+
+# Пул процессов для тяжёлых задач (сборка .xlsx)
+JOB_WORKERS = 2                 # процессов в пуле
+JOB_QUEUE_DEPTH = 8             # сколько задач может ждать/выполняться одновременно
+JOB_START_METHOD = 'spawn'      # spawn: дочерние процессы не наследуют соединения sqlite
+
+# Детальные отчёты РТП: сколько отчётов читать из БД за один запрос при
+# заполнении страницы (границы страниц считаются по длине текста)
+DETAILED_REPORTS_FETCH = 10
+
+# Очередь исходящих сообщений (outbox)
+OUTBOX_GLOBAL_RATE = 25         # сообщений в секунду на весь бот (лимит Telegram ~30)
+OUTBOX_CHAT_INTERVAL = 1.0      # минимальный интервал между сообщениями в один чат, сек
+OUTBOX_BATCH_SIZE = 100         # сколько сообщений выбирать из очереди за один проход
+OUTBOX_POLL_INTERVAL = 5        # как часто проверять очередь без новых сообщений, сек
+OUTBOX_BACKOFF_BASE = 2         # задержка повтора: BASE * 2**попытка, сек
+OUTBOX_BACKOFF_MAX = 600
+OUTBOX_MAX_ATTEMPTS = 8         # после стольких неудач сообщение удаляется
+
+# Напоминания о несданных отчётах (JobQueue, нужен python-telegram-bot[job-queue])
+REMINDER_TIMES = ["17:00", "18:30"]     # ЧЧ:ММ, время сервера (или REMINDER_TIMEZONE)
+REMINDER_TIMEZONE = None                # например "Europe/Moscow"; None — часовой пояс сервера
+REMINDER_DAYS = (1, 2, 3, 4, 5)         # дни недели как в JobQueue.run_daily: 0 — воскресенье
+REMINDER_RTP_SUMMARY = True             # присылать РТП список не сдавших
+
+# Режим работы бота: 'polling' или 'webhook' (переменная окружения BOT_MODE
+# имеет приоритет; WEBHOOK_URL и WEBHOOK_SECRET задаются только в .env)
+BOT_MODE = 'polling'
+WEBHOOK_LISTEN = '127.0.0.1'            # адрес локального HTTP-сервера (за reverse proxy)
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = 'telegram'               # путь, на который Telegram шлёт апдейты
+WEBHOOK_MAX_CONNECTIONS = 40            # параллельных соединений от Telegram (1-100)
+DROP_PENDING_UPDATES = False            # отбросить апдейты, накопившиеся пока бот был выключен
+# HTTPX-клиент для исходящих запросов к Bot API
+BOT_CONNECTION_POOL_SIZE = 64
+BOT_POOL_TIMEOUT = 5.0
+# Bot API сервер; переопределяется BOT_API_BASE_URL в .env (локальный/тестовый сервер)
+BOT_API_BASE_URL = 'https://api.telegram.org/bot'
+
+# Параллельная обработка апдейтов: разные пользователи обрабатываются
+# одновременно (не больше MAX_CONCURRENT_UPDATES), апдейты одного пользователя —
+# строго по очереди. 1 — последовательная обработка, как раньше.
+MAX_CONCURRENT_UPDATES = 32
+
+# Метрики в формате Prometheus на локальном HTTP-порту (GET /metrics).
+# Включаются здесь или переменной окружения METRICS_ENABLED=1; выключенные
+# метрики ничего не считают.
+METRICS_ENABLED = False
+METRICS_LISTEN = '127.0.0.1'
+METRICS_PORT = 9464
+# границы корзин гистограмм задержек, сек
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Оргструктура хранится в БД (org_units, см. database.py) и правится через бота
+# (меню РМ «Оргструктура»). При первом запуске создаётся корневое подразделение
+# ORG_ROOT_NAME с группами РТП из RTP_LIST.
+ORG_ROOT_NAME = "Регион"
@@ -1,19 +1,78 @@
 # database.py
 import sqlite3
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime
 import json
 import os
 
+import config
+
 DB_FILE = 'reports.db'
 
+# -------------------------
+# Connection manager: one long-lived connection per thread
+# -------------------------
+_local = threading.local()
+_all_conns = []
+_conns_lock = threading.Lock()
+_generation = 0
+
+def _connect(path):
+    conn = sqlite3.connect(path, timeout=config.DB_BUSY_TIMEOUT_MS / 1000,
+                           cached_statements=config.DB_CACHED_STATEMENTS,
+                           check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA busy_timeout={int(config.DB_BUSY_TIMEOUT_MS)}')
+    conn.execute(f'PRAGMA cache_size={int(config.DB_CACHE_SIZE)}')
+    conn.execute(f'PRAGMA mmap_size={int(config.DB_MMAP_SIZE)}')
+    return conn
+
 def get_conn():
-    conn = sqlite3.connect(DB_FILE)
+    # connection is reused by every call made from the same thread
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.path != DB_FILE or _local.generation != _generation:
+        conn = _connect(DB_FILE)
+        with _conns_lock:
+            _all_conns.append(conn)
+            _local.generation = _generation
+        _local.conn = conn
+        _local.path = DB_FILE
+    if _schema_ready != DB_FILE:
+        _ensure_schema(conn)
     return conn
 
-def init_db():
-    # ensure DB dir exists if using path
-    conn = get_conn()
-    cursor = conn.cursor()
+def close_all():
+    # close every pooled connection (call on shutdown)
+    global _generation
+    with _conns_lock:
+        conns = list(_all_conns)
+        _all_conns.clear()
+        _generation += 1
+    for conn in conns:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+# -------------------------
+# Schema: versioned migrations, applied on the first connection to DB_FILE
+# -------------------------
+# PRAGMA user_version = number of applied MIGRATIONS; on an up-to-date DB the
+# only work is reading it. DBs created before versioning have user_version 0 and
+# go through every step: steps only add what is missing.
+
+def _columns(cursor, table):
+    cursor.execute(f"PRAGMA table_info({table})")
+    return {row[1] for row in cursor.fetchall()}
+
+def _table_exists(cursor, name):
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,))
+    return cursor.fetchone() is not None
+
+def _m1_base_tables(cursor):
     # users table with is_verified
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -44,98 +103,387 @@ def init_db():
             UNIQUE(rtp_name, report_date)
         )
     ''')
-    conn.commit()
+    # users from very old DBs have no is_verified column
+    if 'is_verified' not in _columns(cursor, 'users'):
+        cursor.execute("ALTER TABLE users ADD COLUMN is_verified INTEGER DEFAULT 0")
+
+def _m2_reports_manager_fi(cursor):
+    # reports.manager_fi: РТП, в агрегат которого засчитан отчёт
+    if 'manager_fi' not in _columns(cursor, 'reports'):
+        cursor.execute("ALTER TABLE reports ADD COLUMN manager_fi TEXT")
+        cursor.execute("UPDATE reports SET manager_fi = (SELECT u.manager_fi FROM users u WHERE u.user_id = reports.user_id)")
+
+def _m3_report_metrics(cursor):
+    # typed metric storage: one row per numeric report field, one per ФЦКП product
+    # (reports.report_data stays as the JSON copy of the whole report)
+    metrics_exist = _table_exists(cursor, 'report_metrics')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS report_metrics (
+            report_id INTEGER NOT NULL,
+            metric_key TEXT NOT NULL,
+            value REAL NOT NULL,
+            PRIMARY KEY (report_id, metric_key)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS report_products (
+            report_id INTEGER NOT NULL,
+            product TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (report_id, product)
+        ) WITHOUT ROWID
+    ''')
+    if not metrics_exist:
+        _migrate_report_metrics(cursor)
+
+def _m4_aggregates(cursor):
+    # materialized aggregates per RTP (from reports); the submitted combined reports
+    # are aggregated per РТП group since _m9_submitted_aggregates
+    aggregates_exist = _table_exists(cursor, 'rtp_aggregates')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS rtp_aggregates (
+            manager_fi TEXT NOT NULL,
+            report_date TEXT NOT NULL,
+            metric_key TEXT NOT NULL,
+            value REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (manager_fi, report_date, metric_key)
+        ) WITHOUT ROWID
+    ''')
+    if not aggregates_exist:
+        _rebuild_aggregates(cursor)
+
+def _m5_indexes(cursor):
+    # secondary indexes for the hot lookups
+    # get_employees: role + manager_fi (name included so the index covers the query)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_role_manager ON users (role, manager_fi, name)")
+    # get_user_by_name / get_manager_id_by_fi / manager chat id subquery
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_name_role ON users (name, role)")
+    # reports of one RTP's employees: users.manager_fi -> reports(user_id, report_date)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_manager ON users (manager_fi)")
+    # all reports on a date
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_reports_date ON reports (report_date, user_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_rtp_combined_date ON rtp_combined (report_date, rtp_name)")
+    # range exports of one RTP
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_reports_manager_date ON reports (manager_fi, report_date)")
+
+def _m6_sessions(cursor):
+    # persisted dialog sessions (see sessions.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sessions (
+            user_id INTEGER PRIMARY KEY,
+            payload TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sessions_updated ON sessions (updated_at)")
+
+def _m7_outbox(cursor):
+    # outgoing messages waiting for delivery (see outbox.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            next_attempt_at REAL NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (next_attempt_at, id)")
+
+def _m8_org_units(cursor):
+    # organisational tree: РМ-подразделения (any depth) -> группы РТП -> МКК (users.unit_id);
+    # org_closure holds every ancestor/descendant pair, so a rollup at any node is one join
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS org_units (
+            id INTEGER PRIMARY KEY,
+            parent_id INTEGER REFERENCES org_units (id),
+            kind TEXT NOT NULL,
+            name TEXT NOT NULL UNIQUE,
+            head_user_id INTEGER
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_org_units_parent ON org_units (parent_id, name)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_org_units_kind ON org_units (kind, name)")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS org_closure (
+            ancestor_id INTEGER NOT NULL,
+            descendant_id INTEGER NOT NULL,
+            depth INTEGER NOT NULL,
+            PRIMARY KEY (ancestor_id, descendant_id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_org_closure_descendant ON org_closure (descendant_id, depth)")
+    # per-unit aggregates of direct members' reports; reports.unit_id is the unit at save time
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS unit_aggregates (
+            unit_id INTEGER NOT NULL,
+            report_date TEXT NOT NULL,
+            metric_key TEXT NOT NULL,
+            value REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (unit_id, report_date, metric_key)
+        ) WITHOUT ROWID
+    ''')
+    if 'unit_id' not in _columns(cursor, 'users'):
+        cursor.execute("ALTER TABLE users ADD COLUMN unit_id INTEGER")
+    if 'unit_id' not in _columns(cursor, 'reports'):
+        cursor.execute("ALTER TABLE reports ADD COLUMN unit_id INTEGER")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_unit ON users (unit_id, role, name)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_reports_unit_date ON reports (unit_id, report_date)")
+
+    # initial tree from config: one root, a РТП group per RTP_LIST entry and per RTP name already in use
+    cursor.execute("SELECT 1 FROM org_units LIMIT 1")
+    if cursor.fetchone() is None:
+        root = _insert_unit(cursor, config.ORG_ROOT_NAME, 'rm', None)
+        cursor.execute("SELECT DISTINCT manager_fi FROM users WHERE manager_fi IS NOT NULL "
+                       "UNION SELECT DISTINCT name FROM users WHERE role = 'rtp' AND name IS NOT NULL")
+        names = list(config.RTP_LIST) + sorted(r[0] for r in cursor.fetchall() if r[0] not in config.RTP_LIST)
+        for name in names:
+            if name != config.ORG_ROOT_NAME:
+                _insert_unit(cursor, name, 'rtp', root)
+        cursor.execute("UPDATE users SET unit_id = ? WHERE role = 'rm'", (root,))
+    cursor.execute('''
+        UPDATE users SET unit_id = (SELECT o.id FROM org_units o WHERE o.kind = 'rtp'
+                                    AND o.name = CASE WHEN users.role = 'rtp' THEN users.name ELSE users.manager_fi END)
+        WHERE unit_id IS NULL AND role IN ('rtp', 'mkk')
+    ''')
+    cursor.execute('''
+        UPDATE org_units SET head_user_id = (SELECT MAX(u.user_id) FROM users u WHERE u.role = 'rtp' AND u.unit_id = org_units.id)
+        WHERE kind = 'rtp' AND head_user_id IS NULL
+    ''')
+    cursor.execute("UPDATE reports SET unit_id = (SELECT o.id FROM org_units o WHERE o.kind = 'rtp' AND o.name = reports.manager_fi) "
+                   "WHERE unit_id IS NULL AND manager_fi IS NOT NULL")
+    _rebuild_unit_aggregates(cursor)
+
+def _m9_submitted_aggregates(cursor):
+    # combined reports submitted by RTPs, aggregated per РТП group (org_units kind 'rtp');
+    # rollups at any node join org_closure like unit_aggregates. Replaces global_aggregates,
+    # which only held the whole-region total.
+    cursor.execute("DROP TABLE IF EXISTS global_aggregates")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS submitted_aggregates (
+            unit_id INTEGER NOT NULL,
+            report_date TEXT NOT NULL,
+            metric_key TEXT NOT NULL,
+            value REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (unit_id, report_date, metric_key)
+        ) WITHOUT ROWID
+    ''')
+    _rebuild_submitted_aggregates(cursor)
 
-    # ensure is_verified column exists (for compatibility with older DB)
-    cursor.execute("PRAGMA table_info(users)")
-    cols = [row[1] for row in cursor.fetchall()]
-    if 'is_verified' not in cols:
+# append only: a step's position is its schema version
+MIGRATIONS = [
+    _m1_base_tables,
+    _m2_reports_manager_fi,
+    _m3_report_metrics,
+    _m4_aggregates,
+    _m5_indexes,
+    _m6_sessions,
+    _m7_outbox,
+    _m8_org_units,
+    _m9_submitted_aggregates,
+]
+
+_schema_ready = None            # DB_FILE whose schema is known to be current
+_schema_lock = threading.Lock()
+
+def migrate(conn):
+    # apply pending migrations, one transaction per step; returns how many were applied
+    if conn.execute('PRAGMA user_version').fetchone()[0] >= len(MIGRATIONS):
+        return 0
+    applied = 0
+    cursor = conn.cursor()
+    for version, step in enumerate(MIGRATIONS, 1):
+        cursor.execute('BEGIN IMMEDIATE')
         try:
-            cursor.execute("ALTER TABLE users ADD COLUMN is_verified INTEGER DEFAULT 0")
+            # re-read under the write lock: another process may have migrated meanwhile
+            if cursor.execute('PRAGMA user_version').fetchone()[0] < version:
+                step(cursor)
+                cursor.execute(f'PRAGMA user_version = {version}')
+                applied += 1
             conn.commit()
-        except Exception:
-            # if alter fails for some reason, ignore (older sqlite etc.)
-            pass
+        except BaseException:
+            conn.rollback()
+            raise
+    return applied
+
+def _ensure_schema(conn):
+    global _schema_ready
+    with _schema_lock:
+        if _schema_ready != DB_FILE:
+            migrate(conn)
+            _schema_ready = DB_FILE
+
+def init_db():
+    # bring the schema up to date now instead of on the first query
+    get_conn()
+
+# -------------------------
+# Read-through cache of user rows (role, name, manager_fi, is_verified, unit_id)
+# -------------------------
+_user_cache = OrderedDict()     # user_id -> (expires_at, row or None), LRU order
+_user_cache_lock = threading.Lock()
+_user_cache_version = 0         # bumped by every users write
+_user_cache_stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+USER_MISS = object()            # get_cached_user: the row is not cached, it has to be read
+
+def _cached_row(user_id, now):
+    # under _user_cache_lock
+    entry = _user_cache.get(user_id)
+    if entry is not None and entry[0] > now:
+        _user_cache.move_to_end(user_id)
+        _user_cache_stats['hits'] += 1
+        return entry[1]
+    return USER_MISS
+
+def _get_user_row(user_id):
+    now = time.monotonic()
+    with _user_cache_lock:
+        row = _cached_row(user_id, now)
+        if row is not USER_MISS:
+            return row
+        _user_cache_stats['misses'] += 1
+        version = _user_cache_version
+    cursor = get_conn().cursor()
+    cursor.execute('SELECT role, name, manager_fi, is_verified, unit_id FROM users WHERE user_id = ?', (user_id,))
+    row = cursor.fetchone()
+    with _user_cache_lock:
+        # a write that happened while we were reading may have made this row stale
+        if version == _user_cache_version:
+            _user_cache[user_id] = (now + config.USER_CACHE_TTL_SECONDS, row)
+            _user_cache.move_to_end(user_id)
+            while len(_user_cache) > config.USER_CACHE_MAX_SIZE:
+                _user_cache.popitem(last=False)
+    return row
 
-    conn.close()
+def _invalidate_user(user_id):
+    global _user_cache_version
+    with _user_cache_lock:
+        _user_cache_version += 1
+        _user_cache.pop(user_id, None)
+        _user_cache_stats['invalidations'] += 1
 
-def add_user(user_id, role, name=None, manager_fi=None):
+def get_cached_user(user_id):
+    # the cached users row (None: no such user) without touching the DB, or USER_MISS;
+    # the user getters below turn a row into their value with .from_row
+    with _user_cache_lock:
+        return _cached_row(user_id, time.monotonic())
+
+def user_cache_stats():
+    with _user_cache_lock:
+        return dict(_user_cache_stats, size=len(_user_cache))
+
+def clear_user_cache():
+    global _user_cache_version
+    with _user_cache_lock:
+        _user_cache_version += 1
+        _user_cache.clear()
+
+def add_user(user_id, role, name=None, manager_fi=None, unit_id=None):
+    # the row is replaced: columns not given (manager_fi, unit_id, is_verified) are reset
+    cols = {'user_id': user_id, 'role': role}
+    if name:
+        cols['name'] = name
+        if manager_fi:
+            cols['manager_fi'] = manager_fi
+    if unit_id is not None:
+        cols['unit_id'] = unit_id
     conn = get_conn()
-    cursor = conn.cursor()
-    if name and manager_fi:
-        cursor.execute('INSERT OR REPLACE INTO users (user_id, role, name, manager_fi) VALUES (?, ?, ?, ?)',
-                      (user_id, role, name, manager_fi))
-    elif name:
-        cursor.execute('INSERT OR REPLACE INTO users (user_id, role, name) VALUES (?, ?, ?)',
-                      (user_id, role, name))
-    else:
-        cursor.execute('INSERT OR REPLACE INTO users (user_id, role) VALUES (?, ?)',
-                      (user_id, role))
-    conn.commit()
-    conn.close()
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute(f"INSERT OR REPLACE INTO users ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})",
+                       list(cols.values()))
+    _invalidate_user(user_id)
+
+def _role(row):
+    return row[0] if row else None
 
 def get_user_role(user_id):
-    conn = get_conn()
-    cursor = conn.cursor()
-    cursor.execute('SELECT role FROM users WHERE user_id = ?', (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    return result[0] if result else None
+    return _role(_get_user_row(user_id))
+get_user_role.from_row = _role
+
+def _name(row):
+    return row[1] if row else None
 
 def get_user_name(user_id):
-    conn = get_conn()
-    cursor = conn.cursor()
-    cursor.execute('SELECT name FROM users WHERE user_id = ?', (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    return result[0] if result else None
+    return _name(_get_user_row(user_id))
+get_user_name.from_row = _name
 
 def set_user_name(user_id, name):
     conn = get_conn()
-    cursor = conn.cursor()
-    cursor.execute('UPDATE users SET name = ? WHERE user_id = ?', (name, user_id))
-    conn.commit()
-    conn.close()
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute('UPDATE users SET name = ? WHERE user_id = ?', (name, user_id))
+    _invalidate_user(user_id)
+
+def _manager_fi(row):
+    return row[2] if row else None
 
 def get_manager_fi_for_employee(user_id):
-    conn = get_conn()
-    cursor = conn.cursor()
-    cursor.execute('SELECT manager_fi FROM users WHERE user_id = ?', (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    return result[0] if result else None
+    return _manager_fi(_get_user_row(user_id))
+get_manager_fi_for_employee.from_row = _manager_fi
+
+def _unit(row):
+    return row[4] if row else None
+
+def get_user_unit(user_id):
+    return _unit(_get_user_row(user_id))
+get_user_unit.from_row = _unit
 
 def set_manager_fi_for_employee(user_id, manager_fi):
     conn = get_conn()
-    cursor = conn.cursor()
-    cursor.execute('UPDATE users SET manager_fi = ? WHERE user_id = ?', (manager_fi, user_id))
-    conn.commit()
-    conn.close()
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute('UPDATE users SET manager_fi = ? WHERE user_id = ?', (manager_fi, user_id))
+    _invalidate_user(user_id)
 
 def get_manager_id_by_fi(manager_fi):
     conn = get_conn()
     cursor = conn.cursor()
     cursor.execute('SELECT user_id FROM users WHERE role = "rtp" AND name = ?', (manager_fi,))
     result = cursor.fetchone()
-    conn.close()
     return result[0] if result else None
 
 def save_report(user_id, report_data):
     # save or replace report for today (unique constraint ensures single report per user/date)
+    # typed metric rows and the RTP aggregate delta are written in the same transaction
     date = datetime.now().strftime('%Y-%m-%d')
     conn = get_conn()
-    cursor = conn.cursor()
-    cursor.execute('INSERT OR REPLACE INTO reports (user_id, report_date, report_data) VALUES (?, ?, ?)',
-                  (user_id, date, json.dumps(report_data, ensure_ascii=False)))
-    conn.commit()
-    conn.close()
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT id, manager_fi, unit_id FROM reports WHERE user_id = ? AND report_date = ?', (user_id, date))
+        old = cursor.fetchone()
+        old_metrics = _stored_metrics(cursor, old[0]) if old else {}
+        cursor.execute('SELECT manager_fi, unit_id FROM users WHERE user_id = ?', (user_id,))
+        row = cursor.fetchone()
+        manager_fi, unit_id = row if row else (None, None)
+        cursor.execute('''
+            INSERT INTO reports (user_id, report_date, report_data, manager_fi, unit_id) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(user_id, report_date) DO UPDATE SET report_data = excluded.report_data,
+                manager_fi = excluded.manager_fi, unit_id = excluded.unit_id
+        ''', (user_id, date, json.dumps(report_data, ensure_ascii=False), manager_fi, unit_id))
+        report_id = old[0] if old else cursor.lastrowid
+        new_metrics = _report_metrics(report_data)
+        _write_metrics(cursor, report_id, new_metrics)
+        # the old metrics are counted only under the RTP the old row was saved with (if any)
+        if old and old[1] and old[1] != manager_fi:
+            _apply_rtp_delta(cursor, old[1], date, _metrics_delta(old_metrics, {}))
+        rtp_old = old_metrics if old and old[1] == manager_fi else {}
+        if manager_fi:
+            _apply_rtp_delta(cursor, manager_fi, date, _metrics_delta(rtp_old, new_metrics))
+        # same for the org unit
+        if old and old[2] is not None and old[2] != unit_id:
+            _apply_unit_delta(cursor, old[2], date, _metrics_delta(old_metrics, {}))
+        unit_old = old_metrics if old and old[2] == unit_id else {}
+        if unit_id is not None:
+            _apply_unit_delta(cursor, unit_id, date, _metrics_delta(unit_old, new_metrics))
 
 def get_report(user_id, date):
     conn = get_conn()
     cursor = conn.cursor()
     cursor.execute('SELECT report_data FROM reports WHERE user_id = ? AND report_date = ?', (user_id, date))
     result = cursor.fetchone()
-    conn.close()
     return json.loads(result[0]) if result else None
 
 def get_all_reports_on_date(date, manager_fi=None):
@@ -151,9 +499,69 @@ def get_all_reports_on_date(date, manager_fi=None):
     else:
         cursor.execute('SELECT user_id, report_data FROM reports WHERE report_date = ?', (date,))
     results = cursor.fetchall()
-    conn.close()
     return [(uid, json.loads(data)) for uid, data in results]
 
+def get_reports_page(date, manager_fi=None, after_user_id=None, before_user_id=None, limit=20):
+    # keyset-страница отчётов за дату в порядке user_id (индекс idx_reports_date):
+    # after_user_id — следующая страница, before_user_id — предыдущая (строки идут
+    # в обратном порядке, от ближайших к границе)
+    where = ['r.report_date = ?']
+    params = [date]
+    if manager_fi:
+        where.append('u.manager_fi = ?')
+        params.append(manager_fi)
+    order = 'ASC'
+    if before_user_id is not None:
+        where.append('r.user_id < ?')
+        params.append(before_user_id)
+        order = 'DESC'
+    elif after_user_id is not None:
+        where.append('r.user_id > ?')
+        params.append(after_user_id)
+    params.append(limit)
+    conn = get_conn()
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        SELECT r.user_id, u.name, r.report_data
+        FROM reports r
+        LEFT JOIN users u ON r.user_id = u.user_id
+        WHERE {' AND '.join(where)}
+        ORDER BY r.user_id {order}
+        LIMIT ?
+    ''', params)
+    return [(uid, name, json.loads(data)) for uid, name, data in cursor.fetchall()]
+
+def get_report_with_manager(user_id, date):
+    # report + employee name + manager FI + manager chat id in one round trip
+    conn = get_conn()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT r.report_data, u.name, u.manager_fi,
+               (SELECT o.head_user_id FROM org_units o WHERE o.id = u.unit_id)
+        FROM reports r
+        LEFT JOIN users u ON r.user_id = u.user_id
+        WHERE r.user_id = ? AND r.report_date = ?
+    ''', (user_id, date))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    return {"report": json.loads(row[0]), "name": row[1], "manager_fi": row[2], "manager_id": row[3]}
+
+def get_missing_reports(date):
+    # МКК без отчёта на дату (anti-join), по всем РТП сразу:
+    # -> [(user_id, name, manager_fi, manager chat id or None)] sorted by RTP and name
+    conn = get_conn()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT u.user_id, u.name, u.manager_fi,
+               (SELECT o.head_user_id FROM org_units o WHERE o.id = u.unit_id)
+        FROM users u
+        WHERE u.role = 'mkk'
+          AND NOT EXISTS (SELECT 1 FROM reports r WHERE r.user_id = u.user_id AND r.report_date = ?)
+        ORDER BY u.manager_fi, u.name
+    ''', (date,))
+    return cursor.fetchall()
+
 def get_employees(manager_fi=None):
     conn = get_conn()
     cursor = conn.cursor()
@@ -162,65 +570,635 @@ def get_employees(manager_fi=None):
     else:
         cursor.execute("SELECT user_id, name FROM users WHERE role = 'mkk'")
     results = cursor.fetchall()
-    conn.close()
     return results
 
+# -------------------------
+# Organisational structure: org_units tree + org_closure (every ancestor/descendant pair)
+# -------------------------
+ORG_KINDS = ('rm', 'rtp')   # rm — подразделение любого уровня, rtp — группа РТП (в неё входят МКК)
+
+def _insert_unit(cursor, name, kind, parent_id):
+    cursor.execute('INSERT INTO org_units (parent_id, kind, name) VALUES (?, ?, ?)', (parent_id, kind, name))
+    unit_id = cursor.lastrowid
+    cursor.execute('''
+        INSERT INTO org_closure (ancestor_id, descendant_id, depth)
+        SELECT ancestor_id, ?, depth + 1 FROM org_closure WHERE descendant_id = ?
+        UNION ALL SELECT ?, ?, 0
+    ''', (unit_id, parent_id, unit_id, unit_id))
+    return unit_id
+
+def get_unit(unit_id):
+    cursor = get_conn().cursor()
+    cursor.execute('SELECT id, parent_id, kind, name, head_user_id FROM org_units WHERE id = ?', (unit_id,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    return {"id": row[0], "parent_id": row[1], "kind": row[2], "name": row[3], "head_user_id": row[4]}
+
+def _unit_keyset(order, after_id, before_id):
+    # keyset paging of org_units lists sorted by `order` (the columns end with the unique name);
+    # the cursor is the id of the unit at the page boundary -> (extra condition, params, ORDER BY).
+    # before_id pages come back in reverse order, nearest to the cursor first (like get_reports_page)
+    cols = ', '.join('o.' + c for c in order)
+    if after_id is not None:
+        return f"AND ({cols}) > (SELECT {', '.join(order)} FROM org_units WHERE id = ?)", [after_id], cols
+    if before_id is not None:
+        return (f"AND ({cols}) < (SELECT {', '.join(order)} FROM org_units WHERE id = ?)", [before_id],
+                ', '.join(f'o.{c} DESC' for c in order))
+    return '', [], cols
+
+def get_units(kind, root_id=None, after_id=None, before_id=None, limit=None):
+    # units of one kind, all or inside root_id's subtree (root included) -> [(id, name)] by name;
+    # after_id / before_id / limit: one page (see _unit_keyset)
+    keyset, params, order = _unit_keyset(('name',), after_id, before_id)
+    cursor = get_conn().cursor()
+    if root_id is None:
+        cursor.execute(f'SELECT o.id, o.name FROM org_units o WHERE o.kind = ? {keyset} ORDER BY {order} LIMIT ?',
+                       [kind] + params + [-1 if limit is None else limit])
+    else:
+        cursor.execute(f'''
+            SELECT o.id, o.name FROM org_closure c JOIN org_units o ON o.id = c.descendant_id
+            WHERE c.ancestor_id = ? AND o.kind = ? {keyset}
+            ORDER BY {order} LIMIT ?
+        ''', [root_id, kind] + params + [-1 if limit is None else limit])
+    return cursor.fetchall()
+
+def get_child_units(parent_id=None, after_id=None, before_id=None, limit=None):
+    # -> [(id, kind, name)]; parent_id=None — top-level units
+    keyset, params, order = _unit_keyset(('kind', 'name'), after_id, before_id)
+    cursor = get_conn().cursor()
+    cursor.execute(f'SELECT o.id, o.kind, o.name FROM org_units o WHERE o.parent_id IS ? {keyset} ORDER BY {order} LIMIT ?',
+                   [parent_id] + params + [-1 if limit is None else limit])
+    return cursor.fetchall()
+
+def get_unit_path(unit_id):
+    # root .. unit -> [(id, name)]
+    cursor = get_conn().cursor()
+    cursor.execute('''
+        SELECT o.id, o.name FROM org_closure c JOIN org_units o ON o.id = c.ancestor_id
+        WHERE c.descendant_id = ?
+        ORDER BY c.depth DESC
+    ''', (unit_id,))
+    return cursor.fetchall()
+
+def is_unit_within(unit_id, ancestor_id):
+    cursor = get_conn().cursor()
+    cursor.execute('SELECT 1 FROM org_closure WHERE ancestor_id = ? AND descendant_id = ?', (ancestor_id, unit_id))
+    return cursor.fetchone() is not None
+
+def get_unit_overview(unit_id, date, after_id=None, before_id=None, limit=None):
+    # the unit (first) and its children with МКК headcount and reports on date, whole subtree each
+    # -> [(id, kind, name, employees, reported)]; after_id / before_id / limit page the children
+    keyset, params, order = _unit_keyset(('kind', 'name'), after_id, before_id)
+    cursor = get_conn().cursor()
+    cursor.execute(f'''
+        SELECT o.id, o.kind, o.name,
+               (SELECT COUNT(*) FROM org_closure c JOIN users u ON u.unit_id = c.descendant_id AND u.role = 'mkk'
+                WHERE c.ancestor_id = o.id),
+               (SELECT COALESCE(SUM(a.value), 0) FROM org_closure c
+                JOIN unit_aggregates a ON a.unit_id = c.descendant_id AND a.report_date = ? AND a.metric_key = ?
+                WHERE c.ancestor_id = o.id)
+        FROM org_units o
+        WHERE o.id = ? OR (o.parent_id = ? {keyset})
+        ORDER BY o.id != ?, {order}
+        LIMIT ?
+    ''', [date, AGG_COUNT_KEY, unit_id, unit_id] + params + [unit_id, -1 if limit is None else limit + 1])
+    return [(i, kind, name, employees, int(reported)) for i, kind, name, employees, reported in cursor.fetchall()]
+
+def get_unit_rollup(unit_id, date):
+    # combined report of every employee in the unit's subtree, or None
+    cursor = get_conn().cursor()
+    cursor.execute('''
+        SELECT a.metric_key, SUM(a.value) FROM org_closure c
+        JOIN unit_aggregates a ON a.unit_id = c.descendant_id AND a.report_date = ?
+        WHERE c.ancestor_id = ?
+        GROUP BY a.metric_key
+    ''', (date, unit_id))
+    return _combined_from_metrics(dict(cursor.fetchall()))
+
+def get_unit_period(unit_id, start_date, end_date):
+    cursor = get_conn().cursor()
+    cursor.execute('''
+        SELECT a.report_date, a.metric_key, SUM(a.value) FROM org_closure c
+        JOIN unit_aggregates a ON a.unit_id = c.descendant_id AND a.report_date BETWEEN ? AND ?
+        WHERE c.ancestor_id = ?
+        GROUP BY a.report_date, a.metric_key
+        ORDER BY a.report_date
+    ''', (start_date, end_date, unit_id))
+    return _period_from_rows(cursor.fetchall())
+
+def _submitted_in_unit(unit_id, date):
+    # combined reports submitted by the РТП groups of a subtree -> [(rtp_name, data)]
+    cursor = get_conn().cursor()
+    cursor.execute('''
+        SELECT r.rtp_name, r.combined_data FROM org_closure c
+        JOIN org_units o ON o.id = c.descendant_id AND o.kind = 'rtp'
+        JOIN rtp_combined r ON r.rtp_name = o.name AND r.report_date = ?
+        WHERE c.ancestor_id = ?
+        ORDER BY r.rtp_name
+    ''', (date, unit_id))
+    return [(name, json.loads(data)) for name, data in cursor.fetchall()]
+
+def _submitted_rows(unit_id, start_date, end_date):
+    # submitted_aggregates summed over the subtree -> [(report_date, metric_key, value)] by date
+    cursor = get_conn().cursor()
+    cursor.execute('''
+        SELECT a.report_date, a.metric_key, SUM(a.value) FROM org_closure c
+        JOIN submitted_aggregates a ON a.unit_id = c.descendant_id AND a.report_date BETWEEN ? AND ?
+        WHERE c.ancestor_id = ?
+        GROUP BY a.report_date, a.metric_key
+        ORDER BY a.report_date
+    ''', (start_date, end_date, unit_id))
+    return cursor.fetchall()
+
+def get_submitted_rollup(unit_id, date):
+    # sum of the combined reports submitted inside the subtree on date, or None
+    cursor = get_conn().cursor()
+    cursor.execute('''
+        SELECT a.metric_key, SUM(a.value) FROM org_closure c
+        JOIN submitted_aggregates a ON a.unit_id = c.descendant_id AND a.report_date = ?
+        WHERE c.ancestor_id = ?
+        GROUP BY a.metric_key
+    ''', (date, unit_id))
+    return _combined_from_metrics(dict(cursor.fetchall()))
+
+def get_submitted_period(unit_id, start_date, end_date):
+    return _period_from_rows(_submitted_rows(unit_id, start_date, end_date))
+
+def add_unit(name, kind, parent_id):
+    # -> id of the new unit; ValueError if it can't be created there
+    if kind not in ORG_KINDS:
+        raise ValueError(f"неизвестный тип подразделения: {kind}")
+    name = (name or '').strip()
+    if not name:
+        raise ValueError("пустое название")
+    conn = get_conn()
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT kind FROM org_units WHERE id = ?', (parent_id,))
+        parent = cursor.fetchone()
+        if parent is None or parent[0] != 'rm':
+            raise ValueError("вложенные подразделения можно создавать только внутри подразделения РМ")
+        try:
+            unit_id = _insert_unit(cursor, name, kind, parent_id)
+        except sqlite3.IntegrityError:
+            raise ValueError(f"название «{name}» уже занято")
+        if kind == 'rtp':
+            # combined reports already submitted under this RTP name
+            _rebuild_submitted_aggregates(cursor, unit_id)
+        return unit_id
+
+def move_unit(unit_id, parent_id):
+    # re-hang a subtree: paths from the old ancestors are dropped, paths from the new ones added;
+    # reports stay attached to their units, so rollups above follow the move
+    conn = get_conn()
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT kind FROM org_units WHERE id = ?', (parent_id,))
+        parent = cursor.fetchone()
+        if parent is None or parent[0] != 'rm':
+            raise ValueError("переносить можно только в подразделение РМ")
+        cursor.execute('SELECT 1 FROM org_closure WHERE ancestor_id = ? AND descendant_id = ?', (unit_id, parent_id))
+        if cursor.fetchone() is not None:
+            raise ValueError("нельзя перенести подразделение внутрь самого себя")
+        cursor.execute('''
+            DELETE FROM org_closure
+            WHERE descendant_id IN (SELECT descendant_id FROM org_closure WHERE ancestor_id = :unit)
+              AND ancestor_id NOT IN (SELECT descendant_id FROM org_closure WHERE ancestor_id = :unit)
+        ''', {'unit': unit_id})
+        cursor.execute('''
+            INSERT INTO org_closure (ancestor_id, descendant_id, depth)
+            SELECT p.ancestor_id, s.descendant_id, p.depth + s.depth + 1
+            FROM org_closure p, org_closure s
+            WHERE p.descendant_id = ? AND s.ancestor_id = ?
+        ''', (parent_id, unit_id))
+        cursor.execute('UPDATE org_units SET parent_id = ? WHERE id = ?', (parent_id, unit_id))
+
+def delete_unit(unit_id):
+    # only empty units: no children, no members and no report history
+    conn = get_conn()
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT EXISTS (SELECT 1 FROM org_units WHERE parent_id = :unit),
+                   EXISTS (SELECT 1 FROM users WHERE unit_id = :unit),
+                   EXISTS (SELECT 1 FROM unit_aggregates WHERE unit_id = :unit)
+                   OR EXISTS (SELECT 1 FROM submitted_aggregates WHERE unit_id = :unit)
+        ''', {'unit': unit_id})
+        children, members, history = cursor.fetchone()
+        if children or members or history:
+            raise ValueError("в подразделении есть вложенные подразделения, сотрудники или отчёты")
+        cursor.execute('DELETE FROM org_closure WHERE descendant_id = ?', (unit_id,))
+        cursor.execute('DELETE FROM org_units WHERE id = ?', (unit_id,))
+
+def set_unit_head(unit_id, user_id):
+    # руководитель подразделения получает отчёты и напоминания его сотрудников
+    conn = get_conn()
+    with conn:
+        conn.execute('UPDATE org_units SET head_user_id = ? WHERE id = ?', (user_id, unit_id))
+
 # -------------------------
 # Combined RТП reports
 # -------------------------
+# in-process index of submitted combined reports: {date: set(rtp_name)}
+# loaded once per date, kept current by save_rtp_combined
+_rtp_status_index = {}
+_rtp_status_lock = threading.Lock()
+
 def save_rtp_combined(rtp_name, combined_data, date):
     conn = get_conn()
-    cursor = conn.cursor()
-    cursor.execute('INSERT OR REPLACE INTO rtp_combined (rtp_name, report_date, combined_data) VALUES (?, ?, ?)',
-                   (rtp_name, date, json.dumps(combined_data, ensure_ascii=False)))
-    conn.commit()
-    conn.close()
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT combined_data FROM rtp_combined WHERE rtp_name = ? AND report_date = ?', (rtp_name, date))
+        old = cursor.fetchone()
+        cursor.execute('INSERT OR REPLACE INTO rtp_combined (rtp_name, report_date, combined_data) VALUES (?, ?, ?)',
+                       (rtp_name, date, json.dumps(combined_data, ensure_ascii=False)))
+        cursor.execute("SELECT id FROM org_units WHERE kind = 'rtp' AND name = ?", (rtp_name,))
+        unit = cursor.fetchone()
+        if unit is not None:
+            old_metrics = _report_metrics(json.loads(old[0])) if old else {}
+            _apply_submitted_delta(cursor, unit[0], date, _metrics_delta(old_metrics, _report_metrics(combined_data)))
+    with _rtp_status_lock:
+        submitted = _rtp_status_index.get(date)
+        if submitted is not None:
+            submitted.add(rtp_name)
 
 def get_rtp_combined(rtp_name, date):
     conn = get_conn()
     cursor = conn.cursor()
     cursor.execute('SELECT combined_data FROM rtp_combined WHERE rtp_name = ? AND report_date = ?', (rtp_name, date))
     row = cursor.fetchone()
-    conn.close()
     return json.loads(row[0]) if row else None
 
-def get_all_rtp_combined_on_date(date):
+def get_all_rtp_combined_on_date(date, unit_id=None):
+    # unit_id: only the РТП groups inside that org unit
+    if unit_id is not None:
+        return _submitted_in_unit(unit_id, date)
     conn = get_conn()
     cursor = conn.cursor()
     cursor.execute('SELECT rtp_name, combined_data FROM rtp_combined WHERE report_date = ?', (date,))
     rows = cursor.fetchall()
-    conn.close()
     return [(r[0], json.loads(r[1])) for r in rows]
 
+def _submitted_rtps_on_date(date):
+    with _rtp_status_lock:
+        submitted = _rtp_status_index.get(date)
+        if submitted is None:
+            # one query for the whole day; held under the lock so a concurrent
+            # save_rtp_combined can't be lost between the SELECT and the insert
+            cursor = get_conn().cursor()
+            cursor.execute('SELECT rtp_name FROM rtp_combined WHERE report_date = ?', (date,))
+            submitted = {row[0] for row in cursor.fetchall()}
+            _rtp_status_index[date] = submitted
+            while len(_rtp_status_index) > config.RTP_STATUS_INDEX_DATES:
+                _rtp_status_index.pop(next(iter(_rtp_status_index)))
+        return set(submitted)
+
 def get_rtp_combined_status_for_all(rtp_list, date):
     # returns dict {rtp_name: True/False}
+    submitted = _submitted_rtps_on_date(date)
+    return {r: r in submitted for r in rtp_list}
+
+# -------------------------
+# Materialized aggregates
+# -------------------------
+# metric rows are (scope, report_date, metric_key, value); besides the numeric
+# report fields there is a report counter and one counter per ФЦКП product
+AGG_COUNT_KEY = '_reports'
+AGG_PRODUCT_PREFIX = 'fckp_products:'
+
+def _report_metrics(data):
+    # same summing rules as benchmarks/reference.combine_reports, for a single report
+    metrics = {AGG_COUNT_KEY: 1.0}
+    for k, v in data.items():
+        if k == 'fckp_products' and isinstance(v, list):
+            for p in v:
+                key = AGG_PRODUCT_PREFIX + str(p)
+                metrics[key] = metrics.get(key, 0) + 1
+        else:
+            try:
+                metrics[k] = metrics.get(k, 0) + float(v or 0)
+            except Exception:
+                pass
+    return metrics
+
+def _write_metrics(cursor, report_id, metrics):
+    # metrics in the _report_metrics form -> report_metrics / report_products rows
+    cursor.execute('DELETE FROM report_metrics WHERE report_id = ?', (report_id,))
+    cursor.execute('DELETE FROM report_products WHERE report_id = ?', (report_id,))
+    cursor.executemany('INSERT INTO report_metrics (report_id, metric_key, value) VALUES (?, ?, ?)',
+                       [(report_id, k, v) for k, v in metrics.items()
+                        if k != AGG_COUNT_KEY and not k.startswith(AGG_PRODUCT_PREFIX)])
+    cursor.executemany('INSERT INTO report_products (report_id, product, count) VALUES (?, ?, ?)',
+                       [(report_id, k[len(AGG_PRODUCT_PREFIX):], int(v)) for k, v in metrics.items()
+                        if k.startswith(AGG_PRODUCT_PREFIX)])
+
+def _stored_metrics(cursor, report_id):
+    # inverse of _write_metrics
+    metrics = {AGG_COUNT_KEY: 1.0}
+    cursor.execute('SELECT metric_key, value FROM report_metrics WHERE report_id = ?', (report_id,))
+    metrics.update(cursor.fetchall())
+    cursor.execute('SELECT product, count FROM report_products WHERE report_id = ?', (report_id,))
+    for product, count in cursor.fetchall():
+        metrics[AGG_PRODUCT_PREFIX + product] = float(count)
+    return metrics
+
+def _migrate_report_metrics(cursor):
+    cursor.execute('SELECT id, report_data FROM reports')
+    for report_id, data in cursor.fetchall():
+        try:
+            parsed = json.loads(data) if data else {}
+        except Exception:
+            parsed = {}
+        _write_metrics(cursor, report_id, _report_metrics(parsed))
+
+def migrate_report_metrics():
+    # one-shot: fill report_metrics / report_products from the JSON in reports.report_data
+    conn = get_conn()
+    with conn:
+        _migrate_report_metrics(conn.cursor())
+
+def _metrics_delta(old, new):
+    delta = dict(new)
+    for k, v in old.items():
+        delta[k] = delta.get(k, 0) - v
+    return {k: v for k, v in delta.items() if v != 0 or k not in old}
+
+def _apply_rtp_delta(cursor, manager_fi, date, delta):
+    cursor.executemany('''
+        INSERT INTO rtp_aggregates (manager_fi, report_date, metric_key, value) VALUES (?, ?, ?, ?)
+        ON CONFLICT(manager_fi, report_date, metric_key) DO UPDATE SET value = value + excluded.value
+    ''', [(manager_fi, date, k, v) for k, v in delta.items()])
+
+def _apply_unit_delta(cursor, unit_id, date, delta):
+    cursor.executemany('''
+        INSERT INTO unit_aggregates (unit_id, report_date, metric_key, value) VALUES (?, ?, ?, ?)
+        ON CONFLICT(unit_id, report_date, metric_key) DO UPDATE SET value = value + excluded.value
+    ''', [(unit_id, date, k, v) for k, v in delta.items()])
+
+def _apply_submitted_delta(cursor, unit_id, date, delta):
+    cursor.executemany('''
+        INSERT INTO submitted_aggregates (unit_id, report_date, metric_key, value) VALUES (?, ?, ?, ?)
+        ON CONFLICT(unit_id, report_date, metric_key) DO UPDATE SET value = value + excluded.value
+    ''', [(unit_id, date, k, v) for k, v in delta.items()])
+
+def _combined_from_metrics(metrics):
+    # metric rows -> dict in the shape benchmarks/reference.combine_reports returns
+    if metrics.get(AGG_COUNT_KEY, 0) <= 0:
+        return None
+    combined = {}
+    prod_counts = {}
+    for k, v in metrics.items():
+        if k == AGG_COUNT_KEY:
+            continue
+        if k.startswith(AGG_PRODUCT_PREFIX):
+            prod_counts[k[len(AGG_PRODUCT_PREFIX):]] = int(round(v))
+        else:
+            combined[k] = v
+    fckp_products = []
+    for p in config.FCKP_OPTIONS + [p for p in prod_counts if p not in config.FCKP_OPTIONS]:
+        fckp_products.extend([p] * prod_counts.get(p, 0))
+    combined['fckp_products'] = fckp_products
+    combined['fckp_realized'] = len(fckp_products)
+    return combined
+
+def get_rtp_aggregate(manager_fi, date):
+    # combined report of one RTP's employees for a date, or None if nobody reported
     conn = get_conn()
     cursor = conn.cursor()
-    result = {}
-    for r in rtp_list:
-        cursor.execute('SELECT 1 FROM rtp_combined WHERE rtp_name = ? AND report_date = ?', (r, date))
-        row = cursor.fetchone()
-        result[r] = bool(row)
-    conn.close()
-    return result
+    cursor.execute('SELECT metric_key, value FROM rtp_aggregates WHERE manager_fi = ? AND report_date = ?', (manager_fi, date))
+    return _combined_from_metrics(dict(cursor.fetchall()))
+
+def _period_from_rows(rows):
+    # rows: (report_date, metric_key, value) ordered by date -> totals + per-day breakdown
+    days = []
+    totals = {}
+    for date, key, value in rows:
+        if not days or days[-1][0] != date:
+            days.append((date, {}))
+        days[-1][1][key] = value
+        totals[key] = totals.get(key, 0) + value
+    if not days:
+        return None
+    return {
+        "totals": _combined_from_metrics(totals),
+        "report_count": int(totals.get(AGG_COUNT_KEY, 0)),
+        "days": [(date, int(m.get(AGG_COUNT_KEY, 0)), _combined_from_metrics(m)) for date, m in days
+                 if m.get(AGG_COUNT_KEY, 0) > 0],
+    }
+
+def get_rtp_period(manager_fi, start_date, end_date):
+    # range scan over the rtp_aggregates primary key (manager_fi, report_date, ...)
+    conn = get_conn()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT report_date, metric_key, value FROM rtp_aggregates
+        WHERE manager_fi = ? AND report_date BETWEEN ? AND ?
+        ORDER BY report_date
+    ''', (manager_fi, start_date, end_date))
+    return _period_from_rows(cursor.fetchall())
+
+def iter_report_metrics(start_date, end_date, manager_fi=None, batch_size=500, unit_id=None):
+    # streams (report_date, manager_fi, user_id, name, {metric_key: value}) per report,
+    # fetching from the cursor in batches; product counts use the AGG_PRODUCT_PREFIX keys;
+    # unit_id limits the reports to that org unit's subtree
+    where = 'r.report_date BETWEEN ? AND ?'
+    params = [start_date, end_date]
+    if manager_fi:
+        where = 'r.manager_fi = ? AND ' + where
+        params.insert(0, manager_fi)
+    if unit_id is not None:
+        where = 'r.unit_id IN (SELECT descendant_id FROM org_closure WHERE ancestor_id = ?) AND ' + where
+        params.insert(0, unit_id)
+    cursor = get_conn().cursor()
+    cursor.execute(f'''
+        SELECT r.id, r.report_date, r.manager_fi, r.user_id, u.name, m.metric_key, m.value
+        FROM reports r
+        JOIN report_metrics m ON m.report_id = r.id
+        LEFT JOIN users u ON u.user_id = r.user_id
+        WHERE {where}
+        UNION ALL
+        SELECT r.id, r.report_date, r.manager_fi, r.user_id, u.name, ? || p.product, p.count
+        FROM reports r
+        JOIN report_products p ON p.report_id = r.id
+        LEFT JOIN users u ON u.user_id = r.user_id
+        WHERE {where}
+        ORDER BY 2, 3, 4, 1
+    ''', params + [AGG_PRODUCT_PREFIX] + params)
+    current = None
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        for report_id, date, rtp, user_id, name, key, value in rows:
+            if current is None or current[0] != report_id:
+                if current is not None:
+                    yield current[1:]
+                current = (report_id, date, rtp, user_id, name, {})
+            current[5][key] = value
+    if current is not None:
+        yield current[1:]
+
+def rebuild_aggregates():
+    # recompute the aggregate tables from scratch (used once when they are created)
+    conn = get_conn()
+    with conn:
+        cursor = conn.cursor()
+        _rebuild_aggregates(cursor)
+        _rebuild_unit_aggregates(cursor)
+        _rebuild_submitted_aggregates(cursor)
+
+def _rebuild_unit_aggregates(cursor):
+    cursor.execute('DELETE FROM unit_aggregates')
+    cursor.execute('''
+        INSERT INTO unit_aggregates (unit_id, report_date, metric_key, value)
+        SELECT r.unit_id, r.report_date, m.metric_key, SUM(m.value)
+        FROM reports r JOIN report_metrics m ON m.report_id = r.id
+        WHERE r.unit_id IS NOT NULL
+        GROUP BY r.unit_id, r.report_date, m.metric_key
+        UNION ALL
+        SELECT r.unit_id, r.report_date, ? || p.product, SUM(p.count)
+        FROM reports r JOIN report_products p ON p.report_id = r.id
+        WHERE r.unit_id IS NOT NULL
+        GROUP BY r.unit_id, r.report_date, p.product
+        UNION ALL
+        SELECT r.unit_id, r.report_date, ?, COUNT(*)
+        FROM reports r
+        WHERE r.unit_id IS NOT NULL
+        GROUP BY r.unit_id, r.report_date
+    ''', (AGG_PRODUCT_PREFIX, AGG_COUNT_KEY))
+
+def _rebuild_aggregates(cursor):
+    cursor.execute('DELETE FROM rtp_aggregates')
+    cursor.execute('''
+        INSERT INTO rtp_aggregates (manager_fi, report_date, metric_key, value)
+        SELECT r.manager_fi, r.report_date, m.metric_key, SUM(m.value)
+        FROM reports r JOIN report_metrics m ON m.report_id = r.id
+        WHERE r.manager_fi IS NOT NULL
+        GROUP BY r.manager_fi, r.report_date, m.metric_key
+        UNION ALL
+        SELECT r.manager_fi, r.report_date, ? || p.product, SUM(p.count)
+        FROM reports r JOIN report_products p ON p.report_id = r.id
+        WHERE r.manager_fi IS NOT NULL
+        GROUP BY r.manager_fi, r.report_date, p.product
+        UNION ALL
+        SELECT r.manager_fi, r.report_date, ?, COUNT(*)
+        FROM reports r
+        WHERE r.manager_fi IS NOT NULL
+        GROUP BY r.manager_fi, r.report_date
+    ''', (AGG_PRODUCT_PREFIX, AGG_COUNT_KEY))
+
+def _rebuild_submitted_aggregates(cursor, unit_id=None):
+    # combined RTP reports are stored as submitted snapshots (JSON); unit_id: only that РТП group
+    where, params = "o.kind = 'rtp'", ()
+    if unit_id is not None:
+        where, params = where + ' AND o.id = ?', (unit_id,)
+    cursor.execute(f'DELETE FROM submitted_aggregates WHERE unit_id IN (SELECT o.id FROM org_units o WHERE {where})', params)
+    cursor.execute(f'''
+        SELECT o.id, r.report_date, r.combined_data FROM org_units o
+        JOIN rtp_combined r ON r.rtp_name = o.name
+        WHERE {where}
+    ''', params)
+    rows = []
+    for unit, date, data in cursor.fetchall():
+        rows.extend((unit, date, k, v) for k, v in _report_metrics(json.loads(data)).items())
+    cursor.executemany('INSERT INTO submitted_aggregates (unit_id, report_date, metric_key, value) VALUES (?, ?, ?, ?)', rows)
 
 # -------------------------
 # Authorization (password remembered)
 # -------------------------
 def set_user_verified(user_id, val=1):
     conn = get_conn()
-    cursor = conn.cursor()
-    cursor.execute('UPDATE users SET is_verified = ? WHERE user_id = ?', (1 if val else 0, user_id))
-    conn.commit()
-    conn.close()
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute('UPDATE users SET is_verified = ? WHERE user_id = ?', (1 if val else 0, user_id))
+    _invalidate_user(user_id)
+
+def _verified(row):
+    return bool(row[3]) if row else False
 
 def is_user_verified(user_id):
+    return _verified(_get_user_row(user_id))
+is_user_verified.from_row = _verified
+
+# -------------------------
+# Dialog sessions
+# -------------------------
+def save_sessions(rows):
+    # rows: [(user_id, payload_json, updated_at)]
+    conn = get_conn()
+    with conn:
+        cursor = conn.cursor()
+        cursor.executemany('INSERT OR REPLACE INTO sessions (user_id, payload, updated_at) VALUES (?, ?, ?)', rows)
+
+def load_session(user_id, min_updated_at=0):
     conn = get_conn()
     cursor = conn.cursor()
-    cursor.execute('SELECT is_verified FROM users WHERE user_id = ?', (user_id,))
+    cursor.execute('SELECT payload FROM sessions WHERE user_id = ? AND updated_at >= ?', (user_id, min_updated_at))
     row = cursor.fetchone()
-    conn.close()
-    return bool(row[0]) if row else False
+    return row[0] if row else None
+
+def touch_sessions(user_ids, now):
+    # продлевает TTL сохранённых сессий без перезаписи содержимого
+    conn = get_conn()
+    with conn:
+        cursor = conn.cursor()
+        cursor.executemany('UPDATE sessions SET updated_at = ? WHERE user_id = ?', [(now, u) for u in user_ids])
+
+def delete_sessions(user_ids):
+    conn = get_conn()
+    with conn:
+        cursor = conn.cursor()
+        cursor.executemany('DELETE FROM sessions WHERE user_id = ?', [(u,) for u in user_ids])
+
+def delete_expired_sessions(before):
+    conn = get_conn()
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM sessions WHERE updated_at < ?', (before,))
+
+# Outbox: persistent queue of outgoing messages
+def enqueue_outbox(chat_id, text, now=None):
+    now = time.time() if now is None else now
+    conn = get_conn()
+    with conn:
+        cursor = conn.cursor()
+        cursor.execute('INSERT INTO outbox (chat_id, text, created_at, next_attempt_at) VALUES (?, ?, ?, ?)',
+                       (chat_id, text, now, now))
+        return cursor.lastrowid
+
+def get_due_outbox(now, limit=100):
+    # -> [(id, chat_id, text, attempts)] in delivery order
+    conn = get_conn()
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT id, chat_id, text, attempts FROM outbox
+        WHERE next_attempt_at <= ?
+        ORDER BY next_attempt_at, id
+        LIMIT ?
+    ''', (now, limit))
+    return cursor.fetchall()
+
+def next_outbox_attempt():
+    # earliest next_attempt_at, or None if the outbox is empty
+    conn = get_conn()
+    cursor = conn.cursor()
+    cursor.execute('SELECT MIN(next_attempt_at) FROM outbox')
+    return cursor.fetchone()[0]
+
+def delete_outbox(ids):
+    conn = get_conn()
+    with conn:
+        cursor = conn.cursor()
+        cursor.executemany('DELETE FROM outbox WHERE id = ?', [(i,) for i in ids])
+
+def reschedule_outbox(ids, next_attempt_at, error=None, count_attempt=True):
+    conn = get_conn()
+    with conn:
+        cursor = conn.cursor()
+        cursor.executemany(
+            'UPDATE outbox SET next_attempt_at = ?, last_error = ?, attempts = attempts + ? WHERE id = ?',
+            [(next_attempt_at, error, 1 if count_attempt else 0, i) for i in ids])
 
 # helper: find user by name
 def get_user_by_name(name):
@@ -228,10 +1206,6 @@ def get_user_by_name(name):
     cursor = conn.cursor()
     cursor.execute("SELECT user_id, role, name, manager_fi FROM users WHERE name = ?", (name,))
     row = cursor.fetchone()
-    conn.close()
     if not row:
         return None
     return {"user_id": row[0], "role": row[1], "name": row[2], "manager_fi": row[3]}
-
-# initialize DB on import
-init_db()
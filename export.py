@@ -0,0 +1,90 @@
+# export.py
+# Выгрузка отчётов в .xlsx. Листы создаются в режиме write-only (openpyxl сразу
+# сбрасывает строки во временные файлы), строки приходят генераторами прямо из
+# курсора БД — расход памяти не зависит от числа выгружаемых строк.
+from io import BytesIO
+
+import config
+import database
+
+_INVALID_TITLE_CHARS = '[]:*?/\\'
+
+def _sheet_title(title, used):
+    # Excel: up to 31 chars, no []:*?/\ and unique within the workbook
+    clean = ''.join('_' if c in _INVALID_TITLE_CHARS else c for c in str(title))[:31] or 'Sheet'
+    candidate, n = clean, 1
+    while candidate in used:
+        n += 1
+        suffix = f"_{n}"
+        candidate = clean[:31 - len(suffix)] + suffix
+    used.add(candidate)
+    return candidate
+
+def new_workbook():
+    import openpyxl
+    return openpyxl.Workbook(write_only=True)
+
+def save_workbook(wb):
+    bio = BytesIO()
+    wb.save(bio)
+    bio.seek(0)
+    return bio
+
+def build_workbook(sheets):
+    # sheets: iterable of (title, header, rows); rows may be any iterable/generator of sequences
+    wb = new_workbook()
+    used = set()
+    for title, header, rows in sheets:
+        ws = wb.create_sheet(title=_sheet_title(title, used))
+        ws.append(list(header))
+        for row in rows:
+            ws.append(list(row))
+    return save_workbook(wb)
+
+def xlsx_from_dicts(title, rows, columns):
+    # rows: dicts, columns: [(key, column title)] — single-sheet export of small reports
+    header = [col_title for _, col_title in columns]
+    body = ([row.get(key, "") if isinstance(row, dict) else "" for key, _ in columns] for row in rows)
+    return build_workbook([(title, header, body)])
+
+def metric_columns():
+    # numeric report fields + one column per ФЦКП product, as stored in report_metrics
+    cols = [(q['key'], q['question']) for q in config.QUESTIONS]
+    cols += [(database.AGG_PRODUCT_PREFIX + p, f"ФЦКП {p}") for p in config.FCKP_OPTIONS]
+    return cols
+
+def _add(acc, metrics):
+    acc[database.AGG_COUNT_KEY] = acc.get(database.AGG_COUNT_KEY, 0) + 1
+    for k, v in metrics.items():
+        acc[k] = acc.get(k, 0) + v
+
+def export_period(start_date, end_date, manager_fi=None, unit_id=None):
+    # sheets: totals, per RTP, per employee (one row per report);
+    # manager_fi / unit_id narrow it to one RTP group / one org subtree, neither — whole region
+    cols = metric_columns()
+    wb = new_workbook()
+    used = set()
+    ws_totals = wb.create_sheet(_sheet_title("Итого", used))
+    ws_rtp = wb.create_sheet(_sheet_title("По РТП", used))
+    ws_emp = wb.create_sheet(_sheet_title("По сотрудникам", used))
+    ws_emp.append(["Дата", "РТП", "Сотрудник"] + [title for _, title in cols])
+
+    # only the per-RTP / total accumulators live in memory, employee rows are streamed
+    per_rtp = {}
+    totals = {}
+    for date, rtp, user_id, name, metrics in database.iter_report_metrics(start_date, end_date, manager_fi, unit_id=unit_id):
+        ws_emp.append([date, rtp or "", name or str(user_id)] + [metrics.get(k, 0) for k, _ in cols])
+        _add(per_rtp.setdefault(rtp or "", {}), metrics)
+        _add(totals, metrics)
+
+    ws_rtp.append(["РТП", "Отчётов"] + [title for _, title in cols])
+    for rtp in sorted(per_rtp):
+        acc = per_rtp[rtp]
+        ws_rtp.append([rtp, int(acc[database.AGG_COUNT_KEY])] + [acc.get(k, 0) for k, _ in cols])
+
+    ws_totals.append(["Показатель", "Значение"])
+    ws_totals.append(["Период", f"{start_date} — {end_date}"])
+    ws_totals.append(["Отчётов", int(totals.get(database.AGG_COUNT_KEY, 0))])
+    for key, title in cols:
+        ws_totals.append([title, totals.get(key, 0)])
+    return save_workbook(wb)
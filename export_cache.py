@@ -0,0 +1,101 @@
+# export_cache.py
+# Кэш готовых выгрузок. Ключ — (вид отчёта, область, дата, версия данных), где
+# версия — хэш исходных данных, поэтому изменённый отчёт сам получает новый ключ.
+# Храним байты файла (с ограничением по суммарному размеру) и file_id документа:
+# повторная выдача того же файла — просто send_document(file_id), без сборки и
+# без повторной загрузки в Telegram.
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+import config
+
+class _Entry:
+    __slots__ = ('data', 'filename', 'file_id')
+
+    def __init__(self, data, filename, file_id=None):
+        self.data = data
+        self.filename = filename
+        self.file_id = file_id
+
+def fingerprint(obj):
+    raw = json.dumps(obj, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()[:16]
+
+class ExportCache:
+    def __init__(self, max_bytes=None, max_entries=None):
+        self.max_bytes = config.EXPORT_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.max_entries = config.EXPORT_CACHE_MAX_ENTRIES if max_entries is None else max_entries
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {'file_id_hits': 0, 'bytes_hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats['file_id_hits' if entry.file_id else 'bytes_hits'] += 1
+            return entry
+
+    def put(self, key, data, filename):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None and old.data is not None:
+                self._bytes -= len(old.data)
+            entry = _Entry(data if len(data) <= self.max_bytes else None, filename)
+            if entry.data is not None:
+                self._bytes += len(entry.data)
+            self._entries[key] = entry
+            self._evict()
+            return entry
+
+    def set_file_id(self, key, file_id):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.file_id = file_id
+
+    def forget_file_id(self, key):
+        # Telegram больше не принимает file_id — при следующей выдаче загрузим байты заново
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.file_id = None
+
+    def _evict(self):
+        # Сначала освобождаем байты самых старых записей: если у записи уже есть
+        # file_id, сама запись остаётся (она почти ничего не весит).
+        if self._bytes > self.max_bytes:
+            for key in list(self._entries):
+                if self._bytes <= self.max_bytes:
+                    break
+                entry = self._entries[key]
+                if entry.data is None:
+                    continue
+                self._bytes -= len(entry.data)
+                entry.data = None
+                if entry.file_id is None:
+                    del self._entries[key]
+                self.stats['evictions'] += 1
+        while len(self._entries) > self.max_entries:
+            _, entry = self._entries.popitem(last=False)
+            if entry.data is not None:
+                self._bytes -= len(entry.data)
+            self.stats['evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size_bytes(self):
+        return self._bytes
@@ -0,0 +1,81 @@
+# jobs.py
+# CPU-тяжёлые задачи (сборка .xlsx) выполняются в пуле процессов, чтобы не
+# блокировать цикл событий бота. Очередь ограничена JOB_QUEUE_DEPTH; у каждого
+# пользователя не больше одной задачи — новая задача или переход в другое меню
+# отменяет предыдущую (результат уже запущенной задачи просто отбрасывается).
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import config
+import database
+import export
+
+class JobQueueFull(Exception):
+    pass
+
+_pool = None
+_pending = 0                    # jobs handed to the pool and not finished there yet
+_pending_lock = threading.Lock()
+_user_jobs = {}
+
+def _init_worker(db_file):
+    database.DB_FILE = db_file
+
+# --- функции, выполняемые в дочернем процессе (возвращают bytes) ---
+def xlsx_from_dicts(title, rows, columns):
+    return export.xlsx_from_dicts(title, rows, columns).getvalue()
+
+def export_period(start_date, end_date, manager_fi=None, unit_id=None):
+    return export.export_period(start_date, end_date, manager_fi, unit_id).getvalue()
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        ctx = multiprocessing.get_context(config.JOB_START_METHOD)
+        _pool = ProcessPoolExecutor(max_workers=config.JOB_WORKERS, mp_context=ctx,
+                                    initializer=_init_worker, initargs=(os.path.abspath(database.DB_FILE),))
+    return _pool
+
+def _done(pool_fut):
+    # called when the pool future finishes (in the pool's thread): a cancelled
+    # asyncio future doesn't stop a task that is already running in a worker
+    global _pending
+    with _pending_lock:
+        _pending -= 1
+
+def submit(uid, fn, *args):
+    # возвращает asyncio.Future; при отмене await выбрасывает CancelledError
+    global _pending
+    cancel(uid)
+    if _pending >= config.JOB_QUEUE_DEPTH:
+        raise JobQueueFull()
+    pool_fut = _get_pool().submit(fn, *args)
+    with _pending_lock:
+        _pending += 1
+    pool_fut.add_done_callback(_done)
+    fut = asyncio.wrap_future(pool_fut)
+    _user_jobs[uid] = fut
+    fut.add_done_callback(lambda f: _user_jobs.pop(uid, None) if _user_jobs.get(uid) is f else None)
+    return fut
+
+def cancel(uid):
+    fut = _user_jobs.pop(uid, None)
+    if fut is not None and not fut.done():
+        fut.cancel()
+        return True
+    return False
+
+def pending():
+    return _pending
+
+def shutdown(wait=True):
+    global _pool
+    for fut in list(_user_jobs.values()):
+        fut.cancel()
+    _user_jobs.clear()
+    if _pool is not None:
+        _pool.shutdown(wait=wait, cancel_futures=True)
+        _pool = None
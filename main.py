@@ -1,14 +1,21 @@
 # main.py
 import os
+import re
 import asyncio
-from io import BytesIO
-from datetime import datetime
+from datetime import datetime, timedelta, time as dtime
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand, InputFile
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
 
 import config
-import database
+from export_cache import ExportCache, fingerprint
+import jobs
+import async_database as adb
+from sessions import Session, SessionStore
+from router import CallbackRouter
+from outbox import Outbox
+from update_processor import PerUserUpdateProcessor
+import metrics
 import json
 
 # load .env
@@ -22,15 +29,26 @@ else:
 TOKEN = os.getenv('BOT_TOKEN')
 if not TOKEN:
     print("ERROR: BOT_TOKEN not found in env (BOT_TOKEN)")
+BOT_MODE = os.getenv('BOT_MODE', config.BOT_MODE)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')          # публичный https-адрес, без WEBHOOK_PATH
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')    # проверяется в заголовке X-Telegram-Bot-Api-Secret-Token
+BOT_API_BASE_URL = os.getenv('BOT_API_BASE_URL', config.BOT_API_BASE_URL)
+if os.getenv('METRICS_ENABLED'):
+    metrics.ENABLED = os.getenv('METRICS_ENABLED').lower() in ('1', 'true', 'yes')
+METRICS_PORT = int(os.getenv('METRICS_PORT', config.METRICS_PORT))
 
-user_states = {}
+sessions = SessionStore()
+export_cache = ExportCache()
+outbox = Outbox()
 
-def safe_state(uid):
-    st = user_states.get(uid)
-    if not st:
-        st = {'mode': 'idle', 'step': 0, 'data': {}, 'editing': False}
-        user_states[uid] = st
-    return st
+# gauges are read only when /metrics is scraped
+metrics.Gauge('bot_sessions', 'Dialog sessions held in memory', lambda: len(sessions))
+metrics.Gauge('bot_export_cache_bytes', 'Bytes held by the export cache', lambda: export_cache.size_bytes)
+metrics.Gauge('bot_export_cache_events', 'Export cache hits/misses/evictions since start',
+              lambda: export_cache.stats, label='event')
+metrics.Gauge('bot_user_cache', 'User row cache size and hits/misses since start',
+              lambda: adb.user_cache_stats(), label='stat')
+metrics.Gauge('bot_export_jobs_pending', 'Export jobs queued or running', lambda: jobs.pending())
 
 def build_main_menu():
     kb = [
@@ -41,25 +59,136 @@ def build_main_menu():
     ]
     return InlineKeyboardMarkup(kb)
 
-# --- Helpers for xlsx generation (used by RM) ---
-def generate_xlsx_for_report(title: str, rows: list, columns: list):
-    try:
-        import openpyxl
-    except Exception:
-        raise
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    ws.title = title[:31]
-    for c_idx, (_, col_title) in enumerate(columns, start=1):
-        ws.cell(row=1, column=c_idx, value=col_title)
-    for r_idx, row in enumerate(rows, start=2):
-        for c_idx, (col_key, _) in enumerate(columns, start=1):
-            value = row.get(col_key, "") if isinstance(row, dict) else ""
-            ws.cell(row=r_idx, column=c_idx, value=value)
-    bio = BytesIO()
-    wb.save(bio)
-    bio.seek(0)
-    return bio
+# --- Org structure: units are picked by id from the org_units tree ---
+ORG_PAGE_SIZE = 50      # units per keyboard page; Telegram caps an inline keyboard at 100 buttons
+NO_UNIT_TEXT = "Подразделение не выбрано. Войдите заново через «Отчеты РМ/МН»."
+
+def parse_org_page(arg):
+    # "<scope>:<n|p><unit_id>" from the *_page_ callbacks (scope may be empty) -> (scope, after_id, before_id)
+    scope, cursor = arg.split(':')
+    if cursor[:1] not in ('n', 'p'):
+        raise ValueError(arg)
+    unit_id = int(cursor[1:])
+    return (int(scope) if scope else None), (unit_id if cursor[0] == 'n' else None), (unit_id if cursor[0] == 'p' else None)
+
+def org_page(rows, after_id=None, before_id=None):
+    # unit rows fetched with limit=ORG_PAGE_SIZE + 1 (keyset by unit id, see database._unit_keyset)
+    # -> (page, has_prev, has_next), the same way render_detailed_page pages reports
+    more = len(rows) > ORG_PAGE_SIZE
+    rows = rows[:ORG_PAGE_SIZE]
+    if before_id is not None:
+        return rows[::-1], more, True
+    return rows, after_id is not None, more
+
+def org_page_nav(prefix, scope, page, has_prev, has_next):
+    # keyboard rows with ⬅️ / ➡️ for a paged unit list; [] if it fits on one page
+    key = '' if scope is None else scope
+    nav = []
+    if has_prev and page:
+        nav.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"{prefix}{key}:p{page[0][0]}"))
+    if has_next and page:
+        nav.append(InlineKeyboardButton("Далее ➡️", callback_data=f"{prefix}{key}:n{page[-1][0]}"))
+    return [nav] if nav else []
+
+async def rtp_picker_kb(parent_id=None, after_id=None, before_id=None):
+    # one tree level: РТП groups are choose_rtp_{id}, subdivisions open with rtp_pick_{id};
+    # a single top-level division (the usual case) is opened right away
+    children = await adb.get_child_units(parent_id, after_id, before_id, ORG_PAGE_SIZE + 1)
+    if parent_id is None and after_id is None and before_id is None and len(children) == 1 and children[0][1] == 'rm':
+        parent_id = children[0][0]
+        children = await adb.get_child_units(parent_id, limit=ORG_PAGE_SIZE + 1)
+    page, has_prev, has_next = org_page(children, after_id, before_id)
+    kb = []
+    for unit_id, kind, name in page:
+        if kind == 'rtp':
+            kb.append([InlineKeyboardButton(name, callback_data=f"choose_rtp_{unit_id}")])
+        else:
+            kb.append([InlineKeyboardButton(f"📂 {name}", callback_data=f"rtp_pick_{unit_id}")])
+    kb += org_page_nav('rtp_page_', parent_id, page, has_prev, has_next)
+    if parent_id is not None:
+        unit = await adb.get_unit(parent_id)
+        if unit and unit['parent_id'] is not None:
+            kb.append([InlineKeyboardButton("⬆️ Наверх", callback_data=f"rtp_pick_{unit['parent_id']}")])
+    kb.append([InlineKeyboardButton("Вернуться в меню", callback_data='return_to_menu')])
+    return InlineKeyboardMarkup(kb)
+
+# --- Period rollups (RTP / RM) ---
+TELEGRAM_TEXT_LIMIT = 4096
+PERIOD_KINDS = ('week', 'month', 'quarter')
+
+def period_bounds(kind, today=None):
+    # calendar period up to today: current week / month / quarter
+    today = today or datetime.now().date()
+    if kind == 'week':
+        start = today - timedelta(days=today.weekday())
+    elif kind == 'month':
+        start = today.replace(day=1)
+    else:
+        start = today.replace(month=(today.month - 1) // 3 * 3 + 1, day=1)
+    return start.strftime('%Y-%m-%d'), today.strftime('%Y-%m-%d')
+
+def parse_period(text):
+    # "01.10.2025-15.10.2025" (или одна дата); ГГГГ-ММ-ДД тоже принимается
+    found = re.findall(r'\d{1,2}\.\d{1,2}\.\d{4}|\d{4}-\d{2}-\d{2}', text)
+    if len(found) not in (1, 2):
+        return None
+    dates = []
+    for f in found:
+        try:
+            fmt = '%d.%m.%Y' if '.' in f else '%Y-%m-%d'
+            dates.append(datetime.strptime(f, fmt).strftime('%Y-%m-%d'))
+        except ValueError:
+            return None
+    return min(dates), max(dates)
+
+def render_period(title, period, count_label):
+    lines = [title, "", config.format_report(period['totals']), "",
+             f"Всего {count_label}: {period['report_count']}", "", "По дням:"]
+    text = "\n".join(lines)
+    days = period['days']
+    for i, (date, count, combined) in enumerate(days):
+        fields = ", ".join(f"{label} {config.format_value(combined.get(key, 0))}" for key, label in config.PERIOD_DAY_FIELDS)
+        line = f"\n{date}: {count_label} {count}, {fields}"
+        tail = f"\n… ещё {len(days) - i} дн."
+        if len(text) + len(line) + len(tail) > TELEGRAM_TEXT_LIMIT:
+            text += tail
+            break
+        text += line
+    return text
+
+async def build_period_text(uid, scope, start_date, end_date):
+    if scope == 'rtp':
+        manager_fi = await adb.get_user_name(uid)
+        period = await adb.get_rtp_period(manager_fi, start_date, end_date)
+        title = f"Отчёт РТП {manager_fi} за {start_date} — {end_date}:"
+        count_label = "отчётов"
+    else:
+        unit_id = await adb.get_user_unit(uid)
+        if unit_id is None:
+            return NO_UNIT_TEXT
+        period = await adb.get_submitted_period(unit_id, start_date, end_date)
+        title = f"Глобальный отчёт за {start_date} — {end_date}:"
+        count_label = "отчётов РТП"
+    if not period:
+        return f"Нет отчётов за период {start_date} — {end_date}."
+    return render_period(title, period, count_label)
+
+def period_back_kb(scope, start_date, end_date):
+    back = 'rtp_menu' if scope == 'rtp' else 'rm_show_rtps'
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("📥 Скачать .xlsx за период", callback_data=f"period_xlsx_{scope}:{start_date}:{end_date}")],
+        [InlineKeyboardButton("Другой период", callback_data=f"{scope}_period_menu")],
+        [InlineKeyboardButton("Назад", callback_data=back)]
+    ])
+
+def parse_period_key(arg):
+    # "rtp:2025-10-01:2025-10-31" -> ('rtp', start, end); raises ValueError
+    scope, start_date, end_date = arg.split(':')
+    if scope not in ('rtp', 'rm'):
+        raise ValueError(scope)
+    for d in (start_date, end_date):
+        datetime.strptime(d, '%Y-%m-%d')
+    return scope, start_date, end_date
 
 # --- Handlers ---
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -72,439 +201,728 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     await query.answer()
     uid = query.from_user.id
-    data = query.data or ""
-    st = user_states.get(uid, {})
-
-    # return to main
-    if data == 'return_to_menu':
-        user_states.pop(uid, None)
-        await query.edit_message_text("Выберите роль:", reply_markup=build_main_menu())
-        return
-
-    # role selection (common)
-    if data.startswith('role_'):
-        role = data.split('_',1)[1]
-        # For RTP and RM: require password if user not verified
-        if role in ('rtp', 'rm'):
-            if database.is_user_verified(uid):
-                user_states[uid] = {'mode': role, 'step': 0, 'data': {}, 'editing': False}
-                await handle_role_selection(query, uid, role)
-                return
-            else:
-                user_states[uid] = {'mode': 'awaiting_password_for', 'await_role': role}
-                try:
-                    await query.edit_message_text("Введите пароль для доступа в раздел руководителя:")
-                except Exception:
-                    await query.message.reply_text("Введите пароль для доступа в раздел руководителя:")
-                return
-        else:
-            # mkk flow
-            user_states[uid] = {'mode': role, 'step': 0, 'data': {}, 'editing': False}
+    # переход в любое другое меню отменяет незавершённую выгрузку пользователя
+    jobs.cancel(uid)
+    st = await sessions.get(uid) or Session()
+    await router.dispatch(query, query.data or "", context, uid, st)
+
+# --- Callback routes: handler(query, context, uid, st, *args) ---
+router = CallbackRouter()
+
+# return to main
+@router.exact('return_to_menu')
+async def on_return_to_menu(query, context, uid, st):
+    sessions.pop(uid)
+    await query.edit_message_text("Выберите роль:", reply_markup=build_main_menu())
+
+# role selection (common): role_mkk / role_rtp / role_rm
+@router.prefix('role_')
+async def on_role(query, context, uid, st, role):
+    # For RTP and RM: require password if user not verified
+    if role in ('rtp', 'rm'):
+        if await adb.is_user_verified(uid):
+            sessions.set(uid, Session.for_role(role))
             await handle_role_selection(query, uid, role)
+        else:
+            sessions.set(uid, Session(mode='awaiting_password_for', await_role=role))
+            try:
+                await query.edit_message_text("Введите пароль для доступа в раздел руководителя:")
+            except Exception:
+                await query.message.reply_text("Введите пароль для доступа в раздел руководителя:")
+    else:
+        # mkk flow
+        sessions.set(uid, Session.for_role(role))
+        await handle_role_selection(query, uid, role)
+
+@router.exact('change_info')
+async def on_change_info(query, context, uid, st):
+    sessions.set(uid, Session(mode='change_fi_enter_name'))
+    try:
+        await query.edit_message_text("Введите ваше ФИ (как хотите, чтобы оно сохранялось):")
+    except Exception:
+        await query.message.reply_text("Введите ваше ФИ (как хотите, чтобы оно сохранялось):")
+
+# rtp_pick_{unit_id}: open a subdivision in the РТП picker
+@router.prefix('rtp_pick_', int, error="Ошибка выбора. Попробуйте снова.")
+async def on_rtp_pick(query, context, uid, st, unit_id):
+    await query.edit_message_reply_markup(reply_markup=await rtp_picker_kb(unit_id))
+
+@router.prefix('rtp_page_', parse_org_page, error="Ошибка выбора. Попробуйте снова.")
+async def on_rtp_page(query, context, uid, st, key):
+    await query.edit_message_reply_markup(reply_markup=await rtp_picker_kb(*key))
+
+# choose_rtp_{unit_id}: РТП group picked in rtp_picker_kb
+@router.prefix('choose_rtp_', int, error="Ошибка выбора. Попробуйте снова.")
+async def on_choose_rtp(query, context, uid, st, unit_id):
+    unit = await adb.get_unit(unit_id)
+    if not unit or unit['kind'] != 'rtp':
+        await query.edit_message_text("Некорректный выбор РТП.")
+        return
+    selected = unit['name']
+    # if in change_flow (user entered new name earlier)
+    if st.change_flow:
+        new_name = st.new_name
+        if not new_name:
+            await query.edit_message_text("Ошибка: имя не найдено в состоянии.")
             return
+        await adb.add_user(uid, 'mkk', new_name, selected, unit_id)
+        sessions.pop(uid)
+        await query.edit_message_text(f"Готово. Ваше имя '{new_name}' привязано к РТП: {selected}.")
+        return
 
-    # change_info
-    if data == 'change_info':
-        user_states[uid] = {'mode': 'change_fi_enter_name'}
-        try:
-            await query.edit_message_text("Введите ваше ФИ (как хотите, чтобы оно сохранялось):")
-        except Exception:
-            await query.message.reply_text("Введите ваше ФИ (как хотите, чтобы оно сохранялось):")
+    role = st.mode
+    if role == 'rtp':
+        # user choosing their own FI as RTP: becomes the head of the group
+        await adb.add_user(uid, 'rtp', selected, unit_id=unit_id)
+        await adb.set_unit_head(unit_id, uid)
+        # when RTP chooses own FI, ensure verified flag set (they passed password earlier)
+        await adb.set_user_verified(uid, 1)
+        sessions.set(uid, Session.for_role('rtp'))
+        await query.edit_message_text(f"Вы вошли как РТП: {selected}")
+        await show_manager_menu(query)
         return
 
-    # choose_rtp_{idx}
-    if data.startswith('choose_rtp_'):
-        try:
-            idx = int(data.split('_')[2])
-        except Exception:
-            await query.edit_message_text("Ошибка выбора. Попробуйте снова.")
-            return
-        if idx < 0 or idx >= len(config.RTP_LIST):
-            await query.edit_message_text("Некорректный индекс РТП.")
-            return
-        selected = config.RTP_LIST[idx]
-        # if in change_flow (user entered new name earlier)
-        if st.get('change_flow'):
-            new_name = st.get('new_name')
-            if not new_name:
-                await query.edit_message_text("Ошибка: имя не найдено в состоянии.")
-                return
-            database.add_user(uid, 'mkk', new_name, selected)
-            user_states.pop(uid, None)
-            await query.edit_message_text(f"Готово. Ваше имя '{new_name}' привязано к РТП: {selected}.")
-            return
+    # registration flow for MKK
+    name = st.name
+    if name:
+        await adb.add_user(uid, 'mkk', name, selected, unit_id)
+        sessions.set(uid, Session.for_role('mkk'))
+        await query.edit_message_text(f"Привязка к {selected} успешна. Начинаем отчёт.")
+        await ask_next_question(query.message, uid)
+        return
 
-        role = st.get('mode', 'idle')
-        if role == 'rtp':
-            # user choosing their own FI as RTP
-            database.add_user(uid, 'rtp', selected)
-            # when RTP chooses own FI, ensure verified flag set (they passed password earlier)
-            database.set_user_verified(uid, 1)
-            user_states[uid] = {'mode': 'rtp', 'step': 0, 'data': {}, 'editing': False}
-            await query.edit_message_text(f"Вы вошли как РТП: {selected}")
-            await show_manager_menu(query)
-            return
+    await query.edit_message_text("Непонятный контекст выбора РТП.")
 
-        # registration flow for MKK
-        name = st.get('name')
-        if name:
-            database.add_user(uid, 'mkk', name, selected)
-            st.pop('choosing_rtp', None); st.pop('name', None)
-            st.update({'step': 0, 'data': {}, 'editing': False, 'mode': 'mkk'})
-            await query.edit_message_text(f"Привязка к {selected} успешна. Начинаем отчёт.")
-            await ask_next_question(query.message, uid)
-            return
+# choose_rm_{unit_id} - RM selects the org unit they manage
+@router.prefix('choose_rm_', int, error="Ошибка выбора РМ/МН.")
+async def on_choose_rm(query, context, uid, st, unit_id):
+    unit = await adb.get_unit(unit_id)
+    if not unit or unit['kind'] != 'rm':
+        await query.edit_message_text("Некорректный выбор подразделения.")
+        return
+    chosen = unit['name']
+    # register user as rm of the unit and mark verified
+    await adb.add_user(uid, 'rm', chosen, unit_id=unit_id)
+    await adb.set_user_verified(uid, 1)
+    sessions.set(uid, Session.for_role('rm'))
+    kb = [
+        [InlineKeyboardButton("Список РТП", callback_data='rm_show_rtps')],
+        [InlineKeyboardButton("Оргструктура", callback_data=f"org_node_{unit_id}")],
+        [InlineKeyboardButton("Отчёт за период", callback_data='rm_period_menu')],
+        [InlineKeyboardButton("Вернуться в меню", callback_data='return_to_menu')]
+    ]
+    await query.edit_message_text(f"Вы вошли как РМ/МН: {chosen}", reply_markup=InlineKeyboardMarkup(kb))
+
+# RM menu interactions
+async def rm_unit(query, uid):
+    # org unit of the RM; None (after telling the user) if they have not picked one
+    unit_id = await adb.get_user_unit(uid)
+    if unit_id is None:
+        await query.edit_message_text(NO_UNIT_TEXT, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Вернуться в меню", callback_data='return_to_menu')]]))
+    return unit_id
 
-        await query.edit_message_text("Непонятный контекст выбора РТП.")
+async def rm_rtp_unit(query, uid, unit_id):
+    # РТП group inside the RM's subtree, or None after an error reply
+    scope = await rm_unit(query, uid)
+    if scope is None:
+        return None
+    unit = await adb.get_unit(unit_id)
+    if not unit or unit['kind'] != 'rtp' or not await adb.is_unit_within(unit_id, scope):
+        await query.edit_message_text("Некорректный выбор РТП.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Назад", callback_data='rm_show_rtps')]]))
+        return None
+    return unit
+
+async def show_rm_rtps(query, uid, after_id=None, before_id=None):
+    scope = await rm_unit(query, uid)
+    if scope is None:
         return
+    date = datetime.now().strftime('%Y-%m-%d')
+    rtps = await adb.get_units('rtp', scope, after_id, before_id, ORG_PAGE_SIZE + 1)
+    page, has_prev, has_next = org_page(rtps, after_id, before_id)
+    sent_status = await adb.get_rtp_combined_status_for_all([fi for _, fi in page], date)
+    kb = []
+    for unit_id, fi in page:
+        status = "✅" if sent_status.get(fi, False) else "❌"
+        kb.append([InlineKeyboardButton(f"{fi} {status}", callback_data=f"rm_choose_rtp_{unit_id}")])
+    kb += org_page_nav('rm_rtps_page_', None, page, has_prev, has_next)
+    kb.append([InlineKeyboardButton("Объединить все РТП (глобально) и скачать", callback_data='rm_combine_all')])
+    kb.append([InlineKeyboardButton("Оргструктура", callback_data=f"org_node_{scope}")])
+    kb.append([InlineKeyboardButton("Отчёт за период", callback_data='rm_period_menu')])
+    kb.append([InlineKeyboardButton("Вернуться в меню", callback_data='return_to_menu')])
+    await query.edit_message_text("Список РТП (статус отправки объединённого отчёта):", reply_markup=InlineKeyboardMarkup(kb))
 
-    # choose_rm_{idx} - RM selects their FI from list
-    if data.startswith('choose_rm_'):
-        try:
-            idx = int(data.split('_')[2])
-        except Exception:
-            await query.edit_message_text("Ошибка выбора РМ/МН.")
-            return
-        if idx < 0 or idx >= len(config.RM_MN_LIST):
-            await query.edit_message_text("Некорректный индекс.")
-            return
-        chosen = config.RM_MN_LIST[idx]
-        # register user as rm and mark verified
-        database.add_user(uid, 'rm', chosen)
-        database.set_user_verified(uid, 1)
-        user_states[uid] = {'mode': 'rm', 'step': 0, 'data': {}, 'editing': False}
-        kb = [
-            [InlineKeyboardButton("Список РТП", callback_data='rm_show_rtps')],
-            [InlineKeyboardButton("Вернуться в меню", callback_data='return_to_menu')]
-        ]
-        await query.edit_message_text(f"Вы вошли как РМ/МН: {chosen}", reply_markup=InlineKeyboardMarkup(kb))
-        return
-
-    # role_rm -> show RM menu (entry)
-    if data == 'role_rm':
-        if database.is_user_verified(uid):
-            await handle_role_selection(query, uid, 'rm')
-            return
-        else:
-            user_states[uid] = {'mode': 'awaiting_password_for', 'await_role': 'rm'}
-            try:
-                await query.edit_message_text("Введите пароль для доступа в раздел руководителя:")
-            except Exception:
-                await query.message.reply_text("Введите пароль для доступа в раздел руководителя:")
-            return
+@router.exact('rm_show_rtps')
+async def on_rm_show_rtps(query, context, uid, st):
+    await show_rm_rtps(query, uid)
 
-    # RM menu interactions
-    if data == 'rm_show_rtps':
-        date = datetime.now().strftime('%Y-%m-%d')
-        sent_status = database.get_rtp_combined_status_for_all(config.RTP_LIST, date)
-        kb = []
-        for i, fi in enumerate(config.RTP_LIST):
-            status = "✅" if sent_status.get(fi, False) else "❌"
-            kb.append([InlineKeyboardButton(f"{fi} {status}", callback_data=f"rm_choose_rtp_{i}")])
-        kb.append([InlineKeyboardButton("Объединить все РТП (глобально) и скачать", callback_data='rm_combine_all')])
-        kb.append([InlineKeyboardButton("Вернуться в меню", callback_data='return_to_menu')])
-        await query.edit_message_text("Список РТП (статус отправки объединённого отчёта):", reply_markup=InlineKeyboardMarkup(kb))
-        return
-
-    if data.startswith('rm_choose_rtp_'):
-        # format: rm_choose_rtp_{i}
-        try:
-            idx = int(data.split('_')[3])
-        except Exception:
-            await query.edit_message_text("Ошибка выбора.")
-            return
-        if idx < 0 or idx >= len(config.RTP_LIST):
-            await query.edit_message_text("Некорректный индекс.")
-            return
-        chosen = config.RTP_LIST[idx]
-        date = datetime.now().strftime('%Y-%m-%d')
-        combined = database.get_rtp_combined(chosen, date)
-        if not combined:
-            await query.edit_message_text(f"РТП {chosen} не отправлял объединённый отчёт на {date}.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Назад", callback_data='rm_show_rtps')]]))
-            return
-        text = f"Объединённый отчёт РТП {chosen} на {date}:\n\n{config.format_report(combined)}"
-        kb = [
-            [InlineKeyboardButton("📥 Скачать .xlsx", callback_data=f"download_rtp_{idx}")],
-            [InlineKeyboardButton("Назад", callback_data='rm_show_rtps')]
-        ]
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb))
-        return
-
-    if data == 'rm_combine_all':
-        date = datetime.now().strftime('%Y-%m-%d')
-        all_combined = database.get_all_rtp_combined_on_date(date)
-        if not all_combined:
-            await query.edit_message_text(f"Нет объединённых отчётов от РТП на {date}.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Назад", callback_data='rm_show_rtps')]]))
-            return
-        aggregated = {}
-        fckp_products = []
-        for rtp_fi, rdata in all_combined:
-            for k, v in rdata.items():
-                if k == 'fckp_products' and isinstance(v, list):
-                    fckp_products.extend(v)
-                else:
-                    try:
-                        aggregated[k] = aggregated.get(k, 0) + float(v or 0)
-                    except Exception:
-                        pass
-        aggregated['fckp_products'] = fckp_products
-        aggregated['fckp_realized'] = len(fckp_products)
-        text = f"Глобальный объединённый отчёт за {date}:\n\n{config.format_report(aggregated)}"
-        kb = [
-            [InlineKeyboardButton("📥 Скачать глобальный .xlsx", callback_data="download_global")],
-            [InlineKeyboardButton("Назад", callback_data='rm_show_rtps')]
-        ]
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb))
+# rm_rtps_page_:{n|p}{unit_id}: next / previous page of the RM's RTP list
+@router.prefix('rm_rtps_page_', parse_org_page, error="Ошибка навигации.")
+async def on_rm_rtps_page(query, context, uid, st, key):
+    _, after_id, before_id = key
+    await show_rm_rtps(query, uid, after_id, before_id)
+
+# rm_choose_rtp_{unit_id}
+@router.prefix('rm_choose_rtp_', int, error="Ошибка выбора.")
+async def on_rm_choose_rtp(query, context, uid, st, unit_id):
+    unit = await rm_rtp_unit(query, uid, unit_id)
+    if unit is None:
+        return
+    chosen = unit['name']
+    date = datetime.now().strftime('%Y-%m-%d')
+    combined = await adb.get_rtp_combined(chosen, date)
+    if not combined:
+        await query.edit_message_text(f"РТП {chosen} не отправлял объединённый отчёт на {date}.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Назад", callback_data='rm_show_rtps')]]))
         return
+    text = f"Объединённый отчёт РТП {chosen} на {date}:\n\n{config.format_report(combined)}"
+    kb = [
+        [InlineKeyboardButton("📥 Скачать .xlsx", callback_data=f"download_rtp_{unit_id}")],
+        [InlineKeyboardButton("Назад", callback_data='rm_show_rtps')]
+    ]
+    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb))
 
-    if data.startswith('download_rtp_'):
-        try:
-            idx = int(data.split('_')[2])
-        except Exception:
-            await query.edit_message_text("Ошибка скачивания.")
-            return
-        if idx < 0 or idx >= len(config.RTP_LIST):
-            await query.edit_message_text("Некорректный индекс.")
-            return
-        rtp_fi = config.RTP_LIST[idx]
-        date = datetime.now().strftime('%Y-%m-%d')
-        rdata = database.get_rtp_combined(rtp_fi, date)
-        if not rdata:
-            await query.edit_message_text("Отчёт не найден.")
-            return
-        rows = []
-        for q in config.QUESTIONS:
-            rows.append({'key': q['question'], 'value': rdata.get(q['key'], 0)})
-        prod_counts = {}
-        for p in rdata.get('fckp_products', []):
-            prod_counts[p] = prod_counts.get(p, 0) + 1
-        for prod in config.FCKP_OPTIONS:
-            rows.append({'key': prod, 'value': prod_counts.get(prod, 0)})
-        cols = [('key', 'Поле'), ('value', 'Значение')]
+@router.exact('rm_combine_all')
+async def on_rm_combine_all(query, context, uid, st):
+    scope = await rm_unit(query, uid)
+    if scope is None:
+        return
+    date = datetime.now().strftime('%Y-%m-%d')
+    aggregated = await adb.get_submitted_rollup(scope, date)
+    if not aggregated:
+        await query.edit_message_text(f"Нет объединённых отчётов от РТП на {date}.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Назад", callback_data='rm_show_rtps')]]))
+        return
+    text = f"Глобальный объединённый отчёт за {date}:\n\n{config.format_report(aggregated)}"
+    kb = [
+        [InlineKeyboardButton("📥 Скачать глобальный .xlsx", callback_data="download_global")],
+        [InlineKeyboardButton("Назад", callback_data='rm_show_rtps')]
+    ]
+    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb))
+
+async def _send_export(context, chat_id, key, filename, data):
+    msg = await context.bot.send_document(chat_id=chat_id, document=InputFile(data, filename=filename))
+    doc = getattr(msg, 'document', None)
+    if key is not None and doc is not None:
+        export_cache.set_file_id(key, doc.file_id)
+    return msg
+
+async def send_from_cache(context, chat_id, key):
+    # Повторная выдача того же файла: сначала file_id (без загрузки), затем
+    # сохранённые байты. False — файла в кэше нет, его нужно собрать
+    entry = export_cache.get(key)
+    if entry is None:
+        return False
+    if entry.file_id:
         try:
-            bio = generate_xlsx_for_report(f"{rtp_fi}_{date}", rows, cols)
-            filename = f"rtp_{rtp_fi.replace(' ','_')}_{date}.xlsx"
-            await context.bot.send_document(chat_id=uid, document=InputFile(bio, filename=filename))
+            await context.bot.send_document(chat_id=chat_id, document=entry.file_id)
+            return True
         except Exception as e:
-            await query.edit_message_text(f"Ошибка формирования файла: {e}")
-        return
-
-    if data == 'download_global':
-        date = datetime.now().strftime('%Y-%m-%d')
-        all_combined = database.get_all_rtp_combined_on_date(date)
-        rows = []
-        for rtp_fi, rdata in all_combined:
-            row = {'rtp': rtp_fi}
-            for q in config.QUESTIONS:
-                row[q['key']] = rdata.get(q['key'], 0)
-            row['fckp_count'] = len(rdata.get('fckp_products', []))
-            rows.append(row)
-        cols = [('rtp', 'RTP')]
+            print(f"file_id {entry.file_id} не принят, загружаем файл заново: {e}")
+            export_cache.forget_file_id(key)
+    if entry.data is not None:
+        await _send_export(context, chat_id, key, entry.filename, entry.data)
+        return True
+    return False
+
+async def _finish_ack(ack, text=None):
+    if ack is None:
+        return
+    try:
+        if text is None:
+            await ack.delete()
+        else:
+            await ack.edit_text(text)
+    except Exception as e:
+        print("ack update error:", e)
+
+async def _deliver_export(context, uid, ack, job, key, filename):
+    try:
+        data = await job
+    except asyncio.CancelledError:
+        await _finish_ack(ack, "Формирование файла отменено.")
+        return
+    except Exception as e:
+        await _finish_ack(ack, f"Ошибка формирования файла: {e}")
+        return
+    if key is not None:
+        export_cache.put(key, data, filename)
+    try:
+        await _send_export(context, uid, key, filename, data)
+    except Exception as e:
+        await _finish_ack(ack, f"Ошибка отправки файла: {e}")
+        return
+    await _finish_ack(ack)
+
+async def send_export(context, uid, filename, fn, *args, key=None):
+    # Файл из кэша уходит сразу. Иначе — сообщение «готовлю…», сборка в пуле
+    # процессов (jobs) и отправка из фоновой задачи: обработчик возвращается
+    # сразу и не задерживает апдейты других пользователей.
+    if key is not None and await send_from_cache(context, uid, key):
+        return
+    try:
+        job = jobs.submit(uid, fn, *args)
+    except jobs.JobQueueFull:
+        await context.bot.send_message(chat_id=uid, text="Сейчас формируется много файлов, попробуйте через минуту.")
+        return
+    ack = await context.bot.send_message(chat_id=uid, text="⏳ Готовлю файл…")
+    context.application.create_task(_deliver_export(context, uid, ack, job, key, filename))
+
+@router.prefix('download_rtp_', int, error="Ошибка скачивания.")
+async def on_download_rtp(query, context, uid, st, unit_id):
+    unit = await rm_rtp_unit(query, uid, unit_id)
+    if unit is None:
+        return
+    rtp_fi = unit['name']
+    date = datetime.now().strftime('%Y-%m-%d')
+    rdata = await adb.get_rtp_combined(rtp_fi, date)
+    if not rdata:
+        await query.edit_message_text("Отчёт не найден.")
+        return
+    key = ('rtp', rtp_fi, date, fingerprint(rdata))
+    filename = f"rtp_{rtp_fi.replace(' ','_')}_{date}.xlsx"
+
+    rows = []
+    for q in config.QUESTIONS:
+        rows.append({'key': q['question'], 'value': rdata.get(q['key'], 0)})
+    prod_counts = {}
+    for p in rdata.get('fckp_products', []):
+        prod_counts[p] = prod_counts.get(p, 0) + 1
+    for prod in config.FCKP_OPTIONS:
+        rows.append({'key': prod, 'value': prod_counts.get(prod, 0)})
+    cols = [('key', 'Поле'), ('value', 'Значение')]
+    try:
+        await send_export(context, uid, filename, jobs.xlsx_from_dicts, f"{rtp_fi}_{date}", rows, cols, key=key)
+    except Exception as e:
+        await query.edit_message_text(f"Ошибка формирования файла: {e}")
+
+@router.exact('download_global')
+async def on_download_global(query, context, uid, st):
+    scope = await rm_unit(query, uid)
+    if scope is None:
+        return
+    date = datetime.now().strftime('%Y-%m-%d')
+    all_combined = await adb.get_all_rtp_combined_on_date(date, scope)
+    key = ('global', scope, date, fingerprint(all_combined))
+    filename = f"global_combined_{date}.xlsx"
+
+    rows = []
+    for rtp_fi, rdata in all_combined:
+        row = {'rtp': rtp_fi}
         for q in config.QUESTIONS:
-            cols.append((q['key'], q['question']))
-        cols.append(('fckp_count', 'FCKP count'))
-        try:
-            bio = generate_xlsx_for_report(f"global_{date}", rows, cols)
-            filename = f"global_combined_{date}.xlsx"
-            await context.bot.send_document(chat_id=uid, document=InputFile(bio, filename=filename))
-        except Exception as e:
-            await query.edit_message_text(f"Ошибка формирования файла: {e}")
+            row[q['key']] = rdata.get(q['key'], 0)
+        row['fckp_count'] = len(rdata.get('fckp_products', []))
+        rows.append(row)
+    cols = [('rtp', 'RTP')]
+    for q in config.QUESTIONS:
+        cols.append((q['key'], q['question']))
+    cols.append(('fckp_count', 'FCKP count'))
+    try:
+        await send_export(context, uid, filename, jobs.xlsx_from_dicts, f"global_{date}", rows, cols, key=key)
+    except Exception as e:
+        await query.edit_message_text(f"Ошибка формирования файла: {e}")
+
+# org structure (RM): browse the subtree, rollups at any node, edit the tree
+async def org_scope(query, uid, unit_id):
+    # True if unit_id is inside the verified RM's own unit; otherwise replies and returns False
+    if await adb.get_user_role(uid) == 'rm' and await adb.is_user_verified(uid):
+        scope = await adb.get_user_unit(uid)
+        if scope is not None and await adb.is_unit_within(unit_id, scope):
+            return True
+    await query.edit_message_text("Нет доступа к этому подразделению.", reply_markup=build_main_menu())
+    return False
+
+def org_back_kb(unit_id):
+    return InlineKeyboardMarkup([[InlineKeyboardButton("Назад", callback_data=f"org_node_{unit_id}")]])
+
+async def show_org_node(query, uid, unit_id, after_id=None, before_id=None):
+    if not await org_scope(query, uid, unit_id):
         return
+    unit = await adb.get_unit(unit_id)
+    date = datetime.now().strftime('%Y-%m-%d')
+    overview = await adb.get_unit_overview(unit_id, date, after_id, before_id, ORG_PAGE_SIZE + 1)
+    path = " / ".join(name for _, name in await adb.get_unit_path(unit_id))
+    _, _, _, employees, reported = overview[0]
+    lines = [path, f"Сотрудников: {employees}, отчётов за {date}: {reported}"]
+    rollup = await adb.get_unit_rollup(unit_id, date)
+    if rollup:
+        lines += ["", config.format_report(rollup)]
+    text = "\n".join(lines)
+    if len(text) > TELEGRAM_TEXT_LIMIT:
+        text = text[:TELEGRAM_TEXT_LIMIT - 1] + "…"
+    page, has_prev, has_next = org_page(overview[1:], after_id, before_id)
+    kb = []
+    for child_id, kind, name, child_employees, child_reported in page:
+        icon = "📂" if kind == 'rm' else "👥"
+        kb.append([InlineKeyboardButton(f"{icon} {name} ({child_reported}/{child_employees})", callback_data=f"org_node_{child_id}")])
+    kb += org_page_nav('org_page_', unit_id, page, has_prev, has_next)
+    kb.append([InlineKeyboardButton("Сводка за месяц", callback_data=f"org_month_{unit_id}")])
+    if unit['kind'] == 'rm':
+        kb.append([InlineKeyboardButton("➕ Подразделение", callback_data=f"org_add_rm_{unit_id}"),
+                   InlineKeyboardButton("➕ Группа РТП", callback_data=f"org_add_rtp_{unit_id}")])
+    if unit_id != await adb.get_user_unit(uid):
+        kb.append([InlineKeyboardButton("Перенести", callback_data=f"org_move_{unit_id}"),
+                   InlineKeyboardButton("Удалить", callback_data=f"org_del_{unit_id}")])
+        kb.append([InlineKeyboardButton("⬆️ Наверх", callback_data=f"org_node_{unit['parent_id']}")])
+    kb.append([InlineKeyboardButton("Список РТП", callback_data='rm_show_rtps')])
+    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb))
 
-    # role_rtp menu (entry)
-    if data == 'role_rtp':
-        if database.is_user_verified(uid):
-            kb = [[InlineKeyboardButton(fi, callback_data=f"choose_rtp_{i}")] for i, fi in enumerate(config.RTP_LIST)]
-            kb.append([InlineKeyboardButton("Вернуться в меню", callback_data='return_to_menu')])
-            await query.edit_message_text("Выберите ваше ФИ (РТП):", reply_markup=InlineKeyboardMarkup(kb))
-            return
-        else:
-            user_states[uid] = {'mode': 'awaiting_password_for', 'await_role': 'rtp'}
-            try:
-                await query.edit_message_text("Введите пароль для доступа в раздел РТП:")
-            except Exception:
-                await query.message.reply_text("Введите пароль для доступа в раздел РТП:")
-            return
+@router.prefix('org_node_', int, error="Ошибка оргструктуры.")
+async def on_org_node(query, context, uid, st, unit_id):
+    await show_org_node(query, uid, unit_id)
 
-    # RTP manager actions
-    if data == 'rtp_menu':
-        await show_manager_menu(query)
+# org_page_{unit_id}:{n|p}{child_id}: next / previous page of the unit's children
+@router.prefix('org_page_', parse_org_page, error="Ошибка оргструктуры.")
+async def on_org_page(query, context, uid, st, key):
+    await show_org_node(query, uid, *key)
+
+@router.prefix('org_month_', int, error="Ошибка оргструктуры.")
+async def on_org_month(query, context, uid, st, unit_id):
+    if not await org_scope(query, uid, unit_id):
         return
+    unit = await adb.get_unit(unit_id)
+    start_date, end_date = period_bounds('month')
+    period = await adb.get_unit_period(unit_id, start_date, end_date)
+    if period:
+        text = render_period(f"{unit['name']} за {start_date} — {end_date}:", period, "отчётов")
+    else:
+        text = f"Нет отчётов за период {start_date} — {end_date}."
+    await query.edit_message_text(text, reply_markup=org_back_kb(unit_id))
 
-    if data == 'rtp_show_reports':
-        date = datetime.now().strftime('%Y-%m-%d')
-        manager_fi = database.get_user_name(uid)
-        employees = database.get_employees(manager_fi)
-        reports = database.get_all_reports_on_date(date, manager_fi)
-        reported_ids = [u for u,_ in reports]
-        text = f"Отчеты на {date}:\n"
-        for u_id, name in employees:
-            status = '✅' if u_id in reported_ids else '❌'
-            text += f"Сотрудник {name or str(u_id)}: {status}\n"
-        kb = [[InlineKeyboardButton("Детальный отчет на дату", callback_data='rtp_detailed_reports')], [InlineKeyboardButton("Назад", callback_data='rtp_menu')]]
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb))
-        return
-
-    if data == 'rtp_detailed_reports':
-        date = datetime.now().strftime('%Y-%m-%d')
-        manager_fi = database.get_user_name(uid)
-        reports = database.get_all_reports_on_date(date, manager_fi)
-        text = f"Детальные отчеты на {date}:\n\n"
-        for u_id, rdata in reports:
-            name = database.get_user_name(u_id) or str(u_id)
-            text += f"Сотрудник {name}:\n{config.format_report(rdata)}\n\n"
-        kb = [[InlineKeyboardButton("Вернуться в меню", callback_data='rtp_menu')]]
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb))
-        return
-
-    if data == 'rtp_combine_reports':
-        date = datetime.now().strftime('%Y-%m-%d')
-        manager_fi = database.get_user_name(uid)
-        reports = database.get_all_reports_on_date(date, manager_fi)
-        if not reports:
-            await query.edit_message_text("Нет отчетов на сегодня.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Назад", callback_data='rtp_menu')]]))
-            return
-        combined = {}
-        fckp_products = []
-        for _, r in reports:
-            for k, v in r.items():
-                if k == 'fckp_products' and isinstance(v, list):
-                    fckp_products.extend(v)
-                else:
-                    try:
-                        combined[k] = combined.get(k, 0) + float(v or 0)
-                    except Exception:
-                        pass
-        combined['fckp_products'] = fckp_products
-        combined['fckp_realized'] = len(fckp_products)
-        text = f"Объединённый отчёт на {date}:\n\n{config.format_report(combined)}\n\n" + config.OPERATIONAL_DEFECTS_BLOCK
-        kb = [
-            [InlineKeyboardButton("Отправить РМ/МН", callback_data='rtp_send_to_rm')],
-            [InlineKeyboardButton("Назад", callback_data='rtp_menu')]
-        ]
-        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb))
-        return
-
-    if data == 'rtp_send_to_rm':
-        manager_fi = database.get_user_name(uid)
-        date = datetime.now().strftime('%Y-%m-%d')
-        reports = database.get_all_reports_on_date(date, manager_fi)
-        if not reports:
-            await query.edit_message_text("Нет отчетов для объединения/отправки.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Назад", callback_data='rtp_menu')]]))
-            return
-        combined = {}
-        fckp_products = []
-        for _, r in reports:
-            for k, v in r.items():
-                if k == 'fckp_products' and isinstance(v, list):
-                    fckp_products.extend(v)
-                else:
-                    try:
-                        combined[k] = combined.get(k, 0) + float(v or 0)
-                    except Exception:
-                        pass
-        combined['fckp_products'] = fckp_products
-        combined['fckp_realized'] = len(fckp_products)
-        database.save_rtp_combined(manager_fi, combined, date)
-        await query.edit_message_text("Объединённый отчёт сохранён и доступен РМ/МН.")
-        return
-
-    # FCKP product picking
-    if data.startswith('fckp_prod_'):
-        prod = data.split('fckp_prod_',1)[1]
-        st = safe_state(uid)
-        st.setdefault('fckp_products', [])
-        st['fckp_products'].append(prod)
-        st['fckp_left'] = st.get('fckp_left', 0) - 1
-        left = st.get('fckp_left', 0)
-        if left > 0:
-            kb = [[InlineKeyboardButton(p, callback_data=f"fckp_prod_{p}")] for p in config.FCKP_OPTIONS]
-            try:
-                await query.edit_message_text(f"Вы выбрали {prod}. Осталось указать ещё {left} ФЦКП.", reply_markup=InlineKeyboardMarkup(kb))
-            except Exception:
-                pass
-            return
+def parse_unit_add(arg):
+    # "rtp_12" -> ('rtp', 12); raises ValueError
+    kind, _, parent = arg.partition('_')
+    if kind not in ('rm', 'rtp'):
+        raise ValueError(arg)
+    return kind, int(parent)
+
+# org_add_rm_{parent} / org_add_rtp_{parent}: the name comes as the next text message
+@router.prefix('org_add_', parse_unit_add, error="Ошибка оргструктуры.")
+async def on_org_add(query, context, uid, st, add):
+    kind, parent_id = add
+    if not await org_scope(query, uid, parent_id):
+        return
+    sessions.set(uid, Session(mode='awaiting_unit_name', org_unit=parent_id, org_kind=kind))
+    what = "подразделения" if kind == 'rm' else "группы РТП (ФИ руководителя)"
+    await query.edit_message_text(f"Введите название {what} или «отмена»:")
+
+async def show_org_move(query, uid, unit_id, after_id=None, before_id=None):
+    if not await org_scope(query, uid, unit_id):
+        return
+    scope = await adb.get_user_unit(uid)
+    unit = await adb.get_unit(unit_id)
+    inside = {i for i, _ in await adb.get_units('rm', unit_id)}
+    page, has_prev, has_next = org_page(await adb.get_units('rm', scope, after_id, before_id, ORG_PAGE_SIZE + 1),
+                                        after_id, before_id)
+    # the page is cut before filtering, so it can come out shorter; paging follows the unfiltered list
+    targets = [(i, name) for i, name in page if i != unit['parent_id'] and i not in inside]
+    kb = [[InlineKeyboardButton(name, callback_data=f"org_moveto_{unit_id}:{i}")] for i, name in targets]
+    kb += org_page_nav('org_mvpage_', unit_id, page, has_prev, has_next)
+    kb.append([InlineKeyboardButton("Назад", callback_data=f"org_node_{unit_id}")])
+    await query.edit_message_text(f"Куда перенести «{unit['name']}»?", reply_markup=InlineKeyboardMarkup(kb))
+
+@router.prefix('org_move_', int, error="Ошибка оргструктуры.")
+async def on_org_move(query, context, uid, st, unit_id):
+    await show_org_move(query, uid, unit_id)
+
+# org_mvpage_{unit_id}:{n|p}{target_id}: next / previous page of move targets
+@router.prefix('org_mvpage_', parse_org_page, error="Ошибка оргструктуры.")
+async def on_org_move_page(query, context, uid, st, key):
+    await show_org_move(query, uid, *key)
+
+def parse_unit_pair(arg):
+    # "12:3" -> (12, 3); raises ValueError
+    unit_id, target_id = arg.split(':')
+    return int(unit_id), int(target_id)
+
+@router.prefix('org_moveto_', parse_unit_pair, error="Ошибка оргструктуры.")
+async def on_org_moveto(query, context, uid, st, pair):
+    unit_id, target_id = pair
+    if not await org_scope(query, uid, unit_id) or not await org_scope(query, uid, target_id):
+        return
+    if unit_id == await adb.get_user_unit(uid):
+        return
+    try:
+        await adb.move_unit(unit_id, target_id)
+    except ValueError as e:
+        await query.edit_message_text(f"Не удалось перенести: {e}", reply_markup=org_back_kb(unit_id))
+        return
+    await query.edit_message_text("Перенесено.", reply_markup=org_back_kb(unit_id))
+
+@router.prefix('org_del_', int, error="Ошибка оргструктуры.")
+async def on_org_delete(query, context, uid, st, unit_id):
+    if not await org_scope(query, uid, unit_id):
+        return
+    unit = await adb.get_unit(unit_id)
+    kb = [[InlineKeyboardButton("Да, удалить", callback_data=f"org_delok_{unit_id}")],
+          [InlineKeyboardButton("Назад", callback_data=f"org_node_{unit_id}")]]
+    await query.edit_message_text(f"Удалить «{unit['name']}»? Удалить можно только пустое подразделение.",
+                                  reply_markup=InlineKeyboardMarkup(kb))
+
+@router.prefix('org_delok_', int, error="Ошибка оргструктуры.")
+async def on_org_delete_confirmed(query, context, uid, st, unit_id):
+    if not await org_scope(query, uid, unit_id) or unit_id == await adb.get_user_unit(uid):
+        return
+    parent_id = (await adb.get_unit(unit_id))['parent_id']
+    try:
+        await adb.delete_unit(unit_id)
+    except ValueError as e:
+        await query.edit_message_text(f"Не удалось удалить: {e}", reply_markup=org_back_kb(unit_id))
+        return
+    await query.edit_message_text("Удалено.", reply_markup=org_back_kb(parent_id))
+
+# RTP manager actions
+@router.exact('rtp_menu')
+async def on_rtp_menu(query, context, uid, st):
+    await show_manager_menu(query)
+
+@router.exact('rtp_show_reports')
+async def on_rtp_show_reports(query, context, uid, st):
+    date = datetime.now().strftime('%Y-%m-%d')
+    manager_fi = await adb.get_user_name(uid)
+    employees = await adb.get_employees(manager_fi)
+    reports = await adb.get_all_reports_on_date(date, manager_fi)
+    reported_ids = {u for u, _ in reports}
+    text = f"Отчеты на {date}:\n"
+    for u_id, name in employees:
+        status = '✅' if u_id in reported_ids else '❌'
+        text += f"Сотрудник {name or str(u_id)}: {status}\n"
+    kb = [[InlineKeyboardButton("Детальный отчет на дату", callback_data='rtp_detailed_reports')], [InlineKeyboardButton("Назад", callback_data='rtp_menu')]]
+    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb))
+
+def _detailed_kb(date, first_uid, last_uid, has_prev, has_next):
+    nav = []
+    if has_prev:
+        nav.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"rtp_det_prev_{date}:{first_uid}"))
+    if has_next:
+        nav.append(InlineKeyboardButton("Далее ➡️", callback_data=f"rtp_det_next_{date}:{last_uid}"))
+    kb = [nav] if nav else []
+    kb.append([InlineKeyboardButton("Вернуться в меню", callback_data='rtp_menu')])
+    return InlineKeyboardMarkup(kb)
+
+async def render_detailed_page(manager_fi, date, after_uid=None, before_uid=None):
+    # Страница набирается, пока текст помещается в TELEGRAM_TEXT_LIMIT; из БД
+    # читаются только нужные отчёты пачками по DETAILED_REPORTS_FETCH (keyset по user_id).
+    # Назад страница заполняется от границы к началу.
+    header = f"Детальные отчеты на {date}:\n\n"
+    budget = TELEGRAM_TEXT_LIMIT - len(header)
+    backward = before_uid is not None
+    fetch = config.DETAILED_REPORTS_FETCH
+    blocks = []
+    used = 0
+    more = False
+    cursor = before_uid if backward else after_uid
+    while True:
+        if backward:
+            rows = await adb.get_reports_page(date, manager_fi, before_user_id=cursor, limit=fetch + 1)
         else:
-            st['data']['fckp_products'] = st.get('fckp_products', [])
-            st['data']['fckp_realized'] = len(st.get('fckp_products', []))
-            try:
-                await query.edit_message_text("Все ФЦКП указаны ✅")
-            except Exception:
-                pass
-            st['step'] = st.get('step',0) + 1
-            await ask_next_question(query.message, uid)
-            return
+            rows = await adb.get_reports_page(date, manager_fi, after_user_id=cursor, limit=fetch + 1)
+        for u_id, name, rdata in rows[:fetch]:
+            block = f"Сотрудник {name or str(u_id)}:\n{config.format_report(rdata)}\n\n"
+            if blocks and used + len(block) > budget:
+                more = True
+                break
+            if len(block) > budget:
+                block = block[:budget - 2] + "…\n"
+            blocks.append((u_id, block))
+            used += len(block)
+        else:
+            if len(rows) > fetch:
+                cursor = rows[fetch - 1][0]
+                continue
+        break
+    if backward:
+        blocks.reverse()
+        has_prev, has_next = more, True
+    else:
+        has_prev, has_next = after_uid is not None, more
+    if not blocks:
+        return f"Нет отчетов на {date}.", _detailed_kb(date, None, None, False, False)
+    text = header + "".join(block for _, block in blocks)
+    return text.rstrip(), _detailed_kb(date, blocks[0][0], blocks[-1][0], has_prev, has_next)
 
-    # download individual user report (RTP view)
-    if data.startswith('download_user_'):
-        try:
-            parts = data.split('_')
-            target_uid = int(parts[2])
-        except Exception:
-            await query.edit_message_text("Ошибка скачивания.")
-            return
-        date = datetime.now().strftime('%Y-%m-%d')
-        rpt = database.get_report(target_uid, date)
-        if not rpt:
-            await query.edit_message_text("Отчёт не найден.")
-            return
-        rows = []
-        for q in config.QUESTIONS:
-            rows.append({'key': q['question'], 'value': rpt.get(q['key'], 0)})
-        prod_counts = {}
-        for p in rpt.get('fckp_products', []):
-            prod_counts[p] = prod_counts.get(p,0) + 1
-        for prod in config.FCKP_OPTIONS:
-            rows.append({'key': prod, 'value': prod_counts.get(prod,0)})
-        cols = [('key','Поле'), ('value','Значение')]
-        try:
-            bio = generate_xlsx_for_report(f"user_{target_uid}_{date}", rows, cols)
-            filename = f"user_{target_uid}_{date}.xlsx"
-            await context.bot.send_document(chat_id=uid, document=InputFile(bio, filename=filename))
-        except Exception as e:
-            await query.edit_message_text(f"Ошибка формирования файла: {e}")
+def parse_page_key(arg):
+    # "<YYYY-MM-DD>:<user_id>" from rtp_det_next_/rtp_det_prev_ callback data
+    date, _, user_id = arg.partition(':')
+    datetime.strptime(date, '%Y-%m-%d')
+    return date, int(user_id)
+
+@router.exact('rtp_detailed_reports')
+async def on_rtp_detailed_reports(query, context, uid, st):
+    date = datetime.now().strftime('%Y-%m-%d')
+    manager_fi = await adb.get_user_name(uid)
+    text, kb = await render_detailed_page(manager_fi, date)
+    await query.edit_message_text(text, reply_markup=kb)
+
+@router.prefix('rtp_det_next_', parse_page_key, error="Ошибка навигации.")
+async def on_rtp_detailed_next(query, context, uid, st, key):
+    date, after_uid = key
+    manager_fi = await adb.get_user_name(uid)
+    text, kb = await render_detailed_page(manager_fi, date, after_uid=after_uid)
+    await query.edit_message_text(text, reply_markup=kb)
+
+@router.prefix('rtp_det_prev_', parse_page_key, error="Ошибка навигации.")
+async def on_rtp_detailed_prev(query, context, uid, st, key):
+    date, before_uid = key
+    manager_fi = await adb.get_user_name(uid)
+    text, kb = await render_detailed_page(manager_fi, date, before_uid=before_uid)
+    await query.edit_message_text(text, reply_markup=kb)
+
+@router.exact('rtp_combine_reports')
+async def on_rtp_combine_reports(query, context, uid, st):
+    date = datetime.now().strftime('%Y-%m-%d')
+    manager_fi = await adb.get_user_name(uid)
+    combined = await adb.get_rtp_aggregate(manager_fi, date)
+    if not combined:
+        await query.edit_message_text("Нет отчетов на сегодня.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Назад", callback_data='rtp_menu')]]))
         return
+    text = f"Объединённый отчёт на {date}:\n\n{config.format_report(combined)}\n\n" + config.OPERATIONAL_DEFECTS_BLOCK
+    kb = [
+        [InlineKeyboardButton("Отправить РМ/МН", callback_data='rtp_send_to_rm')],
+        [InlineKeyboardButton("Назад", callback_data='rtp_menu')]
+    ]
+    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(kb))
 
-    if data == 'send_report':
-        success, msg_text = await send_personal_report_to_manager(uid, context)
+@router.exact('rtp_send_to_rm')
+async def on_rtp_send_to_rm(query, context, uid, st):
+    manager_fi = await adb.get_user_name(uid)
+    date = datetime.now().strftime('%Y-%m-%d')
+    combined = await adb.get_rtp_aggregate(manager_fi, date)
+    if not combined:
+        await query.edit_message_text("Нет отчетов для объединения/отправки.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Назад", callback_data='rtp_menu')]]))
+        return
+    await adb.save_rtp_combined(manager_fi, combined, date)
+    await query.edit_message_text("Объединённый отчёт сохранён и доступен РМ/МН.")
+
+# period rollups: rtp_period_* (own employees), rm_period_* (all submitted RTP reports)
+@router.exact('rtp_period_menu', 'rm_period_menu')
+async def on_period_menu(query, context, uid, st):
+    scope = query.data.split('_')[0]
+    kb = [
+        [InlineKeyboardButton("Текущая неделя", callback_data=f"{scope}_period_week")],
+        [InlineKeyboardButton("Текущий месяц", callback_data=f"{scope}_period_month")],
+        [InlineKeyboardButton("Текущий квартал", callback_data=f"{scope}_period_quarter")],
+        [InlineKeyboardButton("Произвольный период", callback_data=f"{scope}_period_custom")],
+        [InlineKeyboardButton("Назад", callback_data='rtp_menu' if scope == 'rtp' else 'rm_show_rtps')]
+    ]
+    await query.edit_message_text("Выберите период:", reply_markup=InlineKeyboardMarkup(kb))
+
+async def show_period(query, uid, scope, kind):
+    if kind == 'custom':
+        sessions.set(uid, Session(mode='awaiting_period', period_scope=scope))
+        await query.edit_message_text("Введите период в формате ДД.ММ.ГГГГ-ДД.ММ.ГГГГ (или одну дату):")
+        return
+    if kind not in PERIOD_KINDS:
+        return
+    start_date, end_date = period_bounds(kind)
+    text = await build_period_text(uid, scope, start_date, end_date)
+    await query.edit_message_text(text, reply_markup=period_back_kb(scope, start_date, end_date))
+
+@router.prefix('rtp_period_')
+async def on_rtp_period(query, context, uid, st, kind):
+    await show_period(query, uid, 'rtp', kind)
+
+@router.prefix('rm_period_')
+async def on_rm_period(query, context, uid, st, kind):
+    await show_period(query, uid, 'rm', kind)
+
+# multi-sheet export for a period: totals, per RTP, per employee
+@router.prefix('period_xlsx_', parse_period_key, error="Ошибка скачивания.")
+async def on_period_xlsx(query, context, uid, st, period):
+    scope, start_date, end_date = period
+    manager_fi = await adb.get_user_name(uid) if scope == 'rtp' else None
+    unit_id = await adb.get_user_unit(uid) if scope == 'rm' else None
+    if scope == 'rm' and unit_id is None:
+        await query.edit_message_text(NO_UNIT_TEXT)
+        return
+    try:
+        filename = f"{scope}_{start_date}_{end_date}.xlsx"
+        await send_export(context, uid, filename, jobs.export_period, start_date, end_date, manager_fi, unit_id)
+    except Exception as e:
+        await query.edit_message_text(f"Ошибка формирования файла: {e}")
+
+# FCKP product picking
+@router.prefix('fckp_prod_')
+async def on_fckp_product(query, context, uid, st, prod):
+    st = await sessions.ensure(uid)
+    if st.fckp_products is None:
+        st.fckp_products = []
+    st.fckp_products.append(prod)
+    st.fckp_left -= 1
+    sessions.update(uid, st)
+    left = st.fckp_left
+    if left > 0:
+        kb = [[InlineKeyboardButton(p, callback_data=f"fckp_prod_{p}")] for p in config.FCKP_OPTIONS]
         try:
-            if success:
-                await query.edit_message_text("Отчёт успешно отправлен руководителю.")
-            else:
-                await query.edit_message_text(f"Отчет отправлен, но {msg_text}")
+            await query.edit_message_text(f"Вы выбрали {prod}. Осталось указать ещё {left} ФЦКП.", reply_markup=InlineKeyboardMarkup(kb))
         except Exception:
-            try:
-                await query.message.reply_text("Отчёт отправлен (или произошла ошибка, проверьте лог).")
-            except Exception:
-                pass
+            pass
         return
+    st.data['fckp_products'] = st.fckp_products
+    st.data['fckp_realized'] = len(st.fckp_products)
+    try:
+        await query.edit_message_text("Все ФЦКП указаны ✅")
+    except Exception:
+        pass
+    st.step = (st.step or 0) + 1
+    sessions.update(uid, st)
+    await ask_next_question(query.message, uid)
 
-    # fallback
-    return
+# download individual user report (RTP view)
+@router.prefix('download_user_', int, error="Ошибка скачивания.")
+async def on_download_user(query, context, uid, st, target_uid):
+    date = datetime.now().strftime('%Y-%m-%d')
+    rpt = await adb.get_report(target_uid, date)
+    if not rpt:
+        await query.edit_message_text("Отчёт не найден.")
+        return
+    rows = []
+    for q in config.QUESTIONS:
+        rows.append({'key': q['question'], 'value': rpt.get(q['key'], 0)})
+    prod_counts = {}
+    for p in rpt.get('fckp_products', []):
+        prod_counts[p] = prod_counts.get(p,0) + 1
+    for prod in config.FCKP_OPTIONS:
+        rows.append({'key': prod, 'value': prod_counts.get(prod,0)})
+    cols = [('key','Поле'), ('value','Значение')]
+    try:
+        filename = f"user_{target_uid}_{date}.xlsx"
+        await send_export(context, uid, filename, jobs.xlsx_from_dicts, f"user_{target_uid}_{date}", rows, cols)
+    except Exception as e:
+        await query.edit_message_text(f"Ошибка формирования файла: {e}")
+
+@router.exact('send_report')
+async def on_send_report(query, context, uid, st):
+    success, msg_text = await send_personal_report_to_manager(uid, context)
+    try:
+        if success:
+            await query.edit_message_text("Отчёт успешно отправлен руководителю.")
+        else:
+            await query.edit_message_text(f"Отчет отправлен, но {msg_text}")
+    except Exception:
+        try:
+            await query.message.reply_text("Отчёт отправлен (или произошла ошибка, проверьте лог).")
+        except Exception:
+            pass
 
 # role selection helper
 async def handle_role_selection(query_or_message, user_id, role):
-    name = database.get_user_name(user_id)
+    name = await adb.get_user_name(user_id)
     if role == 'rtp':
-        kb = [[InlineKeyboardButton(fi, callback_data=f"choose_rtp_{i}")] for i,fi in enumerate(config.RTP_LIST)]
-        kb.append([InlineKeyboardButton("Вернуться в меню", callback_data='return_to_menu')])
+        markup = await rtp_picker_kb()
         try:
-            await query_or_message.edit_message_text("Выберите ваше ФИ (РТП):", reply_markup=InlineKeyboardMarkup(kb))
+            await query_or_message.edit_message_text("Выберите ваше ФИ (РТП):", reply_markup=markup)
         except Exception:
             try:
-                await query_or_message.reply_text("Выберите ваше ФИ (РТП):", reply_markup=InlineKeyboardMarkup(kb))
+                await query_or_message.reply_text("Выберите ваше ФИ (РТП):", reply_markup=markup)
             except Exception:
                 pass
         return
 
     if role == 'rm':
-        kb = [[InlineKeyboardButton(fi, callback_data=f"choose_rm_{i}")] for i, fi in enumerate(config.RM_MN_LIST)]
-        kb.append([InlineKeyboardButton("Вернуться в меню", callback_data='return_to_menu')])
+        markup = await rm_units_kb()
         try:
-            await query_or_message.edit_message_text("Выберите ваше ФИ (РМ/МН):", reply_markup=InlineKeyboardMarkup(kb))
+            await query_or_message.edit_message_text("Выберите ваше подразделение (РМ/МН):", reply_markup=markup)
         except Exception:
             try:
-                await query_or_message.reply_text("Выберите ваше ФИ (РМ/МН):", reply_markup=InlineKeyboardMarkup(kb))
+                await query_or_message.reply_text("Выберите ваше подразделение (РМ/МН):", reply_markup=markup)
             except Exception:
                 pass
         return
@@ -512,9 +930,9 @@ async def handle_role_selection(query_or_message, user_id, role):
     # MKK flow: ask for name then choose RТП
     if role == 'mkk':
         if name:
-            manager_fi = database.get_manager_fi_for_employee(user_id)
+            manager_fi = await adb.get_manager_fi_for_employee(user_id)
             if manager_fi:
-                user_states[user_id] = {'mode': role, 'step': 0, 'data': {}, 'editing': False}
+                sessions.set(user_id, Session.for_role(role))
                 try:
                     await query_or_message.edit_message_text("Роль выбрана. Начинаем заполнение отчёта.")
                 except Exception:
@@ -525,11 +943,11 @@ async def handle_role_selection(query_or_message, user_id, role):
                 await start_filling(query_or_message, user_id)
                 return
             else:
-                user_states[user_id] = {'mode': role, 'choosing_rtp': True, 'name': name}
+                sessions.set(user_id, Session(mode=role, choosing_rtp=True, name=name))
                 await show_rtp_buttons(query_or_message, "Выберите вашего РТП:")
                 return
         else:
-            user_states[user_id] = {'mode': role, 'entering_name': True}
+            sessions.set(user_id, Session(mode=role, entering_name=True))
             try:
                 await query_or_message.edit_message_text("Пожалуйста, введите ваше имя (ФИ):")
             except Exception:
@@ -539,14 +957,27 @@ async def handle_role_selection(query_or_message, user_id, role):
                     pass
             return
 
-async def show_rtp_buttons(query_or_message, text):
-    kb = [[InlineKeyboardButton(fi, callback_data=f"choose_rtp_{i}")] for i,fi in enumerate(config.RTP_LIST)]
+async def rm_units_kb(after_id=None, before_id=None):
+    page, has_prev, has_next = org_page(await adb.get_units('rm', None, after_id, before_id, ORG_PAGE_SIZE + 1),
+                                        after_id, before_id)
+    kb = [[InlineKeyboardButton(unit_name, callback_data=f"choose_rm_{unit_id}")] for unit_id, unit_name in page]
+    kb += org_page_nav('rm_units_page_', None, page, has_prev, has_next)
     kb.append([InlineKeyboardButton("Вернуться в меню", callback_data='return_to_menu')])
+    return InlineKeyboardMarkup(kb)
+
+# rm_units_page_:{n|p}{unit_id}: next / previous page of the RM/MN division list
+@router.prefix('rm_units_page_', parse_org_page, error="Ошибка выбора. Попробуйте снова.")
+async def on_rm_units_page(query, context, uid, st, key):
+    _, after_id, before_id = key
+    await query.edit_message_reply_markup(reply_markup=await rm_units_kb(after_id, before_id))
+
+async def show_rtp_buttons(query_or_message, text):
+    markup = await rtp_picker_kb()
     try:
-        await query_or_message.reply_text(text, reply_markup=InlineKeyboardMarkup(kb))
+        await query_or_message.reply_text(text, reply_markup=markup)
     except Exception:
         try:
-            await query_or_message.message.reply_text(text, reply_markup=InlineKeyboardMarkup(kb))
+            await query_or_message.message.reply_text(text, reply_markup=markup)
         except Exception:
             pass
 
@@ -555,6 +986,7 @@ async def show_manager_menu(q):
         [InlineKeyboardButton("Показать отчеты на дату", callback_data='rtp_show_reports')],
         [InlineKeyboardButton("Детальный отчет на дату", callback_data='rtp_detailed_reports')],
         [InlineKeyboardButton("Объединить и показать отчеты на дату", callback_data='rtp_combine_reports')],
+        [InlineKeyboardButton("Отчёт за период", callback_data='rtp_period_menu')],
         [InlineKeyboardButton("Вернуться в меню", callback_data='return_to_menu')]
     ]
     try:
@@ -566,15 +998,39 @@ async def show_manager_menu(q):
             pass
 
 # messages handler
+def message_state(st):
+    # metrics label: which branch of message_handler the message goes to
+    if st is None:
+        return 'no_session'
+    if st.mode in ('awaiting_password_for', 'awaiting_period', 'change_fi_enter_name', 'awaiting_unit_name'):
+        return st.mode
+    if st.entering_name:
+        return 'entering_name'
+    if st.choosing_rtp:
+        return 'choosing_rtp'
+    if st.step is None:
+        return st.mode
+    if st.step < len(config.QUESTIONS):
+        return 'question_' + config.QUESTIONS[st.step]['key']
+    return 'finished'
+
 async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = update.message
     if not msg:
         return
     uid = msg.from_user.id
+    st = await sessions.get(uid)
+    started = metrics.start()
+    state = message_state(st) if started is not None else None
+    try:
+        await handle_message(update, context, msg, uid, st)
+    finally:
+        metrics.MESSAGE_SECONDS.time(started, state)
+
+async def handle_message(update, context, msg, uid, st):
     text = (msg.text or "").strip()
-    st = user_states.get(uid, {})
 
-    if not st:
+    if st is None:
         if text.lower() == "вернуться в меню":
             await start(update, context)
             return
@@ -582,24 +1038,24 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     if text.lower() == "вернуться в меню":
-        user_states.pop(uid, None)
+        sessions.pop(uid)
         await start(update, context)
         return
 
     # Password entry flow for RTP/RM (variant B)
-    if st.get('mode') == 'awaiting_password_for':
-        await_role = st.get('await_role')
+    if st.mode == 'awaiting_password_for':
+        await_role = st.await_role
         if text.lower() == 'отмена' or text.lower() == 'cancel':
-            user_states.pop(uid, None)
+            sessions.pop(uid)
             await msg.reply_text("Отмена. Возврат в меню.", reply_markup=build_main_menu())
             return
         # check password
         if text == config.ADMIN_PASSWORD:
             # ensure user row exists and mark verified
-            database.add_user(uid, await_role)
+            await adb.add_user(uid, await_role)
             # don't override name; set_user_name called only if present
-            database.set_user_verified(uid, 1)
-            user_states[uid] = {'mode': await_role, 'step': 0, 'data': {}, 'editing': False}
+            await adb.set_user_verified(uid, 1)
+            sessions.set(uid, Session.for_role(await_role))
             await msg.reply_text("Пароль верный. Доступ предоставлен.")
             await handle_role_selection(msg, uid, await_role)
             return
@@ -607,37 +1063,68 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await msg.reply_text("Неверный пароль. Попробуйте снова")
             return
 
+    # custom period entry for RTP/RM rollups
+    if st.mode == 'awaiting_period':
+        scope = st.period_scope or 'rtp'
+        bounds = parse_period(text)
+        if not bounds:
+            await msg.reply_text("Не удалось разобрать период. Пример: 01.10.2025-15.10.2025")
+            return
+        sessions.set(uid, Session.for_role(scope))
+        result = await build_period_text(uid, scope, *bounds)
+        await msg.reply_text(result, reply_markup=period_back_kb(scope, *bounds))
+        return
+
+    # new org unit name (RM, Оргструктура)
+    if st.mode == 'awaiting_unit_name':
+        parent, kind = st.org_unit, st.org_kind
+        sessions.set(uid, Session.for_role('rm'))
+        back = InlineKeyboardMarkup([[InlineKeyboardButton("К подразделению", callback_data=f"org_node_{parent}")]])
+        if text.lower() == 'отмена' or text.lower() == 'cancel':
+            await msg.reply_text("Отменено.", reply_markup=back)
+            return
+        try:
+            await adb.add_unit(text, kind, parent)
+        except ValueError as e:
+            await msg.reply_text(f"Не удалось создать: {e}", reply_markup=back)
+            return
+        await msg.reply_text(f"Создано: {text}", reply_markup=back)
+        return
+
     # change FI flow
-    if st.get('mode') == 'change_fi_enter_name':
+    if st.mode == 'change_fi_enter_name':
         entered_name = text
-        st['new_name'] = entered_name
-        st['change_flow'] = True
+        st.new_name = entered_name
+        st.change_flow = True
+        sessions.update(uid, st)
         await show_rtp_buttons(msg, f"Вы ввели имя: {entered_name}\nТеперь выберите вашего РТП из списка:")
         return
 
     # Registration flows (MKK name entering)
-    if st.get('entering_name'):
+    if st.entering_name:
         name = text
-        role = st.get('mode','idle')
-        st['name'] = name
-        st.pop('entering_name', None)
-        database.add_user(uid, 'mkk' if role == 'mkk' else role, name)
+        role = st.mode
+        st.name = name
+        st.entering_name = False
+        sessions.update(uid, st)
+        await adb.add_user(uid, 'mkk' if role == 'mkk' else role, name)
         if role == 'mkk':
-            st['choosing_rtp'] = True
+            st.choosing_rtp = True
+            sessions.update(uid, st)
             await show_rtp_buttons(update, "Выберите вашего РТП:")
         else:
             await msg.reply_text("Выберите ваше ФИ из списка кнопок.")
         return
 
-    if st.get('choosing_rtp'):
+    if st.choosing_rtp:
         await msg.reply_text("Пожалуйста, выберите РТП из списка кнопок.")
         return
 
     # Now questionnaire: accept floats (and ints)
-    if 'step' not in st:
+    if st.step is None:
         return
 
-    step = st['step']
+    step = st.step
     if step < len(config.QUESTIONS):
         q = config.QUESTIONS[step]
         # Accept float-like input (allow comma)
@@ -654,20 +1141,23 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # special handling for fckp_realized (asks for product choices)
         if q['key'] == 'fckp_realized':
             n = int(val)
-            st['data'][q['key']] = n
+            st.data[q['key']] = n
             if n > 0:
-                st['fckp_left'] = n
-                st['fckp_products'] = []
+                st.fckp_left = n
+                st.fckp_products = []
+                sessions.update(uid, st)
                 kb = [[InlineKeyboardButton(p, callback_data=f"fckp_prod_{p}")] for p in config.FCKP_OPTIONS]
                 await msg.reply_text(f"Вы указали {n} ФЦКП. Выберите оформленный продукт (1/{n}):", reply_markup=InlineKeyboardMarkup(kb))
                 return
             else:
-                st['step'] += 1
+                st.step += 1
+                sessions.update(uid, st)
                 await ask_next_question(msg, uid)
                 return
         else:
-            st['data'][q['key']] = str(val)
-            st['step'] += 1
+            st.data[q['key']] = str(val)
+            st.step += 1
+            sessions.update(uid, st)
             await ask_next_question(msg, uid)
             return
     else:
@@ -675,11 +1165,11 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
 async def ask_next_question(msgobj, uid):
-    st = safe_state(uid)
-    step = st.get('step', 0)
+    st = await sessions.ensure(uid)
+    step = st.step or 0
     if step < len(config.QUESTIONS):
         q = config.QUESTIONS[step]
-        current = st.get('data', {}).get(q['key'], '')
+        current = st.data.get(q['key'], '')
         try:
             await msgobj.reply_text(f"{q['question']} {f'(текущее: {current})' if current != '' else ''}")
         except Exception:
@@ -691,11 +1181,12 @@ async def ask_next_question(msgobj, uid):
         await finish_report(msgobj, uid)
 
 async def start_filling(query_or_message, uid, editing=False):
-    st = safe_state(uid)
-    st['editing'] = editing
-    st['step'] = 0
+    st = await sessions.ensure(uid)
+    st.editing = editing
+    st.step = 0
     if not editing:
-        st['data'] = {}
+        st.data = {}
+    sessions.update(uid, st)
     try:
         await query_or_message.edit_message_text("Начинаем заполнение отчёта.")
     except Exception:
@@ -706,17 +1197,18 @@ async def start_filling(query_or_message, uid, editing=False):
     await ask_next_question(query_or_message, uid)
 
 async def finish_report(msgobj, uid):
-    st = safe_state(uid)
-    data = st.get('data', {}) or {}
-    if 'fckp_products' in st and st.get('fckp_products'):
-        data['fckp_products'] = st.get('fckp_products')
-        data['fckp_realized'] = len(st.get('fckp_products'))
+    st = await sessions.ensure(uid)
+    data = st.data
+    if st.fckp_products:
+        data['fckp_products'] = st.fckp_products
+        data['fckp_realized'] = len(st.fckp_products)
     # ensure all questions present
     for q in config.QUESTIONS:
         data.setdefault(q['key'], 0)
+    sessions.update(uid, st)
     try:
-        if st.get('mode') != 'idle':
-            database.save_report(uid, data)
+        if st.mode != 'idle':
+            await adb.save_report(uid, data)
     except Exception as e:
         print("DB save_report error:", e)
     formatted = config.format_report(data)
@@ -731,7 +1223,7 @@ async def finish_report(msgobj, uid):
     kb = [
         [InlineKeyboardButton("Редактировать", callback_data='edit_report')]
     ]
-    if st.get('mode') == 'mkk':
+    if st.mode == 'mkk':
         kb[0].insert(1, InlineKeyboardButton("Отправить руководителю", callback_data='send_report'))
     try:
         await msgobj.reply_text("Действия:", reply_markup=InlineKeyboardMarkup(kb))
@@ -740,26 +1232,58 @@ async def finish_report(msgobj, uid):
 
 async def send_personal_report_to_manager(uid, context):
     date = datetime.now().strftime('%Y-%m-%d')
-    rpt = database.get_report(uid, date)
-    if not rpt:
+    info = await adb.get_report_with_manager(uid, date)
+    if not info:
         return False, "Отчёт не найден"
-    formatted = config.format_report(rpt)
-    name = database.get_user_name(uid) or str(uid)
-    manager_fi = database.get_manager_fi_for_employee(uid)
+    formatted = config.format_report(info['report'])
+    name = info['name'] or str(uid)
+    manager_fi = info['manager_fi']
     if not manager_fi:
         return False, "Руководитель не привязан"
-    manager_id = database.get_manager_id_by_fi(manager_fi)
+    manager_id = info['manager_id']
     if not manager_id:
         return False, f"руководитель {manager_fi} не найден в системе"
+    # доставку (лимиты Telegram, повторы) берёт на себя outbox
     try:
-        await context.bot.send_message(chat_id=manager_id, text=f"Отчёт от сотрудника {name} на {date}:\n{formatted}")
+        await outbox.enqueue(manager_id, f"Отчёт от сотрудника {name} на {date}:\n{formatted}")
         return True, "Отчёт отправлен"
     except Exception as e:
         print("send_personal_report_to_manager error:", e)
         return False, "Ошибка отправки"
 
+# deadline reminders: one anti-join query, delivery through the outbox
+async def send_deadline_reminders(context: ContextTypes.DEFAULT_TYPE):
+    date = datetime.now().strftime('%Y-%m-%d')
+    missing = await adb.get_missing_reports(date)
+    by_rtp = {}
+    for user_id, name, manager_fi, manager_id in missing:
+        await outbox.enqueue(user_id, f"Напоминание: вы ещё не отправили отчёт за {date}. Нажмите /start, чтобы заполнить.")
+        by_rtp.setdefault((manager_fi, manager_id), []).append(name or str(user_id))
+    if config.REMINDER_RTP_SUMMARY:
+        for (manager_fi, manager_id), names in by_rtp.items():
+            if not manager_id:
+                continue
+            text = f"Не сдали отчёт за {date} ({len(names)}):\n" + "\n".join(f"• {n}" for n in names)
+            await outbox.enqueue(manager_id, text)
+    print(f"reminders {date}: {len(missing)} сотрудников, {len(by_rtp)} РТП")
+
+def schedule_reminders(app):
+    if app.job_queue is None:
+        print("JobQueue недоступен (pip install \"python-telegram-bot[job-queue]\"), напоминания отключены")
+        return
+    if config.REMINDER_TIMEZONE:
+        from zoneinfo import ZoneInfo
+        tz = ZoneInfo(config.REMINDER_TIMEZONE)
+    else:
+        tz = datetime.now().astimezone().tzinfo
+    for t in config.REMINDER_TIMES:
+        hour, minute = map(int, t.split(':'))
+        app.job_queue.run_daily(send_deadline_reminders, time=dtime(hour, minute, tzinfo=tz),
+                                days=tuple(config.REMINDER_DAYS), name=f"reminder_{t}")
+
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     print("Error:", context.error)
+    metrics.HANDLER_ERRORS.inc(type(context.error).__name__)
 
 async def set_commands(app):
     try:
@@ -767,12 +1291,69 @@ async def set_commands(app):
     except Exception as e:
         print("set_commands error:", e)
 
-if __name__ == '__main__':
-    app = ApplicationBuilder().token(TOKEN).build()
+async def set_commands_job(context: ContextTypes.DEFAULT_TYPE):
+    await set_commands(context.application)
+
+async def on_startup(app):
+    # post_init runs before polling/webhook starts: only what the first update needs
+    # is done here, the rest runs once the application is up
+    if app.job_queue is not None:
+        app.job_queue.run_once(set_commands_job, 0, name='set_commands')
+    else:
+        await set_commands(app)
+    sessions.start()
+    outbox.start(app.bot)
+    schedule_reminders(app)
+    port = await metrics.start_server(port=METRICS_PORT)
+    if port is not None:
+        print(f"Metrics on http://{config.METRICS_LISTEN}:{port}/metrics")
+
+async def on_shutdown(app):
+    # сохранить сессии и дождаться записей в БД, поставленных в очередь
+    await sessions.stop()
+    await outbox.stop()
+    await metrics.stop_server()
+    jobs.shutdown()
+    adb.shutdown()
+
+def build_application():
+    builder = (ApplicationBuilder().token(TOKEN)
+               .base_url(BOT_API_BASE_URL)
+               .concurrent_updates(PerUserUpdateProcessor(config.MAX_CONCURRENT_UPDATES))
+               .post_init(on_startup)
+               .post_shutdown(on_shutdown))
+    if metrics.ENABLED:
+        # Bot API calls go through the counting request class
+        builder = (builder.request(metrics.MeteredRequest(connection_pool_size=config.BOT_CONNECTION_POOL_SIZE,
+                                                          pool_timeout=config.BOT_POOL_TIMEOUT))
+                   .get_updates_request(metrics.MeteredRequest()))
+    else:
+        builder = builder.connection_pool_size(config.BOT_CONNECTION_POOL_SIZE).pool_timeout(config.BOT_POOL_TIMEOUT)
+    app = builder.build()
     app.add_handler(CommandHandler('start', start))
     app.add_handler(CallbackQueryHandler(button_handler))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
     app.add_error_handler(error_handler)
-    asyncio.get_event_loop().run_until_complete(set_commands(app))
-    print("Bot started")
-    app.run_polling()
+    return app
+
+def run(app):
+    if BOT_MODE == 'webhook':
+        if not WEBHOOK_URL or not WEBHOOK_SECRET:
+            raise SystemExit("ERROR: webhook mode needs WEBHOOK_URL and WEBHOOK_SECRET in env")
+        print(f"Bot started (webhook on {config.WEBHOOK_LISTEN}:{config.WEBHOOK_PORT}/{config.WEBHOOK_PATH})")
+        app.run_webhook(
+            listen=config.WEBHOOK_LISTEN,
+            port=config.WEBHOOK_PORT,
+            url_path=config.WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{config.WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            max_connections=config.WEBHOOK_MAX_CONNECTIONS,
+            drop_pending_updates=config.DROP_PENDING_UPDATES,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    else:
+        print("Bot started (polling)")
+        app.run_polling(drop_pending_updates=config.DROP_PENDING_UPDATES, allowed_updates=Update.ALL_TYPES)
+
+if __name__ == '__main__':
+    run(build_application())
@@ -0,0 +1,204 @@
+# metrics.py
+# Метрики в текстовом формате Prometheus: гистограммы задержек обработчиков,
+# запросов к БД и вызовов Bot API, счётчики ошибок и гейджи (размер хранилища
+# сессий, кэшей), отдаются по GET /metrics с локального HTTP-порта.
+# Пока метрики выключены, start() возвращает None, а observe()/inc() сразу
+# выходят — в горячем пути остаётся одна проверка флага.
+import asyncio
+import threading
+import time
+from bisect import bisect_left
+
+from telegram.request import HTTPXRequest
+
+import config
+
+ENABLED = config.METRICS_ENABLED
+_families = {}    # name -> metric, in registration order
+_server = None
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self._values = {}     # label values tuple -> count
+        self._lock = threading.Lock()
+        _families[name] = self
+
+    def inc(self, *labels, value=1):
+        if not ENABLED:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            yield self.name + _labels(self.labelnames, labels), value
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self.buckets = tuple(buckets or config.METRICS_BUCKETS)
+        self._values = {}     # label values tuple -> [count per bucket..., count above last, sum]
+        self._lock = threading.Lock()
+        _families[name] = self
+
+    def observe(self, seconds, *labels):
+        if not ENABLED:
+            return
+        i = bisect_left(self.buckets, seconds)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[i] += 1
+            state[-1] += seconds
+
+    def time(self, started, *labels):
+        # started is what start() returned; None means metrics were off at that moment
+        if started is not None:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def samples(self):
+        with self._lock:
+            items = sorted((labels, list(state)) for labels, state in self._values.items())
+        for labels, state in items:
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), state):
+                total += count
+                yield self.name + '_bucket' + _labels(self.labelnames, labels, [('le', _number(bound))]), total
+            yield self.name + '_sum' + _labels(self.labelnames, labels), state[-1]
+            yield self.name + '_count' + _labels(self.labelnames, labels), total
+
+class Gauge:
+    # value is read from fn() at scrape time; with `label` fn returns {label value: number}
+    kind = 'gauge'
+
+    def __init__(self, name, help, fn, label=None):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.label = label
+        _families[name] = self
+
+    def samples(self):
+        value = self.fn()
+        if self.label is None:
+            yield self.name, value
+            return
+        for key, v in sorted(value.items()):
+            yield self.name + _labels((self.label,), (key,)), v
+
+def start():
+    return time.perf_counter() if ENABLED else None
+
+def render():
+    lines = []
+    for metric in list(_families.values()):
+        try:
+            samples = list(metric.samples())
+        except Exception as e:
+            print("metrics collect error:", metric.name, e)
+            continue
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(f"{name} {_number(value)}" for name, value in samples)
+    return '\n'.join(lines) + '\n'
+
+# --- instrumentation points ---------------------------------------------------
+CALLBACK_SECONDS = Histogram('bot_callback_seconds', 'Callback query handling time by route handler', ['route'])
+MESSAGE_SECONDS = Histogram('bot_message_seconds', 'Text message handling time by dialog state', ['state'])
+HANDLER_ERRORS = Counter('bot_handler_errors_total', 'Exceptions that reached the error handler', ['error'])
+DB_SECONDS = Histogram('bot_db_query_seconds', 'database.py call time in the DB threads', ['function'])
+BOT_API_SECONDS = Histogram('bot_api_request_seconds', 'Bot API request time', ['method'])
+BOT_API_REQUESTS = Counter('bot_api_requests_total', 'Bot API requests by HTTP status', ['method', 'code'])
+BOT_API_ERRORS = Counter('bot_api_errors_total', 'Failed Bot API requests (HTTP status >= 400 or network error)',
+                         ['method', 'reason'])
+BOT_API_RETRY_AFTER = Counter('bot_api_retry_after_total', 'Bot API answers 429 Too Many Requests', ['method'])
+
+def timed_call(histogram, label, call):
+    # wraps a sync callable (run in a worker thread) so its run time is observed
+    def run():
+        started = time.perf_counter()
+        try:
+            return call()
+        finally:
+            histogram.observe(time.perf_counter() - started, label)
+    return run
+
+class MeteredRequest(HTTPXRequest):
+    # HTTPXRequest that counts and times every Bot API call
+    async def do_request(self, url, method, request_data=None, **timeouts):
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, **timeouts)
+        except Exception as e:
+            BOT_API_ERRORS.inc(api_method, type(e).__name__)
+            raise
+        finally:
+            BOT_API_SECONDS.observe(time.perf_counter() - started, api_method)
+        BOT_API_REQUESTS.inc(api_method, str(code))
+        if code == 429:
+            BOT_API_RETRY_AFTER.inc(api_method)
+        if code >= 400:
+            BOT_API_ERRORS.inc(api_method, str(code))
+        return code, payload
+
+# --- HTTP endpoint --------------------------------------------------------------
+async def _serve(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?', 1)[0] == '/metrics':
+            status, body = b'200 OK', render().encode()
+        else:
+            status, body = b'404 Not Found', b'not found\n'
+        writer.write(b'HTTP/1.1 ' + status + b'\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                     b'Content-Length: ' + str(len(body)).encode() + b'\r\nConnection: close\r\n\r\n' + body)
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def start_server(host=None, port=None):
+    # returns the bound port, or None when metrics are disabled
+    global _server
+    if not ENABLED or _server is not None:
+        return None
+    _server = await asyncio.start_server(_serve, host or config.METRICS_LISTEN,
+                                         config.METRICS_PORT if port is None else port)
+    return _server.sockets[0].getsockname()[1]
+
+async def stop_server():
+    global _server
+    if _server is not None:
+        _server.close()
+        await _server.wait_closed()
+        _server = None
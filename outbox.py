@@ -0,0 +1,170 @@
+# outbox.py
+# Исходящие уведомления идут через таблицу outbox: enqueue() пишет сообщение в БД,
+# фоновый диспетчер отправляет его с учётом лимитов Telegram (общий темп и
+# интервал на чат), склеивает накопившиеся сообщения одному получателю, при
+# 429 ждёт retry_after, при сетевых ошибках повторяет с экспоненциальной
+# задержкой. Неотправленное переживает перезапуск бота.
+import asyncio
+import time
+from collections import OrderedDict
+
+from telegram.error import RetryAfter, Forbidden, BadRequest
+
+import config
+import async_database as adb
+
+TELEGRAM_TEXT_LIMIT = 4096
+SEPARATOR = "\n\n"
+
+def _seconds(value):
+    return value.total_seconds() if hasattr(value, 'total_seconds') else float(value)
+
+def coalesce(items, limit=TELEGRAM_TEXT_LIMIT):
+    # items: [(id, text, attempts)] одного получателя -> [(ids, text, attempts)],
+    # тексты склеиваются, пока помещаются в одно сообщение
+    chunks = []
+    ids, parts, size, attempts = [], [], 0, 0
+    for msg_id, text, tries in items:
+        extra = len(text) + (len(SEPARATOR) if parts else 0)
+        if parts and size + extra > limit:
+            chunks.append((ids, SEPARATOR.join(parts), attempts))
+            ids, parts, size, attempts = [], [], 0, 0
+            extra = len(text)
+        ids.append(msg_id)
+        parts.append(text)
+        size += extra
+        attempts = max(attempts, tries)
+    if parts:
+        chunks.append((ids, SEPARATOR.join(parts), attempts))
+    return chunks
+
+class Outbox:
+    def __init__(self, rate=None, chat_interval=None, batch_size=None, poll_interval=None):
+        self.rate = rate or config.OUTBOX_GLOBAL_RATE
+        self.chat_interval = config.OUTBOX_CHAT_INTERVAL if chat_interval is None else chat_interval
+        self.batch_size = batch_size or config.OUTBOX_BATCH_SIZE
+        self.poll_interval = poll_interval or config.OUTBOX_POLL_INTERVAL
+        self.bot = None
+        self.stats = {'sent': 0, 'coalesced': 0, 'retries': 0, 'flood_waits': 0, 'dropped': 0}
+        self._chat_next = {}        # chat_id -> monotonic time when the chat may receive again
+        self._next_send = 0.0       # monotonic time of the next allowed send (global rate)
+        self._paused_until = 0.0    # wall-clock time until which a 429 asked us to wait
+        self._wake = None
+        self._task = None
+
+    async def enqueue(self, chat_id, text):
+        msg_id = await adb.enqueue_outbox(chat_id, text)
+        if self._wake is not None:
+            self._wake.set()
+        return msg_id
+
+    async def _throttle(self):
+        now = time.monotonic()
+        if self._next_send > now:
+            await asyncio.sleep(self._next_send - now)
+        self._next_send = max(now, self._next_send) + 1.0 / self.rate
+
+    async def _send(self, chat_id, ids, text, attempts):
+        # False — Telegram попросил подождать, проход нужно прервать
+        try:
+            await self.bot.send_message(chat_id=chat_id, text=text)
+        except RetryAfter as e:
+            delay = _seconds(e.retry_after)
+            self._paused_until = time.time() + delay
+            self.stats['flood_waits'] += 1
+            await adb.reschedule_outbox(ids, self._paused_until, str(e), False)
+            return False
+        except (Forbidden, BadRequest) as e:
+            # бот заблокирован / чат не существует: повтор не поможет
+            print(f"outbox: сообщение в чат {chat_id} отброшено: {e}")
+            self.stats['dropped'] += len(ids)
+            await adb.delete_outbox(ids)
+            return True
+        except Exception as e:
+            attempts += 1
+            if attempts >= config.OUTBOX_MAX_ATTEMPTS:
+                print(f"outbox: сообщение в чат {chat_id} не доставлено после {attempts} попыток: {e}")
+                self.stats['dropped'] += len(ids)
+                await adb.delete_outbox(ids)
+            else:
+                delay = min(config.OUTBOX_BACKOFF_BASE * 2 ** attempts, config.OUTBOX_BACKOFF_MAX)
+                self.stats['retries'] += 1
+                await adb.reschedule_outbox(ids, time.time() + delay, str(e))
+            return True
+        self.stats['sent'] += 1
+        self.stats['coalesced'] += len(ids) - 1
+        await adb.delete_outbox(ids)
+        return True
+
+    async def drain(self):
+        # один проход по очереди; -> через сколько секунд имеет смысл следующий
+        now = time.time()
+        if self._paused_until > now:
+            return self._paused_until - now
+        rows = await adb.get_due_outbox(now, self.batch_size)
+        if not rows:
+            return await self._until_next_due()
+        groups = OrderedDict()
+        for msg_id, chat_id, text, attempts in rows:
+            groups.setdefault(chat_id, []).append((msg_id, text, attempts))
+        mono = time.monotonic()
+        self._chat_next = {c: t for c, t in self._chat_next.items() if t > mono}
+        wait = None
+        sent = False
+        for chat_id, items in groups.items():
+            ready_at = self._chat_next.get(chat_id, 0)
+            chunks = coalesce(items)
+            if ready_at <= time.monotonic():
+                ids, text, attempts = chunks.pop(0)
+                await self._throttle()
+                if not await self._send(chat_id, ids, text, attempts):
+                    return self._paused_until - time.time()
+                ready_at = time.monotonic() + self.chat_interval
+                self._chat_next[chat_id] = ready_at
+                sent = True
+            if chunks:
+                # остаток этому получателю уйдёт, когда истечёт интервал чата
+                left = max(ready_at - time.monotonic(), 0)
+                wait = left if wait is None else min(wait, left)
+        if sent and len(rows) == self.batch_size:
+            # выбрали полную пачку — в очереди могут быть ещё готовые сообщения
+            return 0
+        if wait is None:
+            return await self._until_next_due()
+        return wait
+
+    async def _until_next_due(self):
+        due = await adb.next_outbox_attempt()
+        return None if due is None else max(due - time.time(), 0)
+
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            try:
+                delay = await self.drain()
+            except Exception as e:
+                print("outbox error:", e)
+                delay = self.poll_interval
+            if delay is None or delay > self.poll_interval:
+                delay = self.poll_interval
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+
+    def start(self, bot):
+        self.bot = bot
+        if self._task is None:
+            self._wake = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # недоставленное остаётся в таблице и уйдёт после следующего запуска
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,64 @@
+# router.py
+# Маршрутизация callback_data для CallbackQueryHandler.
+# Точные ключи ищутся в словаре; ключи вида "<префикс>_<аргумент>" — по самому
+# длинному зарегистрированному префиксу (кандидаты — границы '_' справа налево),
+# аргумент приводится к типу, указанному при регистрации.
+# Время работы обработчика пишется в metrics.CALLBACK_SECONDS по его имени.
+import metrics
+
+class CallbackRouter:
+    def __init__(self):
+        self._exact = {}      # callback_data -> handler
+        self._prefixes = {}   # prefix ending with '_' -> (handler, arg_type, error_text)
+
+    def exact(self, *keys):
+        def decorator(handler):
+            for key in keys:
+                if key in self._exact:
+                    raise ValueError(f"duplicate callback route: {key}")
+                self._exact[key] = handler
+            return handler
+        return decorator
+
+    def prefix(self, prefix, arg_type=str, error=None):
+        # the rest of callback_data after `prefix` is passed to the handler as arg_type;
+        # if the conversion fails the user gets `error` (nothing happens when it is None)
+        if not prefix.endswith('_'):
+            raise ValueError(f"callback prefix must end with '_': {prefix}")
+        def decorator(handler):
+            if prefix in self._prefixes:
+                raise ValueError(f"duplicate callback prefix: {prefix}")
+            self._prefixes[prefix] = (handler, arg_type, error)
+            return handler
+        return decorator
+
+    def resolve(self, data):
+        # -> (handler or None, args, error text or None)
+        handler = self._exact.get(data)
+        if handler is not None:
+            return handler, (), None
+        end = data.rfind('_')
+        while end >= 0:
+            route = self._prefixes.get(data[:end + 1])
+            if route is not None:
+                handler, arg_type, error = route
+                try:
+                    return handler, (arg_type(data[end + 1:]),), None
+                except (TypeError, ValueError):
+                    return None, (), error
+            end = data.rfind('_', 0, end)
+        return None, (), None
+
+    async def dispatch(self, query, data, *args):
+        # handler is called as handler(query, *args, *parsed_args); returns False if nothing matched
+        handler, parsed, error = self.resolve(data)
+        if handler is None:
+            if error:
+                await query.edit_message_text(error)
+            return False
+        started = metrics.start()
+        try:
+            await handler(query, *args, *parsed)
+        finally:
+            metrics.CALLBACK_SECONDS.time(started, handler.__name__)
+        return True
@@ -0,0 +1,174 @@
+# sessions.py
+# Состояние диалога пользователей: компактный объект сессии и хранилище
+# с LRU/TTL-вытеснением и отложенной (write-behind) записью в SQLite.
+import asyncio
+import json
+import time
+from collections import OrderedDict
+
+import config
+import async_database as adb
+
+class Session:
+    # поля состояния и значения по умолчанию (отсутствующий ключ в старом dict-состоянии)
+    _DEFAULTS = {
+        'mode': 'idle',
+        'step': None,           # None — анкета не начата
+        'data': None,
+        'editing': False,
+        'await_role': None,
+        'name': None,
+        'new_name': None,
+        'change_flow': False,
+        'entering_name': False,
+        'choosing_rtp': False,
+        'fckp_left': 0,
+        'fckp_products': None,
+        'period_scope': None,
+        'org_unit': None,       # оргструктура: родитель создаваемого подразделения
+        'org_kind': None,
+    }
+    __slots__ = tuple(_DEFAULTS) + ('touched',)
+
+    def __init__(self, **fields):
+        for key, default in self._DEFAULTS.items():
+            setattr(self, key, fields.pop(key, default))
+        if self.data is None:
+            self.data = {}
+        if fields:
+            raise TypeError(f"unknown session fields: {', '.join(fields)}")
+        self.touched = time.monotonic()
+
+    @classmethod
+    def for_role(cls, mode):
+        # session ready for the questionnaire / manager menus
+        return cls(mode=mode, step=0, data={}, editing=False)
+
+    def to_dict(self):
+        return {key: getattr(self, key) for key in self._DEFAULTS}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(**{k: v for k, v in d.items() if k in cls._DEFAULTS})
+
+class SessionStore:
+    def __init__(self, max_size=None, ttl=None, flush_interval=None):
+        self.max_size = max_size or config.SESSION_MAX_SIZE
+        self.ttl = ttl or config.SESSION_TTL_SECONDS
+        self.flush_interval = flush_interval or config.SESSION_FLUSH_INTERVAL
+        self._sessions = OrderedDict()   # uid -> Session, LRU order
+        self._dirty = {}                 # uid -> Session waiting to be written
+        self._deleted = set()            # uids whose persisted row must be removed
+        self._touched = set()            # uids read since the last flush: only updated_at is refreshed
+        self._task = None
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def _expired(self, session, now):
+        return now - session.touched > self.ttl
+
+    def _remember(self, uid, session):
+        session.touched = time.monotonic()
+        self._sessions[uid] = session
+        self._sessions.move_to_end(uid)
+        while len(self._sessions) > self.max_size:
+            # LRU eviction only drops the in-memory copy; a dirty session stays queued for flush
+            self._sessions.popitem(last=False)
+        return session
+
+    def _mark_dirty(self, uid, session):
+        self._dirty[uid] = session
+        self._touched.discard(uid)
+        self._deleted.discard(uid)
+        return self._remember(uid, session)
+
+    def _touch(self, uid, session):
+        # read access: extend the TTL; the persisted row only gets its updated_at bumped on flush
+        if uid not in self._dirty:
+            self._touched.add(uid)
+        return self._remember(uid, session)
+
+    async def get(self, uid):
+        # in-memory session, or the persisted one restored lazily; None if there is none
+        session = self._sessions.get(uid)
+        now = time.monotonic()
+        if session is not None:
+            if self._expired(session, now):
+                self.pop(uid)
+                return None
+            return self._touch(uid, session)
+        if uid in self._deleted:
+            return None
+        session = self._dirty.get(uid)
+        if session is None:
+            row = await adb.load_session(uid, time.time() - self.ttl)
+            if row is None or uid in self._sessions or uid in self._deleted:
+                # a concurrent update may have created or dropped the session meanwhile
+                return self._sessions.get(uid)
+            session = Session.from_dict(json.loads(row))
+        return self._touch(uid, session)
+
+    async def ensure(self, uid):
+        session = await self.get(uid)
+        if session is None:
+            session = self.set(uid, Session.for_role('idle'))
+        return session
+
+    def set(self, uid, session):
+        return self._mark_dirty(uid, session)
+
+    def update(self, uid, session):
+        # handlers mutate the session in place and then report the change here
+        return self._mark_dirty(uid, session)
+
+    def pop(self, uid):
+        self._sessions.pop(uid, None)
+        self._dirty.pop(uid, None)
+        self._touched.discard(uid)
+        self._deleted.add(uid)
+
+    def sweep(self):
+        # drop sessions idle longer than ttl
+        now = time.monotonic()
+        for uid in [uid for uid, s in self._sessions.items() if self._expired(s, now)]:
+            self.pop(uid)
+
+    async def flush(self):
+        # write-behind: persist changed sessions and remove dropped ones
+        dirty, self._dirty = self._dirty, {}
+        deleted, self._deleted = self._deleted, set()
+        touched, self._touched = self._touched, set()
+        if dirty:
+            now = time.time()
+            rows = [(uid, json.dumps(s.to_dict(), ensure_ascii=False), now) for uid, s in dirty.items()]
+            await adb.save_sessions(rows)
+        if touched:
+            await adb.touch_sessions(list(touched), time.time())
+        if deleted:
+            await adb.delete_sessions(list(deleted))
+        await adb.delete_expired_sessions(time.time() - self.ttl)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                self.sweep()
+                await self.flush()
+            except Exception as e:
+                print("session flush error:", e)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # stop the background writer and flush what is left
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
@@ -0,0 +1,55 @@
+# update_processor.py
+# Обработчик апдейтов для Application.concurrent_updates(): апдейты разных
+# пользователей идут параллельно, апдейты одного пользователя — по одному и в
+# порядке поступления (состояние анкеты в сессии не должно меняться из двух
+# обработчиков сразу). Сначала берётся замок пользователя, потом общий семафор,
+# так что очередь одного пользователя не занимает слоты остальных.
+import asyncio
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+def update_key(update):
+    # пользователь, а если его нет (посты каналов и т.п.) — чат
+    if isinstance(update, Update):
+        if update.effective_user is not None:
+            return ('user', update.effective_user.id)
+        if update.effective_chat is not None:
+            return ('chat', update.effective_chat.id)
+    return None
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._locks = {}    # key -> [asyncio.Lock, number of updates holding or waiting]
+
+    async def process_update(self, update, coroutine):
+        key = update_key(update)
+        if key is None:
+            await super().process_update(update, coroutine)
+            return
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            # asyncio.Lock будит ожидающих в порядке FIFO — порядок апдейтов сохраняется
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def active_users(self):
+        return len(self._locks)